@@ -139,4 +139,82 @@ LOGGING = {
             'level': 'INFO',
         },
     },
-}
\ No newline at end of file
+}
+
+# Mailbox pagination
+MAILBOX_PAGE_SIZE = 50
+MAILBOX_MAX_PAGE_SIZE = 200
+
+# Number of parsed PGP public keys kept in memory per process
+PGP_KEY_CACHE_SIZE = 256
+
+# Seconds a signature verification result stays cached (None = until evicted)
+SIGNATURE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Processes used to encrypt/sign for several recipients in parallel (0 or 1 = in the request)
+PGP_WORKER_PROCESSES = 0
+
+# Encrypt each sent email once with a session key shared by all recipients,
+# instead of one ciphertext per recipient
+COMPOSE_SHARED_SESSION_KEY = False
+
+# Queue sent emails and send them from `manage.py process_outbox` instead of in the request
+COMPOSE_OUTBOX = False
+OUTBOX_CONCURRENCY = 1
+# Seconds after which a job still running is considered abandoned by its worker and queued
+# again, and the number of attempts after which a job fails for good
+OUTBOX_JOB_TIMEOUT = 300
+OUTBOX_MAX_ATTEMPTS = 3
+
+# Server-sent mailbox events (/emails/events). The local backend only reaches clients
+# connected to the process that handled the change (or ran process_outbox); multi-worker
+# deployments plug in a backend that fans events out through a shared broker. Each open
+# stream holds a worker thread under WSGI (runserver) until it ends after
+# MAIL_EVENT_STREAM_TIMEOUT seconds and the browser reconnects.
+MAIL_EVENTS = False
+MAIL_EVENT_BACKEND = 'mail.utils.events.LocalEventBackend'
+MAIL_EVENT_QUEUE_SIZE = 100
+MAIL_EVENT_KEEPALIVE = 15
+MAIL_EVENT_STREAM_TIMEOUT = 300
+
+# Ids updated per UPDATE/DELETE statement by POST /emails/bulk
+BULK_BATCH_SIZE = 500
+
+# Rows fetched per query when streaming a mailbox export
+EXPORT_CHUNK_SIZE = 500
+
+# How email bodies are stored: 'text' (as sent) or 'compact' (binary OpenPGP packets instead
+# of ASCII armor). EMAIL_COMPRESS_BODIES also zlib-compresses long plain-text bodies in compact
+# mode; those are not matched by the substring search used when SQLite FTS5 is unavailable.
+EMAIL_BODY_STORAGE = 'text'
+EMAIL_COMPRESS_BODIES = False
+EMAIL_COMPRESS_MIN_LENGTH = 256
+
+# Store each distinct body once in a content-addressed table referenced by the per-user
+# Email rows, instead of once per participant (prune with `manage.py prune_email_bodies`)
+EMAIL_SHARED_BODIES = False
+
+# HMAC key registry {version: secret}. Each HMAC records the version it was made with,
+# so a key is rotated by adding a new version and pointing HMAC_KEY_VERSION at it
+HMAC_KEYS = {1: SECRET_KEY}
+HMAC_KEY_VERSION = 1
+
+# Generate PGP keys from `manage.py process_key_jobs` instead of in the request;
+# clients poll /api/security/generate/<job_id>. Jobs running for more than
+# KEYGEN_JOB_TIMEOUT seconds are queued again, up to KEYGEN_MAX_ATTEMPTS attempts
+KEYGEN_BACKGROUND = False
+KEYGEN_JOB_TIMEOUT = 600
+KEYGEN_MAX_ATTEMPTS = 3
+
+# Pre-generated key material per (key_type, key_size), e.g. {('RSA', 2048): 5}, kept filled
+# by `manage.py process_key_jobs`. Pooled keys are stored encrypted with KEY_POOL_SECRET
+# (SECRET_KEY when unset) until they are taken; changing it discards the pooled keys.
+KEY_POOL_SIZES = {}
+KEY_POOL_SECRET = None
+
+# Keep private keys unlocked in memory per session after the first decrypt, so following
+# decrypts skip the passphrase derivation. Entries expire after UNLOCKED_KEY_CACHE_TTL
+# seconds and are dropped on logout and when the key is deleted.
+UNLOCKED_KEY_CACHE = False
+UNLOCKED_KEY_CACHE_TTL = 300
+UNLOCKED_KEY_CACHE_SIZE = 100
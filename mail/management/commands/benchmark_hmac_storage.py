@@ -0,0 +1,69 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from mail.utils.hmac_auth import compute_hmac, current_key_version
+
+# (table, columns, indexes) of the old and the current EmailHMAC layout
+LAYOUTS = [
+    (
+        'hex digest + secret', 'bench_hmac_hex',
+        'email_id INTEGER PRIMARY KEY, hmac TEXT, secret_key VARCHAR(255)', ['hmac', 'secret_key'],
+    ),
+    (
+        'binary digest + key version', 'bench_hmac_bin',
+        'email_id INTEGER PRIMARY KEY, digest BLOB, key_version SMALLINT', ['digest'],
+    ),
+]
+
+
+class Command(BaseCommand):
+    help = 'Compares insert time, index build time and size of the hex and binary EmailHMAC layouts (SQLite).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('This benchmark uses SQLite temporary tables.')
+
+        version = current_key_version()
+        digests = [compute_hmac(os.urandom(16).hex(), version) for _ in range(options['rows'])]
+        rows = {
+            'bench_hmac_hex': [(i, digest.hex(), settings.SECRET_KEY) for i, digest in enumerate(digests)],
+            'bench_hmac_bin': [(i, digest, version) for i, digest in enumerate(digests)],
+        }
+
+        with connection.cursor() as cursor:
+            for label, table, columns, indexed in LAYOUTS:
+                cursor.execute(f'DROP TABLE IF EXISTS temp.{table}')
+                cursor.execute(f'CREATE TEMP TABLE {table} ({columns})')
+
+                start = time.perf_counter()
+                cursor.executemany(f'INSERT INTO {table} VALUES (%s, %s, %s)', rows[table])
+                insert_ms = (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                for column in indexed:
+                    cursor.execute(f'CREATE INDEX temp.{table}_{column} ON {table} ({column})')
+                index_ms = (time.perf_counter() - start) * 1000
+
+                self.stdout.write(f'{label}: insert {insert_ms:.1f} ms, index build {index_ms:.1f} ms')
+                for name, size in self.sizes(cursor, table, [f'{table}_{column}' for column in indexed]):
+                    self.stdout.write(f'    {name}: {size}')
+                cursor.execute(f'DROP TABLE temp.{table}')
+
+    # Bytes used by the table and its indexes, if SQLite was built with the dbstat table
+    def sizes(self, cursor, table, indexes):
+        names = [table] + indexes
+        placeholders = ', '.join(['%s'] * len(names))
+        try:
+            cursor.execute(
+                f'SELECT name, SUM(pgsize) FROM dbstat(%s) WHERE name IN ({placeholders}) GROUP BY name',
+                ['temp'] + names,
+            )
+        except Exception:
+            return [(name, 'size unavailable (no dbstat)') for name in names]
+        sizes = dict(cursor.fetchall())
+        return [(name, f'{sizes.get(name, 0) / 1024:.0f} KiB') for name in names]
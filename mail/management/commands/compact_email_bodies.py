@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mail.models import Email
+
+BODY_FIELDS = ['content', 'body', 'body_data', 'body_encoding']
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrites inline email bodies in the storage format set by EMAIL_BODY_STORAGE, '
+        'moving them to shared bodies when EMAIL_SHARED_BODIES is on.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        emails = Email.objects.filter(content__isnull=True).only(*BODY_FIELDS).order_by('id')
+
+        total = 0
+        batch = []
+        for email in emails.iterator(chunk_size=batch_size):
+            batch.append(email)
+            if len(batch) == batch_size:
+                total += self.save(batch)
+                batch = []
+        total += self.save(batch)
+
+        self.stdout.write(f'Compacted {total} email(s).')
+
+    @transaction.atomic
+    def save(self, emails):
+        texts = {email.id: email.get_body() for email in emails}
+        packed = Email.pack_bodies(texts.values())
+
+        changed = []
+        for email in emails:
+            fields = packed[texts[email.id]]
+            if fields.get('content') is None and fields['body_encoding'] == email.body_encoding:
+                continue
+            for field, value in fields.items():
+                setattr(email, field, value)
+            changed.append(email)
+
+        Email.objects.bulk_update(changed, BODY_FIELDS)
+        return len(changed)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from mail.models import User
+from mail.utils.mailbox_formats import MAILDIR, MBOX, export_queryset, mbox_records, write_maildir
+
+
+class Command(BaseCommand):
+    help = "Exports a user's emails to an mbox file or a Maildir directory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help='Owner of the mailbox.')
+        parser.add_argument('path', help='mbox file or Maildir directory to write.')
+        parser.add_argument('--format', choices=[MBOX, MAILDIR], default=MBOX)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email__iexact=options['email']).first()
+        if user is None:
+            raise CommandError('User not found.')
+
+        emails = export_queryset(user).iterator(chunk_size=options['batch_size'])
+        if options['format'] == MAILDIR:
+            total = write_maildir(options['path'], emails)
+        else:
+            total = 0
+            with open(options['path'], 'wb') as f:
+                for record in mbox_records(emails):
+                    f.write(record)
+                    total += 1
+
+        self.stdout.write(f'Exported {total} email(s).')
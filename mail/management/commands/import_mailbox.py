@@ -0,0 +1,30 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from mail.models import User
+from mail.utils.mailbox_formats import MAILDIR, MBOX, import_messages, read_maildir, read_mbox
+
+
+class Command(BaseCommand):
+    help = "Imports an mbox file or a Maildir directory into a user's mailbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help='Owner of the imported emails.')
+        parser.add_argument('path', help='mbox file or Maildir directory to read.')
+        parser.add_argument(
+            '--format', choices=[MBOX, MAILDIR], help='Default: maildir for directories, mbox otherwise.'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email__iexact=options['email']).first()
+        if user is None:
+            raise CommandError('User not found.')
+
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist.')
+        output_format = options['format'] or (MAILDIR if os.path.isdir(path) else MBOX)
+        messages = read_maildir(path) if output_format == MAILDIR else read_mbox(path)
+
+        imported, skipped = import_messages(user, messages, batch_size=options['batch_size'])
+        self.stdout.write(f'Imported {imported} email(s), skipped {skipped} with an unknown sender or signing key.')
@@ -0,0 +1,102 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from mail.models import Email, MailboxEntry, User
+from mail.views.mailbox import mailbox_queryset, mailbox_summary_queryset, mailbox_entries_queryset
+
+MAILBOXES = ['inbox', 'sent', 'archive']
+
+
+# Returns the EXPLAIN QUERY PLAN lines of a queryset (SQLite)
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+# The query behind the first page of a mailbox listing, from Email
+def first_page_queryset(user, mailbox, limit):
+    emails = mailbox_summary_queryset(mailbox_queryset(user, mailbox))
+    return emails.order_by('-timestamp', '-id')[:limit + 1]
+
+
+# The query behind the first page of a mailbox listing, from MailboxEntry
+def first_entries_page_queryset(user, mailbox, limit):
+    return mailbox_entries_queryset(user, mailbox).order_by('-timestamp', '-pk')[:limit + 1]
+
+
+class Command(BaseCommand):
+    help = 'Shows the query plan and timing of the mailbox listing queries, optionally on generated data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', help='User whose mailboxes are queried (default: first user).')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Query a throwaway user with this many generated emails instead; nothing is kept.',
+        )
+        parser.add_argument('--limit', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('EXPLAIN QUERY PLAN output is only available on SQLite.')
+
+        if options['seed']:
+            if options['email']:
+                raise CommandError('--seed generates its own user and cannot be used with --email.')
+            # The generated users and emails bypass counters, change log and search index,
+            # so everything is rolled back once the plans are shown
+            with transaction.atomic():
+                user = self.seed(options['seed'])
+                self.show_plans(user, options)
+                transaction.set_rollback(True)
+            return
+
+        user = User.objects.filter(email=options['email']).first() if options['email'] else User.objects.first()
+        if user is None:
+            raise CommandError('User not found.')
+        self.show_plans(user, options)
+
+    def show_plans(self, user, options):
+        for mailbox in MAILBOXES:
+            for source, page_queryset in [('email', first_page_queryset), ('entries', first_entries_page_queryset)]:
+                queryset = page_queryset(user, mailbox, options['limit'])
+
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    list(queryset.all())
+                elapsed = (time.perf_counter() - start) / options['repeat'] * 1000
+
+                self.stdout.write(f'{mailbox} ({source}): {elapsed:.2f} ms per page')
+                for line in query_plan(queryset):
+                    self.stdout.write(f'    {line}')
+
+    # Creates a throwaway user with emails in both directions to another throwaway user
+    def seed(self, count):
+        user = User.objects.create(username='owner@benchmark.invalid', email='owner@benchmark.invalid')
+        other = User.objects.create(username='other@benchmark.invalid', email='other@benchmark.invalid')
+        EmailRecipient = Email.recipients.through
+        batch_size = 1000
+        for start in range(0, count, batch_size):
+            emails = []
+            for i in range(start, min(start + batch_size, count)):
+                received = i % 2 == 0
+                emails.append(Email(
+                    user=user,
+                    sender=other if received else user,
+                    subject=f'Benchmark {i}',
+                    body='Lorem ipsum dolor sit amet',
+                    archived=received and i % 10 == 0,
+                ))
+            Email.objects.bulk_create(emails)
+            EmailRecipient.objects.bulk_create([
+                EmailRecipient(email_id=email.id, user_id=user.id if email.sender_id == other.id else other.id)
+                for email in emails
+            ])
+            MailboxEntry.objects.bulk_create([
+                MailboxEntry.from_email(email, [user if email.sender_id == other.id else other])
+                for email in emails
+            ])
+        self.stdout.write(f'Generated {count} emails.')
+        return user
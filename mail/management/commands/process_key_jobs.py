@@ -0,0 +1,43 @@
+import time
+from django.core.management.base import BaseCommand
+from mail.utils.key_jobs import drain_key_jobs
+from mail.utils.key_pool import fill_key_pool
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates the PGP keys queued by /api/security/generate (KEYGEN_BACKGROUND mode) '
+        'and keeps the key pool (KEY_POOL_SIZES) filled.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait before polling an empty queue again.',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the queue and fill the key pool once, then exit.',
+        )
+        parser.add_argument(
+            '--no-pool', action='store_true',
+            help='Do not generate keys for the key pool.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_key_jobs()
+            if processed:
+                self.stdout.write(f'Processed {processed} key generation job(s).')
+
+            if options['once']:
+                if not options['no_pool']:
+                    generated = fill_key_pool()
+                    if generated:
+                        self.stdout.write(f'Added {generated} key(s) to the key pool.')
+                return
+
+            # Fill the pool one key at a time so queued jobs are not kept waiting
+            if not options['no_pool'] and fill_key_pool(limit=1):
+                continue
+            time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mail.utils.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails queued in the outbox (COMPOSE_OUTBOX mode).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=getattr(settings, 'OUTBOX_CONCURRENCY', 1),
+            help='Number of jobs processed at the same time.',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait before polling an empty queue again.',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the queue once and exit.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_outbox(options['concurrency'])
+            if processed:
+                self.stdout.write(f'Processed {processed} outbox job(s).')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
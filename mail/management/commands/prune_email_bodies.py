@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from mail.models import Email, EmailBody
+
+
+class Command(BaseCommand):
+    help = 'Deletes shared email bodies that no email references any more.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be deleted.')
+
+    def handle(self, *args, **options):
+        orphans = EmailBody.objects.filter(~Exists(Email.objects.filter(content=OuterRef('pk'))))
+        if options['dry_run']:
+            self.stdout.write(f'Would delete {orphans.count()} EmailBody row(s).')
+            return
+
+        batch_size = options['batch_size']
+        total = 0
+        while True:
+            digests = list(orphans.values_list('digest', flat=True)[:batch_size])
+            if not digests:
+                break
+            # Re-checked in the DELETE, in case an email started using the body meanwhile
+            total += orphans.filter(digest__in=digests).delete()[0]
+        self.stdout.write(f'Deleted {total} EmailBody row(s).')
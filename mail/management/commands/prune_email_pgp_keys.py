@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, F, Min, OuterRef, Q
+from mail.models import EmailPGPKey, EmailRecipient
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes EmailPGPKey rows that link an email to keys it was not encrypted with, '
+        'as written by compose before it only linked the recipients of each email.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be deleted.')
+
+    def handle(self, *args, **options):
+        links = EmailPGPKey.objects.filter(recipient_public_key__isnull=False)
+
+        # A recipient key belongs to an email if the email's sender received it from one
+        # of the email's recipients, and it is the key of the email's owner (recipient
+        # copy) or the owner is the sender
+        is_recipient = Exists(EmailRecipient.objects.filter(
+            email=OuterRef('email'), user=OuterRef('recipient_public_key__owner')
+        ))
+        unrelated = links.filter(
+            ~Q(recipient_public_key__user=F('email__sender'))
+            | ~is_recipient
+            | (~Q(email__user=F('email__sender')) & ~Q(recipient_public_key__owner=F('email__user')))
+        )
+        unrelated_ids = list(unrelated.values_list('id', flat=True))
+
+        # Keep one row per (email, recipient key)
+        duplicate_ids = []
+        duplicates = (
+            links.exclude(id__in=unrelated_ids)
+            .values('email', 'recipient_public_key')
+            .annotate(keep=Min('id'), count=Count('id'))
+            .filter(count__gt=1)
+        )
+        for group in duplicates:
+            duplicate_ids += links.filter(
+                email=group['email'], recipient_public_key=group['recipient_public_key']
+            ).exclude(id=group['keep']).values_list('id', flat=True)
+
+        ids = unrelated_ids + duplicate_ids
+        if options['dry_run']:
+            self.stdout.write(f'Would delete {len(ids)} EmailPGPKey row(s).')
+            return
+
+        batch_size = options['batch_size']
+        for start in range(0, len(ids), batch_size):
+            EmailPGPKey.objects.filter(id__in=ids[start:start + batch_size]).delete()
+        self.stdout.write(f'Deleted {len(ids)} EmailPGPKey row(s).')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+from mail.models import Email, User
+from mail.utils.search import clear_search_index, index_emails
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of all emails.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        clear_search_index()
+
+        emails = Email.objects.select_related('sender', 'content').prefetch_related(
+            Prefetch('recipients', queryset=User.objects.only('id', 'email'))
+        ).order_by('id')
+
+        batch_size = options['batch_size']
+        batch = []
+        total = 0
+        for email in emails.iterator(chunk_size=batch_size):
+            batch.append(email)
+            if len(batch) == batch_size:
+                index_emails(batch)
+                total += len(batch)
+                batch = []
+        index_emails(batch)
+        total += len(batch)
+
+        self.stdout.write(f'Indexed {total} email(s).')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from mail.models import User
+from mail.utils.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-folder total/unread counters from the mailbox listing rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', action='append', help='Only reconcile this user (can be repeated).')
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options['email']:
+            user_ids = list(User.objects.filter(email__in=options['email']).values_list('id', flat=True))
+            if not user_ids:
+                raise CommandError('User not found.')
+
+        reconcile_counters(user_ids)
+        self.stdout.write('Mailbox counters reconciled.')
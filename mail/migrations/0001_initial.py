@@ -0,0 +1,176 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:20
+
+from django.conf import settings
+import django.contrib.auth.models
+import django.contrib.auth.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('username', models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, unique=True, validators=[django.contrib.auth.validators.UnicodeUsernameValidator()], verbose_name='username')),
+                ('first_name', models.CharField(blank=True, max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('email', models.EmailField(blank=True, max_length=254, verbose_name='email address')),
+                ('is_staff', models.BooleanField(default=False, help_text='Designates whether the user can log into this admin site.', verbose_name='staff status')),
+                ('is_active', models.BooleanField(default=True, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'verbose_name': 'user',
+                'verbose_name_plural': 'users',
+                'abstract': False,
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Email',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField(blank=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('read', models.BooleanField(default=False)),
+                ('archived', models.BooleanField(default=False)),
+                ('encrypted', models.BooleanField(default=False)),
+                ('signed', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReceivedPublicKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_id', models.CharField(db_index=True, max_length=255)),
+                ('public_key', models.TextField()),
+                ('expire_date', models.DateTimeField(db_index=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='public_keys_received', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='public_keys', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_received_public_keys',
+            },
+        ),
+        migrations.CreateModel(
+            name='PGPKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_id', models.CharField(db_index=True, max_length=255, unique=True)),
+                ('private_key', models.TextField()),
+                ('public_key', models.TextField()),
+                ('key_size', models.IntegerField(default=0)),
+                ('encrypt', models.BooleanField(default=False)),
+                ('sign', models.BooleanField(default=False)),
+                ('passphrase', models.CharField(max_length=255)),
+                ('expire_date', models.DateTimeField(db_index=True)),
+                ('default_key', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pgp_keys', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_pgp_keys',
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_outbox_jobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='EmailRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mail.email')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_email_recipients',
+            },
+        ),
+        migrations.CreateModel(
+            name='EmailPGPKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='public_keys', to='mail.email')),
+                ('recipient_public_key', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='emails', to='mail.receivedpublickey')),
+                ('sender_public_key', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='emails', to='mail.pgpkey')),
+            ],
+            options={
+                'db_table': 'mail_email_pgp_keys',
+            },
+        ),
+        migrations.CreateModel(
+            name='EmailHMAC',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hmac', models.TextField(db_index=True)),
+                ('secret_key', models.CharField(db_index=True, max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hmac', to='mail.email')),
+            ],
+            options={
+                'db_table': 'mail_email_hmacs',
+            },
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='recipients',
+            field=models.ManyToManyField(related_name='emails_received', through='mail.EmailRecipient', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='emails_sent', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='emails', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='receivedpublickey',
+            index=models.Index(fields=['user', 'owner'], name='mail_receiv_user_id_5256f7_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='receivedpublickey',
+            unique_together={('user', 'owner')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='emailrecipient',
+            unique_together={('email', 'user')},
+        ),
+        migrations.AddIndex(
+            model_name='emailpgpkey',
+            index=models.Index(fields=['email', 'recipient_public_key'], name='mail_email__email_i_cbc056_idx'),
+        ),
+    ]
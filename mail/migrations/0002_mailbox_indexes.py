@@ -0,0 +1,25 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['user', 'archived', '-timestamp', '-id'], name='mail_email_user_arch_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['user', 'sender', '-timestamp', '-id'], name='mail_email_user_sender_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailrecipient',
+            index=models.Index(fields=['user', 'email'], name='mail_email_rcpt_user_idx'),
+        ),
+    ]
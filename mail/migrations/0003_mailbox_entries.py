@@ -0,0 +1,70 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Creates the listing rows of the emails that already exist
+def create_mailbox_entries(apps, schema_editor):
+    Email = apps.get_model('mail', 'Email')
+    MailboxEntry = apps.get_model('mail', 'MailboxEntry')
+
+    batch = []
+    emails = Email.objects.select_related('sender').prefetch_related('recipients').order_by('id')
+    for email in emails.iterator(chunk_size=1000):
+        if email.user_id == email.sender_id:
+            folder = 'sent'
+        else:
+            folder = 'archive' if email.archived else 'inbox'
+        recipients = [user.email for user in email.recipients.all()]
+        batch.append(MailboxEntry(
+            email_id=email.id,
+            owner_id=email.user_id,
+            folder=folder,
+            timestamp=email.timestamp,
+            read=email.read,
+            archived=email.archived,
+            encrypted=email.encrypted,
+            signed=email.signed,
+            subject=email.subject,
+            sender_display=email.sender.email,
+            recipients_display=','.join(recipients),
+            preview='' if email.body.startswith('-----BEGIN PGP') else email.body[:100],
+        ))
+        if len(batch) == 1000:
+            MailboxEntry.objects.bulk_create(batch)
+            batch = []
+    MailboxEntry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0002_mailbox_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxEntry',
+            fields=[
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mailbox_entry', serialize=False, to='mail.email')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('archive', 'Archive')], max_length=16)),
+                ('timestamp', models.DateTimeField()),
+                ('read', models.BooleanField(default=False)),
+                ('archived', models.BooleanField(default=False)),
+                ('encrypted', models.BooleanField(default=False)),
+                ('signed', models.BooleanField(default=False)),
+                ('subject', models.CharField(max_length=255)),
+                ('sender_display', models.CharField(max_length=254)),
+                ('recipients_display', models.TextField(blank=True)),
+                ('preview', models.CharField(blank=True, max_length=100)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_mailbox_entries',
+                'indexes': [models.Index(fields=['owner', 'folder', '-timestamp', '-email'], name='mail_mailbox_listing_idx'), models.Index(fields=['owner', 'folder', 'read'], name='mail_mailbox_unread_idx')],
+            },
+        ),
+        migrations.RunPython(create_mailbox_entries, migrations.RunPython.noop),
+    ]
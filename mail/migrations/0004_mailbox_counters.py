@@ -0,0 +1,46 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:24
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+# Computes the counters of the existing mailbox entries
+def create_mailbox_counters(apps, schema_editor):
+    MailboxEntry = apps.get_model('mail', 'MailboxEntry')
+    MailboxCounter = apps.get_model('mail', 'MailboxCounter')
+
+    rows = MailboxEntry.objects.values('owner_id', 'folder').annotate(
+        total=Count('pk'),
+        unread=Count('pk', filter=Q(read=False)),
+    )
+    MailboxCounter.objects.bulk_create([
+        MailboxCounter(owner_id=row['owner_id'], folder=row['folder'], total=row['total'], unread=row['unread'])
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0003_mailbox_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('archive', 'Archive')], max_length=16)),
+                ('total', models.IntegerField(default=0)),
+                ('unread', models.IntegerField(default=0)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_mailbox_counters',
+                'unique_together': {('owner', 'folder')},
+            },
+        ),
+        migrations.RunPython(create_mailbox_counters, migrations.RunPython.noop),
+    ]
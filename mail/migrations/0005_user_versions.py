@@ -0,0 +1,28 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0004_mailbox_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='version', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('mailbox_version', models.BigIntegerField(default=0)),
+                ('mailbox_updated', models.DateTimeField(null=True)),
+                ('keys_version', models.BigIntegerField(default=0)),
+                ('keys_updated', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'mail_user_versions',
+            },
+        ),
+    ]
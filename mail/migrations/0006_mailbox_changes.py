@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0005_user_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email_id', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_changes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_mailbox_changes',
+                'indexes': [models.Index(fields=['owner', 'id'], name='mail_mailbox_changes_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:33
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0006_mailbox_changes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
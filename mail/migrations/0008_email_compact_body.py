@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0007_email_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='body_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='body_encoding',
+            field=models.CharField(blank=True, default='', max_length=8),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0008_email_compact_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailBody',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('body', models.TextField(blank=True)),
+                ('body_data', models.BinaryField(blank=True, null=True)),
+                ('body_encoding', models.CharField(blank=True, default='', max_length=8)),
+            ],
+            options={
+                'db_table': 'mail_email_bodies',
+            },
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='content',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='emails', to='mail.emailbody'),
+        ),
+    ]
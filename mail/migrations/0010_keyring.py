@@ -0,0 +1,123 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+# Metadata of an armored key, or the defaults if it cannot be parsed
+def key_metadata(armored):
+    import pgpy
+    from pgpy.constants import KeyFlags
+    try:
+        key, _ = pgpy.PGPKey.from_blob(armored)
+    except Exception:
+        return {}
+    flags = set()
+    for uid in key.userids:
+        if uid.selfsig is not None:
+            flags |= set(uid.selfsig.key_flags)
+    return {
+        'key_size': key.key_size if isinstance(key.key_size, int) else 0,
+        'encrypt': KeyFlags.EncryptCommunications in flags or bool(key.subkeys),
+        'sign': KeyFlags.Sign in flags,
+        'expire_date': key.expires_at,
+    }
+
+
+"""
+Moves the armored keys of ReceivedPublicKey into the keyring, one row per
+fingerprint however many users received it, and points the received keys and
+the email key links at it.
+"""
+def collapse_received_keys(apps, schema_editor):
+    KeyringKey = apps.get_model('mail', 'KeyringKey')
+    PGPKey = apps.get_model('mail', 'PGPKey')
+    ReceivedPublicKey = apps.get_model('mail', 'ReceivedPublicKey')
+    EmailPGPKey = apps.get_model('mail', 'EmailPGPKey')
+
+    # Most recent copy of each fingerprint
+    keys = {}
+    for key_id, public_key in ReceivedPublicKey.objects.order_by('id').values_list('key_id', 'public_key').iterator():
+        keys[key_id] = public_key
+
+    # The owners' key rows already hold the metadata; parse only keys without one
+    owned = {key.key_id: key for key in PGPKey.objects.filter(key_id__in=list(keys))}
+    entries = []
+    for fingerprint, public_key in keys.items():
+        owned_key = owned.get(fingerprint)
+        if owned_key is not None:
+            metadata = {
+                'key_size': owned_key.key_size,
+                'encrypt': owned_key.encrypt,
+                'sign': owned_key.sign,
+                'expire_date': owned_key.expire_date,
+            }
+        else:
+            metadata = key_metadata(public_key)
+        entries.append(KeyringKey(fingerprint=fingerprint, public_key=public_key, **metadata))
+    KeyringKey.objects.bulk_create(entries, batch_size=1000)
+
+    ReceivedPublicKey.objects.update(keyring_id=models.F('key_id'))
+    EmailPGPKey.objects.filter(recipient_public_key__isnull=False).update(
+        recipient_key_id=Subquery(
+            ReceivedPublicKey.objects.filter(pk=OuterRef('recipient_public_key')).values('key_id')[:1]
+        )
+    )
+
+
+# Copies the keys back before the column is restored
+def restore_received_keys(apps, schema_editor):
+    KeyringKey = apps.get_model('mail', 'KeyringKey')
+    ReceivedPublicKey = apps.get_model('mail', 'ReceivedPublicKey')
+    ReceivedPublicKey.objects.update(
+        public_key=Subquery(KeyringKey.objects.filter(pk=OuterRef('keyring')).values('public_key')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0009_email_bodies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyringKey',
+            fields=[
+                ('fingerprint', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('public_key', models.TextField()),
+                ('key_size', models.IntegerField(default=0)),
+                ('encrypt', models.BooleanField(default=False)),
+                ('sign', models.BooleanField(default=False)),
+                ('expire_date', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'mail_keyring',
+            },
+        ),
+        migrations.AddField(
+            model_name='receivedpublickey',
+            name='keyring',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='received', to='mail.keyringkey'),
+        ),
+        migrations.AddField(
+            model_name='emailpgpkey',
+            name='recipient_key',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='emails', to='mail.keyringkey'),
+        ),
+        migrations.AlterField(
+            model_name='receivedpublickey',
+            name='public_key',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(collapse_received_keys, restore_received_keys),
+        migrations.RemoveField(
+            model_name='receivedpublickey',
+            name='public_key',
+        ),
+        migrations.AlterField(
+            model_name='receivedpublickey',
+            name='keyring',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='received', to='mail.keyringkey'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+def hmac_keys():
+    return getattr(settings, 'HMAC_KEYS', None) or {1: settings.SECRET_KEY}
+
+
+# Hex digests become 32 bytes, and the stored secret the version of the same key in the registry
+def hmac_to_binary(apps, schema_editor):
+    EmailHMAC = apps.get_model('mail', 'EmailHMAC')
+    versions = {secret: version for version, secret in hmac_keys().items()}
+
+    batch = []
+    for row in EmailHMAC.objects.only('id', 'hmac', 'secret_key').iterator(chunk_size=1000):
+        try:
+            row.digest = bytes.fromhex(row.hmac)
+        except ValueError:
+            row.digest = b''
+        # 0: signed with a key that is not in the registry (cannot be verified)
+        row.key_version = versions.get(row.secret_key, 0)
+        batch.append(row)
+        if len(batch) == 1000:
+            EmailHMAC.objects.bulk_update(batch, ['digest', 'key_version'])
+            batch = []
+    EmailHMAC.objects.bulk_update(batch, ['digest', 'key_version'])
+
+
+def hmac_to_hex(apps, schema_editor):
+    EmailHMAC = apps.get_model('mail', 'EmailHMAC')
+    keys = hmac_keys()
+
+    batch = []
+    for row in EmailHMAC.objects.only('id', 'digest', 'key_version').iterator(chunk_size=1000):
+        row.hmac = bytes(row.digest).hex()
+        row.secret_key = keys.get(row.key_version, '')
+        batch.append(row)
+        if len(batch) == 1000:
+            EmailHMAC.objects.bulk_update(batch, ['hmac', 'secret_key'])
+            batch = []
+    EmailHMAC.objects.bulk_update(batch, ['hmac', 'secret_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0010_keyring'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailhmac',
+            name='digest',
+            field=models.BinaryField(db_index=True, default=b'', max_length=32),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='emailhmac',
+            name='key_version',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='emailhmac',
+            name='hmac',
+            field=models.TextField(db_index=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='emailhmac',
+            name='secret_key',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(hmac_to_binary, hmac_to_hex),
+        migrations.RemoveField(
+            model_name='emailhmac',
+            name='hmac',
+        ),
+        migrations.RemoveField(
+            model_name='emailhmac',
+            name='secret_key',
+        ),
+    ]
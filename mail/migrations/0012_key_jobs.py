@@ -0,0 +1,46 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0011_email_hmac_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_type', models.CharField(max_length=8)),
+                ('key_size', models.IntegerField()),
+                ('key_data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'mail_key_pool',
+                'indexes': [models.Index(fields=['key_type', 'key_size'], name='mail_key_pool_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='KeyGenJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('key', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mail.pgpkey')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'mail_key_jobs',
+            },
+        ),
+    ]
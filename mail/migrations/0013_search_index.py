@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+# SQLite FTS5 table of the mailbox search (see mail.utils.search). Other databases
+# search with a LIKE fallback and get no table.
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS mail_email_fts USING fts5('
+        'owner, subject, sender, recipients, body, tokenize="unicode61")'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS mail_email_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0012_key_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,7 +1,12 @@
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
+from django.conf import settings
 from django.db import models
 import pytz
+from mail.utils import body_storage
+
+# Number of body characters included in mailbox list previews
+PREVIEW_LENGTH = 100
 
 
 class User(AbstractUser):
@@ -9,19 +14,97 @@ class User(AbstractUser):
         return f'{self.username}'
 
 
+# Content-addressed email body, shared by every Email row with the same stored body
+# (the copies of one send, and identical bodies across sends). Used when EMAIL_SHARED_BODIES is on.
+class EmailBody(models.Model):
+    digest = models.CharField(max_length=64, primary_key=True)
+    body = models.TextField(blank=True)
+    body_data = models.BinaryField(null=True, blank=True)
+    body_encoding = models.CharField(max_length=8, blank=True, default=body_storage.TEXT)
+
+    class Meta:
+        db_table = 'mail_email_bodies'
+
+    # Returns {text: EmailBody} for the texts, inserting the missing bodies with one query
+    @classmethod
+    def store(cls, texts):
+        bodies = {}
+        for text in set(texts):
+            fields = body_storage.pack_body(text)
+            bodies[text] = cls(digest=body_storage.body_digest(fields), **fields)
+        cls.objects.bulk_create(bodies.values(), ignore_conflicts=True)
+        return bodies
+
+
 class Email(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='emails')
     sender = models.ForeignKey(User, on_delete=models.PROTECT, related_name='emails_sent')
-    recipients = models.ManyToManyField(User, related_name='emails_received')
+    recipients = models.ManyToManyField(User, related_name='emails_received', through='EmailRecipient')
     subject = models.CharField(max_length=255)
     body = models.TextField(blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Compact storage of the body (see mail.utils.body_storage); body is then empty
+    body_data = models.BinaryField(null=True, blank=True)
+    body_encoding = models.CharField(max_length=8, blank=True, default=body_storage.TEXT)
+    # Shared body; the inline body fields above are then empty
+    content = models.ForeignKey(EmailBody, null=True, blank=True, on_delete=models.PROTECT, related_name='emails')
+    # A default rather than auto_now_add, so imported emails keep their date
+    timestamp = models.DateTimeField(default=timezone.now)
     read = models.BooleanField(default=False)
     archived = models.BooleanField(default=False)
     encrypted = models.BooleanField(default=False)
     signed = models.BooleanField(default=False)
 
-    def serialize(self):
+    class Meta:
+        indexes = [
+            # inbox / archive: user, archived, newest first
+            models.Index(fields=['user', 'archived', '-timestamp', '-id'], name='mail_email_user_arch_ts_idx'),
+            # sent: user, sender, newest first
+            models.Index(fields=['user', 'sender', '-timestamp', '-id'], name='mail_email_user_sender_ts_idx'),
+        ]
+
+    # Returns {text: Email field values} storing each text as configured by EMAIL_BODY_STORAGE:
+    # in a shared EmailBody row when EMAIL_SHARED_BODIES is on (inserted here, one query
+    # for all the texts), inline otherwise
+    @staticmethod
+    def pack_bodies(texts):
+        if getattr(settings, 'EMAIL_SHARED_BODIES', False):
+            return {
+                text: {'content': content, 'body': '', 'body_data': None, 'body_encoding': body_storage.TEXT}
+                for text, content in EmailBody.store(texts).items()
+            }
+        return {text: body_storage.pack_body(text) for text in set(texts)}
+
+    @classmethod
+    def with_body(cls, body, **fields):
+        return cls(**fields, **cls.pack_bodies([body])[body])
+
+    # (body, body_data, body_encoding) of the shared or inline body
+    def get_stored_fields(self):
+        stored = self.content if self.content_id is not None else self
+        return stored.body, stored.body_data, stored.body_encoding
+
+    def get_body_encoding(self):
+        return self.get_stored_fields()[2]
+
+    # The body as text; PGP messages stored in binary are armored here
+    def get_body(self):
+        return body_storage.unpack_body(*self.get_stored_fields())
+
+    # The body as given to pgpy (binary packets are not armored)
+    def get_pgp_body(self):
+        return body_storage.pgp_body(*self.get_stored_fields())
+
+    # Raw stored bytes of the body, e.g. for digests
+    def get_stored_body(self):
+        return body_storage.stored_bytes(*self.get_stored_fields())
+
+    def get_preview(self):
+        if self.get_body_encoding() == body_storage.PGP:
+            return ''
+        return body_preview(self.get_body())
+
+    # body replaces the stored body (e.g. a verified or decrypted text)
+    def serialize(self, body=None):
         tz = pytz.timezone('Asia/Bangkok')
         timestamp_date = self.timestamp.astimezone(tz)
         
@@ -30,7 +113,122 @@ class Email(models.Model):
             'sender': self.sender.email,
             'recipients': [user.email for user in self.recipients.all()],
             'subject': self.subject,
-            'body': self.body,
+            'body': self.get_body() if body is None else body,
+            'timestamp': timestamp_date.strftime('%b %d %Y, %I:%M %p'),
+            'read': self.read,
+            'archived': self.archived,
+            'encrypted': self.encrypted,
+            'signed': self.signed,
+        }
+
+    # Lightweight representation for mailbox listings, without the body.
+    # Expects `preview` to be annotated on the queryset (see mailbox_summary_queryset)
+    def serialize_summary(self):
+        tz = pytz.timezone('Asia/Bangkok')
+        timestamp_date = self.timestamp.astimezone(tz)
+        preview = body_preview(getattr(self, 'preview', None) or '')
+
+        return {
+            'id': self.id,
+            'sender': self.sender.email,
+            'recipients': [user.email for user in self.recipients.all()],
+            'subject': self.subject,
+            'preview': preview,
+            'timestamp': timestamp_date.strftime('%b %d %Y, %I:%M %p'),
+            'read': self.read,
+            'archived': self.archived,
+            'encrypted': self.encrypted,
+            'signed': self.signed,
+        }
+
+
+class EmailRecipient(models.Model):
+    email = models.ForeignKey(Email, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'mail_email_recipients'
+        unique_together = ('email', 'user')
+        indexes = [
+            # "emails received by user": look up by user, join on email
+            models.Index(fields=['user', 'email'], name='mail_email_rcpt_user_idx'),
+        ]
+
+
+# Returns the mailbox an email row belongs to for its owner
+def mailbox_folder(user_id, sender_id, archived):
+    if user_id == sender_id:
+        return MailboxEntry.SENT
+    return MailboxEntry.ARCHIVE if archived else MailboxEntry.INBOX
+
+
+# Returns the list preview of a body: armored PGP bodies are not readable, so don't preview them
+def body_preview(body):
+    if body.startswith('-----BEGIN PGP'):
+        return ''
+    return body[:PREVIEW_LENGTH]
+
+
+# Denormalized listing row, one per Email, holding only what a mailbox listing shows.
+# Listings and unread counts read this narrow table instead of Email bodies and the recipients join.
+class MailboxEntry(models.Model):
+    INBOX = 'inbox'
+    SENT = 'sent'
+    ARCHIVE = 'archive'
+    FOLDER_CHOICES = [
+        (INBOX, 'Inbox'),
+        (SENT, 'Sent'),
+        (ARCHIVE, 'Archive'),
+    ]
+
+    email = models.OneToOneField(Email, on_delete=models.CASCADE, primary_key=True, related_name='mailbox_entry')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mailbox_entries')
+    folder = models.CharField(max_length=16, choices=FOLDER_CHOICES)
+    timestamp = models.DateTimeField()
+    read = models.BooleanField(default=False)
+    archived = models.BooleanField(default=False)
+    encrypted = models.BooleanField(default=False)
+    signed = models.BooleanField(default=False)
+    subject = models.CharField(max_length=255)
+    sender_display = models.CharField(max_length=254)
+    recipients_display = models.TextField(blank=True)
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+
+    class Meta:
+        db_table = 'mail_mailbox_entries'
+        indexes = [
+            models.Index(fields=['owner', 'folder', '-timestamp', '-email'], name='mail_mailbox_listing_idx'),
+            models.Index(fields=['owner', 'folder', 'read'], name='mail_mailbox_unread_idx'),
+        ]
+
+    @classmethod
+    def from_email(cls, email, recipients):
+        return cls(
+            email=email,
+            owner_id=email.user_id,
+            folder=mailbox_folder(email.user_id, email.sender_id, email.archived),
+            timestamp=email.timestamp,
+            read=email.read,
+            archived=email.archived,
+            encrypted=email.encrypted,
+            signed=email.signed,
+            subject=email.subject,
+            sender_display=email.sender.email,
+            recipients_display=','.join(user.email for user in recipients),
+            preview=email.get_preview(),
+        )
+
+    # Same shape as Email.serialize_summary
+    def serialize(self):
+        tz = pytz.timezone('Asia/Bangkok')
+        timestamp_date = self.timestamp.astimezone(tz)
+
+        return {
+            'id': self.pk,
+            'sender': self.sender_display,
+            'recipients': self.recipients_display.split(',') if self.recipients_display else [],
+            'subject': self.subject,
+            'preview': self.preview,
             'timestamp': timestamp_date.strftime('%b %d %Y, %I:%M %p'),
             'read': self.read,
             'archived': self.archived,
@@ -39,10 +237,67 @@ class Email(models.Model):
         }
 
 
+# Per-user, per-folder message counts, maintained incrementally (see mail.utils.counters)
+class MailboxCounter(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mailbox_counters')
+    folder = models.CharField(max_length=16, choices=MailboxEntry.FOLDER_CHOICES)
+    total = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'mail_mailbox_counters'
+        unique_together = ('owner', 'folder')
+
+    def serialize(self):
+        return {
+            'total': self.total,
+            'unread': self.unread,
+        }
+
+
+# Per-user change counters used as ETag / Last-Modified validators (see mail.utils.versions)
+class UserVersion(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='version')
+    mailbox_version = models.BigIntegerField(default=0)
+    mailbox_updated = models.DateTimeField(null=True)
+    keys_version = models.BigIntegerField(default=0)
+    keys_updated = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'mail_user_versions'
+
+
+# Per-user change log of mailbox rows, read by the delta sync API.
+# The auto-increment id is the (monotonic) sync token.
+class MailboxChange(models.Model):
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    KIND_CHOICES = [
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    ]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mailbox_changes')
+    # Not a foreign key: the change log outlives deleted emails
+    email_id = models.BigIntegerField()
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'mail_mailbox_changes'
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='mail_mailbox_changes_idx'),
+        ]
+
+
 class EmailHMAC(models.Model):
     email = models.OneToOneField(Email, on_delete=models.CASCADE, related_name='hmac')
-    hmac = models.TextField(db_index=True)
-    secret_key = models.CharField(max_length=255, db_index=True)
+    # 32-byte HMAC-SHA256 digest
+    digest = models.BinaryField(max_length=32, db_index=True)
+    # Version of the key in the HMAC_KEYS registry (see mail.utils.hmac_auth)
+    key_version = models.PositiveSmallIntegerField(default=1)
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -51,8 +306,8 @@ class EmailHMAC(models.Model):
     def serialize(self):
         return {
             'email': self.email.id,
-            'hmac': self.hmac,
-            'secret_key': self.secret_key,
+            'hmac': bytes(self.digest).hex(),
+            'key_version': self.key_version,
             'created': self.created.strftime('%b %d %Y, %I:%M %p')
         }
 
@@ -111,11 +366,43 @@ class PGPKey(models.Model):
         }
         
         
+# Shared keyring: every public key stored once, keyed by fingerprint, with its metadata
+# parsed once when it is first stored
+class KeyringKey(models.Model):
+    fingerprint = models.CharField(max_length=255, primary_key=True)
+    public_key = models.TextField()
+    key_size = models.IntegerField(default=0)
+    encrypt = models.BooleanField(default=False)
+    sign = models.BooleanField(default=False)
+    expire_date = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'mail_keyring'
+
+    # Keyring entry of a user's key, from the metadata already stored with it
+    @classmethod
+    def from_pgp_key(cls, pgp_key):
+        return cls(
+            fingerprint=pgp_key.key_id,
+            public_key=pgp_key.public_key,
+            key_size=pgp_key.key_size,
+            encrypt=pgp_key.encrypt,
+            sign=pgp_key.sign,
+            expire_date=pgp_key.expire_date,
+        )
+
+    # Inserts the keys that are not in the keyring yet, in one query
+    @classmethod
+    def store(cls, keys):
+        cls.objects.bulk_create(keys, ignore_conflicts=True)
+
+
 class ReceivedPublicKey(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='public_keys')
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='public_keys_received')
     key_id = models.CharField(max_length=255, db_index=True)
-    public_key = models.TextField()
+    keyring = models.ForeignKey(KeyringKey, on_delete=models.PROTECT, related_name='received')
     expire_date = models.DateTimeField(db_index=True)
     
     class Meta:
@@ -127,6 +414,10 @@ class ReceivedPublicKey(models.Model):
     
     def is_expired(self):
         return self.expire_date < timezone.now()
+
+    @property
+    def public_key(self):
+        return self.keyring.public_key
     
     def serialize_detail(self):
         return {
@@ -151,6 +442,8 @@ class ReceivedPublicKey(models.Model):
 class EmailPGPKey(models.Model):
     email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='public_keys')
     recipient_public_key = models.ForeignKey(ReceivedPublicKey, on_delete=models.CASCADE, related_name='emails', null=True)
+    # The exact key the email was encrypted with (the received key may be replaced later)
+    recipient_key = models.ForeignKey(KeyringKey, on_delete=models.PROTECT, related_name='emails', null=True)
     sender_public_key = models.ForeignKey(PGPKey, on_delete=models.CASCADE, related_name='emails', null=True)
     
     class Meta:
@@ -162,6 +455,101 @@ class EmailPGPKey(models.Model):
     def serialize(self):
         return {
             'email': self.email.id,
-            'recipient_public_key': self.recipient_public_key.public_key,
+            'recipient_public_key': self.recipient_key.public_key,
             'sender_public_key': self.sender_public_key.public_key
-        }
\ No newline at end of file
+        }
+
+
+class OutboxJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='outbox_jobs')
+    payload = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'mail_outbox_jobs'
+
+    def serialize(self):
+        tz = pytz.timezone('Asia/Bangkok')
+        created_date = self.created.astimezone(tz)
+        updated_date = self.updated.astimezone(tz)
+
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'attempts': self.attempts,
+            'created': created_date.strftime('%b %d %Y, %I:%M %p'),
+            'updated': updated_date.strftime('%b %d %Y, %I:%M %p'),
+        }
+
+
+# Background PGP key generation (KEYGEN_BACKGROUND mode). The payload holds the
+# request data, including the passphrase until the job is done.
+class KeyGenJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='key_jobs')
+    payload = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    key = models.ForeignKey(PGPKey, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'mail_key_jobs'
+
+    def serialize(self):
+        tz = pytz.timezone('Asia/Bangkok')
+        created_date = self.created.astimezone(tz)
+        updated_date = self.updated.astimezone(tz)
+
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'attempts': self.attempts,
+            'key_id': self.key.key_id if self.key_id else None,
+            'created': created_date.strftime('%b %d %Y, %I:%M %p'),
+            'updated': updated_date.strftime('%b %d %Y, %I:%M %p'),
+        }
+
+
+# Pre-generated key material (a primary key without user id, unprotected), taken
+# by generate_key so the request only binds the uid and protects the key
+class PooledKey(models.Model):
+    key_type = models.CharField(max_length=8)
+    key_size = models.IntegerField()
+    key_data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'mail_key_pool'
+        indexes = [
+            models.Index(fields=['key_type', 'key_size'], name='mail_key_pool_idx'),
+        ]
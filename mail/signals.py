@@ -0,0 +1,37 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from .models import Email, EmailPGPKey, PGPKey, ReceivedPublicKey
+from .utils.key_cache import unlocked_key_cache
+from .utils.search import unindex_emails
+from .utils.versions import bump_keys_version
+
+
+@receiver(post_delete, sender=Email)
+def unindex_deleted_email(sender, instance, **kwargs):
+    unindex_emails([instance.id])
+
+
+# Deleting a key deletes its links to emails, which changes how those emails open
+# (email_etag). The owners of the linked emails are collected before the cascade
+# and their keys version is bumped once the rows are gone.
+@receiver(pre_delete, sender=PGPKey)
+@receiver(pre_delete, sender=ReceivedPublicKey)
+def collect_linked_email_owners(sender, instance, **kwargs):
+    field = 'sender_public_key' if sender is PGPKey else 'recipient_public_key'
+    instance._linked_email_owners = set(
+        EmailPGPKey.objects.filter(**{field: instance}).values_list('email__user_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=PGPKey)
+@receiver(post_delete, sender=ReceivedPublicKey)
+def bump_linked_email_owners(sender, instance, **kwargs):
+    bump_keys_version(getattr(instance, '_linked_email_owners', ()))
+
+
+# Private keys unlocked in the session must not outlive it
+@receiver(user_logged_out)
+def lock_session_keys(sender, request, **kwargs):
+    if request is not None and request.session.session_key is not None:
+        unlocked_key_cache.invalidate_session(request.session.session_key)
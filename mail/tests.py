@@ -1,8 +1,53 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+import pgpy
+from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
-from .models import User, Email
+from .management.commands.mailbox_query_plans import first_page_queryset, query_plan
+from .models import (
+    User, Email, EmailBody, EmailHMAC, KeyringKey, MailboxEntry, MailboxCounter, MailboxChange, PGPKey,
+    ReceivedPublicKey, EmailPGPKey, OutboxJob, KeyGenJob, PooledKey, PREVIEW_LENGTH,
+)
+from .utils.key_cache import PublicKeyCache, UnlockedKeyCache, unlocked_key_cache
+from .utils.outbox import drain_outbox, claim_next_job as claim_outbox_job, process_job as process_outbox_job
+from .utils.counters import mailbox_summary, reconcile_counters
+from .utils.crypto_pool import run_crypto_jobs
+from .utils.events import EventBackend, LocalEventBackend, get_event_backend
+from .utils.hmac_auth import compute_hmac, sign_body, verify_signed_body
+from .utils.jobs import JobLost, finish_job
+from .utils.key_jobs import drain_key_jobs, claim_next_job as claim_key_job, process_job as process_key_job
+from .utils.key_pool import open_key, take_pooled_key
+from .utils.pgp_encryption import encrypt_message, sign_message, verify_message
+from .views.bulk import StaleBatch, apply_action, group_by_state
+from .views.compose import outbox_payload
+from .views.email import signature_cache_key
+from .views.index import email_state
+from .views.events import async_stream
+
+
+# Creates an email row the way compose does, with its recipients and listing row
+def create_email(user, sender, recipients, **fields):
+    email = Email.objects.create(user=user, sender=sender, **fields)
+    email.recipients.add(*recipients)
+    MailboxEntry.from_email(email, recipients).save(force_insert=True)
+    return email
 
 
 class UserModelUnitTestCase(TestCase):
@@ -50,3 +95,1437 @@ class IndexRequestTestCase(TestCase):
                              status_code=302,
                              target_status_code=200,
                              fetch_redirect_response=True)
+
+
+class MailboxPaginationTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(email='bob@test.com', username='bob@test.com', password='pass123')
+        self.user = User.objects.create_user(email='john@test.com', username='john@test.com', password='pass123')
+        for i in range(7):
+            create_email(self.user, self.sender, [self.user], subject=f'Email {i}', body='Hello')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_pages_follow_cursor(self):
+        response = self.client.get('/emails/inbox?limit=3')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([e['subject'] for e in data['emails']], ['Email 6', 'Email 5', 'Email 4'])
+        self.assertIsNone(data['prev'])
+
+        seen = [e['id'] for e in data['emails']]
+        while data['next']:
+            data = self.client.get(f'/emails/inbox?limit=3&before={data["next"]}').json()
+            seen += [e['id'] for e in data['emails']]
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_after_cursor_returns_newer_emails(self):
+        data = self.client.get('/emails/inbox?limit=3').json()
+        last = self.client.get(f'/emails/inbox?limit=3&before={data["next"]}').json()
+        newer = self.client.get(f'/emails/inbox?limit=2&after={last["prev"]}').json()
+        self.assertEqual([e['subject'] for e in newer['emails']], ['Email 5', 'Email 4'])
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        # session, user, version, mailbox entries
+        with self.assertNumQueries(4):
+            self.client.get('/emails/inbox?limit=2')
+        with self.assertNumQueries(4):
+            self.client.get('/emails/inbox?limit=7')
+        # session, user, version, emails, recipients
+        with self.assertNumQueries(5):
+            self.client.get('/emails/inbox?limit=2&view=full')
+        with self.assertNumQueries(5):
+            self.client.get('/emails/inbox?limit=7&view=full')
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/emails/inbox?before=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+
+class MailboxSummaryTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(email='bob@test.com', username='bob@test.com', password='pass123')
+        self.user = User.objects.create_user(email='john@test.com', username='john@test.com', password='pass123')
+        self.plain = create_email(self.user, self.sender, [self.user], subject='Plain', body='x' * 5000)
+        self.armored = create_email(
+            self.user, self.sender, [self.user], subject='Secret', encrypted=True,
+            body='-----BEGIN PGP MESSAGE-----\n\nwcBMA...\n-----END PGP MESSAGE-----'
+        )
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_list_returns_preview_without_body(self):
+        emails = self.client.get('/emails/inbox').json()['emails']
+        by_subject = {e['subject']: e for e in emails}
+        self.assertNotIn('body', by_subject['Plain'])
+        self.assertEqual(by_subject['Plain']['preview'], 'x' * PREVIEW_LENGTH)
+        self.assertEqual(by_subject['Secret']['preview'], '')
+
+    def test_full_view_returns_body(self):
+        emails = self.client.get('/emails/inbox?view=full').json()['emails']
+        self.assertIn('x' * 5000, [e['body'] for e in emails])
+
+
+def make_pgp_key(name='Bob', email='bob@test.com', passphrase='secret'):
+    key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 1024)
+    uid = pgpy.PGPUID.new(name, email=email)
+    key.add_uid(
+        uid,
+        usage={KeyFlags.Sign, KeyFlags.EncryptCommunications},
+        hashes=[HashAlgorithm.SHA256],
+        ciphers=[SymmetricKeyAlgorithm.AES256],
+        compression=[CompressionAlgorithm.ZLIB],
+    )
+    key.protect(passphrase, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+    return key
+
+
+class PublicKeyCacheTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key = make_pgp_key()
+
+    def test_lru_hits_misses_and_eviction(self):
+        cache = PublicKeyCache(max_size=2)
+        armored = str(self.key.pubkey)
+        first = cache.get('a', armored)
+        self.assertIs(cache.get('a', armored), first)
+        cache.get('b', armored)
+        cache.get('c', armored)
+        self.assertEqual(cache.stats(), {'size': 2, 'max_size': 2, 'hits': 1, 'misses': 3})
+
+        # 'a' was least recently used and has been evicted
+        self.assertIsNot(cache.get('a', armored), first)
+
+    def test_invalidate(self):
+        cache = PublicKeyCache(max_size=2)
+        armored = str(self.key.pubkey)
+        first = cache.get('a', armored)
+        cache.invalidate('a')
+        self.assertIsNot(cache.get('a', armored), first)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class UnlockedKeyCacheTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.armored = str(make_pgp_key())
+
+    def get(self, cache, session_key, key_id):
+        with cache.use(session_key, key_id, self.armored, 'secret') as key:
+            self.assertTrue(key.is_unlocked)
+        return key
+
+    def test_hit_until_ttl(self):
+        cache = UnlockedKeyCache(max_size=2, ttl=60)
+        key = self.get(cache, 'session', 'key')
+        self.assertTrue(key.is_unlocked)
+        self.assertIs(self.get(cache, 'session', 'key'), key)
+
+        with patch('mail.utils.key_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNot(self.get(cache, 'session', 'key'), key)
+        # The expired key has been locked again
+        self.assertFalse(key.is_unlocked)
+        self.assertEqual(
+            {name: cache.stats()[name] for name in ('hits', 'misses', 'expired', 'evictions')},
+            {'hits': 1, 'misses': 2, 'expired': 1, 'evictions': 0},
+        )
+
+    def test_eviction_and_invalidation(self):
+        cache = UnlockedKeyCache(max_size=2, ttl=60)
+        first = self.get(cache, 'a', 'key')
+        second = self.get(cache, 'b', 'key')
+        other = self.get(cache, 'b', 'other')
+        self.assertFalse(first.is_unlocked)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache.invalidate_key('key')
+        self.assertFalse(second.is_unlocked)
+        self.assertTrue(other.is_unlocked)
+        cache.invalidate_session('b')
+        self.assertFalse(other.is_unlocked)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_key_in_use_is_locked_after_release(self):
+        cache = UnlockedKeyCache(max_size=1, ttl=60)
+        with cache.use('a', 'key', self.armored, 'secret') as key:
+            with cache.use('a', 'key', self.armored, 'secret') as same:
+                self.assertIs(same, key)
+                # Logout, eviction and deletion while two requests use the key
+                cache.invalidate_session('a')
+                self.get(cache, 'b', 'key')
+                cache.invalidate_key('key')
+                self.assertTrue(key.is_unlocked)
+            self.assertTrue(key.is_unlocked)
+        self.assertFalse(key.is_unlocked)
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class SignatureCacheTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key = make_pgp_key()
+        cls.recipient_key = make_pgp_key(name='John', email='john@test.com')
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user(email='bob@test.com', username='bob@test.com', password='pass123')
+        self.user = User.objects.create_user(email='john@test.com', username='john@test.com', password='pass123')
+        self.sender_key = PGPKey.objects.create(
+            user=self.sender, key_id=str(self.key.fingerprint), public_key=str(self.key.pubkey),
+            private_key=str(self.key), passphrase='secret', expire_date=timezone.now() + timedelta(days=1),
+            default_key=True,
+        )
+        PGPKey.objects.create(
+            user=self.user, key_id=str(self.recipient_key.fingerprint), public_key=str(self.recipient_key.pubkey),
+            private_key=str(self.recipient_key), passphrase='secret', expire_date=timezone.now() + timedelta(days=1),
+            default_key=True,
+        )
+        self.client = Client()
+        self.client.force_login(self.sender)
+        payload = {
+            'recipients': 'john@test.com', 'subject': 'Signed', 'body': 'Signed hello',
+            'sign': True, 'passphrase': 'secret',
+        }
+        response = self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.email = Email.objects.get(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_sign_only_email_is_verified(self):
+        self.assertTrue(self.email.get_body().startswith('-----BEGIN PGP MESSAGE-----'))
+        self.assertEqual(self.client.get('/emails/inbox').json()['emails'][0]['preview'], 'Signed hello')
+        self.client.force_login(self.sender)
+        sent = Email.objects.get(user=self.sender)
+        self.assertEqual(self.client.get(f'/emails/{sent.id}').json()['body'], 'Signed hello')
+
+    def test_sign_only_body_is_searchable(self):
+        def search():
+            return [e['subject'] for e in self.client.get('/emails/search', {'q': 'hello'}).json()['emails']]
+
+        self.assertEqual(search(), ['Signed'])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(search(), ['Signed'])
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'john.mbox')
+        call_command('export_mailbox', 'john@test.com', path, stdout=StringIO())
+        Email.objects.filter(user=self.user).delete()
+        call_command('import_mailbox', 'john@test.com', path, stdout=StringIO())
+        self.assertEqual(search(), ['Signed'])
+        self.assertEqual(self.client.get('/emails/inbox').json()['emails'][0]['preview'], 'Signed hello')
+
+    def test_verification_result_is_cached(self):
+        with patch('mail.views.email.verify_message', wraps=verify_message) as verify:
+            first = self.client.get(f'/emails/{self.email.id}').json()
+            second = self.client.get(f'/emails/{self.email.id}').json()
+        self.assertEqual(first['body'], 'Signed hello')
+        self.assertEqual(second['body'], 'Signed hello')
+        self.assertEqual(verify.call_count, 1)
+
+    def test_cache_key_depends_on_sender_key(self):
+        other_key = PGPKey(key_id='OTHER')
+        self.assertNotEqual(
+            signature_cache_key(self.email, self.sender_key),
+            signature_cache_key(self.email, other_key),
+        )
+
+
+class ComposeEncryptionTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.keys = [make_pgp_key(email=f'user{i}@test.com') for i in range(3)]
+
+    def setUp(self):
+        self.users = []
+        for i, key in enumerate(self.keys):
+            user = User.objects.create_user(
+                email=f'user{i}@test.com', username=f'user{i}@test.com', password='pass123'
+            )
+            PGPKey.objects.create(
+                user=user, key_id=str(key.fingerprint), public_key=str(key.pubkey), private_key=str(key),
+                passphrase='secret', expire_date=timezone.now() + timedelta(days=1), default_key=True,
+            )
+            self.users.append(user)
+        self.client = Client()
+        self.client.force_login(self.users[0])
+
+    def send(self, **data):
+        payload = {'recipients': 'user1@test.com, user2@test.com', 'subject': 'Hi', 'body': 'Hello'}
+        payload.update(data)
+        return self.client.post('/emails', json.dumps(payload), content_type='application/json')
+
+    def assert_recipients_can_decrypt(self):
+        for user, key in zip(self.users[1:], self.keys[1:]):
+            email = Email.objects.get(user=user)
+            with key.unlock('secret'):
+                message = key.decrypt(pgpy.PGPMessage.from_blob(email.body)).message
+            self.assertTrue(message.startswith('Hello::'))
+
+    def test_encrypt_for_each_recipient(self):
+        response = self.send(encrypt=True)
+        self.assertEqual(response.status_code, 201)
+        self.assert_recipients_can_decrypt()
+
+    @override_settings(PGP_WORKER_PROCESSES=2)
+    def test_encrypt_in_process_pool(self):
+        response = self.send(encrypt=True, sign=True, passphrase='secret')
+        self.assertEqual(response.status_code, 201)
+        self.assert_recipients_can_decrypt()
+
+    def test_sign_once_for_all_recipients(self):
+        with patch('mail.views.compose.sign_message', wraps=sign_message) as sign:
+            response = self.send(encrypt=True, sign=True, passphrase='secret')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sign.call_count, 1)
+
+        for user, key in zip(self.users[1:], self.keys[1:]):
+            email = Email.objects.get(user=user)
+            with key.unlock('secret'):
+                message = key.decrypt(pgpy.PGPMessage.from_blob(email.body))
+            self.assertTrue(self.keys[0].pubkey.verify(message))
+
+    @override_settings(COMPOSE_SHARED_SESSION_KEY=True)
+    def test_shared_session_key(self):
+        response = self.send(encrypt=True, sign=True, passphrase='secret')
+        self.assertEqual(response.status_code, 201)
+        bodies = {Email.objects.get(user=user).body for user in self.users[1:]}
+        self.assertEqual(len(bodies), 1)
+        self.assert_recipients_can_decrypt()
+
+    @override_settings(EMAIL_BODY_STORAGE='compact')
+    def test_compact_body_storage(self):
+        response = self.send(encrypt=True, sign=True, passphrase='secret')
+        self.assertEqual(response.status_code, 201)
+        email = Email.objects.get(user=self.users[1])
+        self.assertEqual((email.body, email.body_encoding), ('', 'pgp'))
+        armored = email.get_body()
+        self.assertTrue(armored.startswith('-----BEGIN PGP MESSAGE-----'))
+        self.assertLess(len(email.body_data), len(armored) * 0.8)
+
+        self.client.force_login(self.users[1])
+        self.assertEqual(self.client.get(f'/emails/{email.id}').json()['body'], armored)
+        response = self.client.post(
+            f'/emails/decrypt/{email.id}', json.dumps({'passphrase': 'secret'}), content_type='application/json'
+        )
+        self.assertEqual(response.json()['data']['body'], 'Hello')
+
+    @override_settings(UNLOCKED_KEY_CACHE=True)
+    def test_decrypt_with_unlocked_key_cache(self):
+        unlocked_key_cache.clear()
+        self.send(encrypt=True, sign=True, passphrase='secret')
+        self.send(encrypt=True, sign=True, passphrase='secret', subject='Again')
+        self.client.force_login(self.users[1])
+
+        with patch('pgpy.PGPKey.unlock', autospec=True, side_effect=pgpy.PGPKey.unlock) as unlock:
+            for email in Email.objects.filter(user=self.users[1]):
+                response = self.client.post(
+                    f'/emails/decrypt/{email.id}', json.dumps({'passphrase': 'secret'}),
+                    content_type='application/json',
+                )
+                self.assertEqual(response.json()['data']['body'], 'Hello')
+            response = self.client.post(
+                f'/emails/decrypt/{email.id}', json.dumps({'passphrase': 'wrong'}), content_type='application/json'
+            )
+            self.assertEqual(response.json()['error'], 'Passphrase does not match.')
+        self.assertEqual(unlock.call_count, 1)
+        self.assertEqual(unlocked_key_cache.stats()['size'], 1)
+
+        self.client.logout()
+        self.assertEqual(unlocked_key_cache.stats()['size'], 0)
+
+    @override_settings(EMAIL_BODY_STORAGE='compact', EMAIL_COMPRESS_BODIES=True)
+    def test_compressed_plain_body(self):
+        body = 'Hello world. ' * 100
+        self.send(body=body)
+        email = Email.objects.get(user=self.users[1])
+        self.assertEqual(email.body_encoding, 'zlib')
+        self.assertLess(len(email.body_data), len(body))
+        self.assertEqual(email.get_body(), body)
+        self.assertEqual(MailboxEntry.objects.get(pk=email.pk).preview, body[:PREVIEW_LENGTH])
+        self.assertEqual(self.send(body='Short').status_code, 201)
+        self.assertEqual(Email.objects.filter(body='Short').count(), 3)
+
+    def test_compact_existing_bodies(self):
+        self.send(encrypt=True)
+        out = StringIO()
+        with override_settings(EMAIL_BODY_STORAGE='compact'):
+            call_command('compact_email_bodies', stdout=out)
+        self.assertIn('Compacted 2 email(s).', out.getvalue())
+        for user, key in zip(self.users[1:], self.keys[1:]):
+            email = Email.objects.get(user=user)
+            with key.unlock('secret'):
+                message = key.decrypt(pgpy.PGPMessage.from_blob(email.get_pgp_body())).message
+            self.assertTrue(message.startswith('Hello::'))
+
+    @override_settings(EMAIL_SHARED_BODIES=True)
+    def test_shared_bodies(self):
+        self.send()
+        self.assertEqual(EmailBody.objects.count(), 1)
+        self.assertEqual(Email.objects.filter(content__isnull=False, body='').count(), 3)
+
+        self.send(encrypt=True)
+        # The sender's plain copy reuses the body above, each recipient has its own ciphertext
+        self.assertEqual(EmailBody.objects.count(), 3)
+
+        self.client.force_login(self.users[1])
+        email = Email.objects.filter(user=self.users[1]).latest('id')
+        body = self.client.get(f'/emails/{email.id}').json()['body']
+        self.assertTrue(body.startswith('-----BEGIN PGP MESSAGE-----'))
+        response = self.client.post(
+            f'/emails/decrypt/{email.id}', json.dumps({'passphrase': 'secret'}), content_type='application/json'
+        )
+        self.assertEqual(response.json()['data']['body'], 'Hello')
+        self.assertTrue(self.client.get('/emails/inbox?view=full').json()['emails'])
+
+        out = StringIO()
+        Email.objects.filter(encrypted=True).delete()
+        call_command('prune_email_bodies', stdout=out)
+        self.assertIn('Deleted 2 EmailBody row(s).', out.getvalue())
+
+    def test_move_existing_bodies_to_shared_table(self):
+        self.send()
+        out = StringIO()
+        with override_settings(EMAIL_SHARED_BODIES=True):
+            call_command('compact_email_bodies', stdout=out)
+            self.assertIn('Compacted 3 email(s).', out.getvalue())
+        self.assertEqual(EmailBody.objects.count(), 1)
+        self.assertEqual({email.get_body() for email in Email.objects.all()}, {'Hello'})
+
+    def test_hmac_stored_as_binary_digest(self):
+        self.send(encrypt=True)
+        digests = {(bytes(row.digest), row.key_version) for row in EmailHMAC.objects.all()}
+        self.assertEqual(digests, {(compute_hmac('Hello', 1), 1)})
+
+        self.client.force_login(self.users[1])
+        email = Email.objects.get(user=self.users[1])
+        response = self.client.post(
+            f'/emails/decrypt/{email.id}', json.dumps({'passphrase': 'secret'}), content_type='application/json'
+        )
+        self.assertEqual(response.json()['data']['body'], 'Hello')
+
+    def test_crypto_errors_are_reported_per_job(self):
+        results = run_crypto_jobs(encrypt_message, [('Hello', str(self.keys[0].pubkey)), ('Hello', 'not a key')])
+        self.assertIsInstance(results[0], str)
+        self.assertIn('error', results[1])
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(email='bob@test.com', username='bob@test.com', password='pass123')
+        self.user = User.objects.create_user(email='john@test.com', username='john@test.com', password='pass123')
+        self.client = Client()
+        self.client.force_login(self.sender)
+
+    def send(self, recipients):
+        payload = {'recipients': recipients, 'subject': 'Hi', 'body': 'Hello'}
+        return self.client.post('/emails', json.dumps(payload), content_type='application/json')
+
+    @override_settings(COMPOSE_OUTBOX=True)
+    def test_queued_email_is_sent_by_worker(self):
+        response = self.send('john@test.com')
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+        self.assertFalse(Email.objects.filter(user=self.user).exists())
+        self.assertEqual(self.client.get(f'/emails/outbox/{job_id}').json()['status'], OutboxJob.PENDING)
+
+        call_command('process_outbox', once=True, stdout=StringIO())
+
+        self.assertEqual(self.client.get(f'/emails/outbox/{job_id}').json()['status'], OutboxJob.SENT)
+        self.assertTrue(Email.objects.filter(user=self.user, subject='Hi').exists())
+
+    @override_settings(COMPOSE_OUTBOX=True)
+    def test_invalid_email_is_not_queued(self):
+        response = self.send('nobody@test.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OutboxJob.objects.exists())
+
+    def test_failed_job_records_error(self):
+        payload = {'recipients': 'nobody@test.com', 'sign': True, 'passphrase': 'secret'}
+        job = OutboxJob.objects.create(user=self.sender, payload=json.dumps(payload))
+        self.assertEqual(drain_outbox(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxJob.FAILED)
+        self.assertIn('does not exist', job.error)
+        self.assertNotIn('passphrase', json.loads(job.payload))
+
+    def test_payload_keeps_only_delivery_fields(self):
+        data = {'recipients': 'john@test.com', 'body': 'Hello', 'passphrase': 'secret', 'extra': 1}
+        self.assertEqual(outbox_payload(data), {'recipients': 'john@test.com', 'body': 'Hello'})
+        self.assertEqual(outbox_payload(dict(data, sign=True))['passphrase'], 'secret')
+
+    def test_stale_running_job_is_reclaimed(self):
+        payload = json.dumps({'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'})
+        job = OutboxJob.objects.create(user=self.sender, payload=payload, status=OutboxJob.RUNNING, attempts=1)
+        OutboxJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timedelta(hours=1))
+        self.assertEqual(drain_outbox(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (OutboxJob.SENT, 2))
+
+    def test_gives_up_after_max_attempts(self):
+        payload = json.dumps({'recipients': 'john@test.com', 'sign': True, 'passphrase': 'secret'})
+        job = OutboxJob.objects.create(user=self.sender, payload=payload, status=OutboxJob.RUNNING, attempts=3)
+        OutboxJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timedelta(hours=1))
+        self.assertEqual(drain_outbox(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxJob.FAILED)
+        self.assertIn('Gave up', job.error)
+        self.assertNotIn('passphrase', json.loads(job.payload))
+
+    def test_unexpected_error_is_retried(self):
+        payload = json.dumps({'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'})
+        job = OutboxJob.objects.create(user=self.sender, payload=payload)
+        with patch('mail.utils.outbox.deliver_email', side_effect=RuntimeError('boom')), self.assertLogs('app_api'):
+            self.assertEqual(drain_outbox(), 3)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error), (OutboxJob.FAILED, 3, 'boom'))
+
+    @override_settings(OUTBOX_JOB_TIMEOUT=60)
+    def test_reclaimed_job_is_delivered_once(self):
+        payload = json.dumps({'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'})
+        OutboxJob.objects.create(user=self.sender, payload=payload)
+        slow = claim_outbox_job()
+        OutboxJob.objects.filter(pk=slow.pk).update(updated=timezone.now() - timedelta(seconds=120))
+        second = claim_outbox_job()
+        self.assertEqual((second.pk, second.attempts), (slow.pk, 2))
+
+        # The slow worker finishes after its job was reclaimed: its delivery is rolled back
+        with self.assertRaises(JobLost):
+            process_outbox_job(slow)
+        self.assertFalse(Email.objects.filter(user=self.user).exists())
+        process_outbox_job(second)
+        self.assertEqual(OutboxJob.objects.get(pk=slow.pk).status, OutboxJob.SENT)
+        self.assertEqual(Email.objects.filter(user=self.user, subject='Hi').count(), 1)
+
+    def test_sent_state_commits_with_delivery(self):
+        payload = json.dumps({'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'})
+        job = OutboxJob.objects.create(user=self.sender, payload=payload)
+        calls = []
+
+        # The worker dies while marking the job sent: the delivery is rolled back with it
+        def finish_once(job, status, *args, **kwargs):
+            calls.append(status)
+            if calls == [OutboxJob.SENT]:
+                raise RuntimeError('worker died')
+            return finish_job(job, status, *args, **kwargs)
+
+        with patch('mail.utils.outbox.finish_job', side_effect=finish_once), self.assertLogs('app_api'):
+            self.assertEqual(drain_outbox(), 2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxJob.SENT)
+        self.assertEqual(Email.objects.filter(user=self.user, subject='Hi').count(), 1)
+
+
+class ComposeQueryCountTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key = make_pgp_key()
+
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.users = [User.objects.create(email=f'user{i}@test.com', username=f'user{i}@test.com') for i in range(6)]
+        for i, user in enumerate([self.sender] + self.users):
+            PGPKey.objects.create(
+                user=user, key_id=f'{self.key.fingerprint}-{i}', public_key=str(self.key.pubkey),
+                private_key=str(self.key), passphrase='secret', expire_date=timezone.now() + timedelta(days=1),
+                default_key=True,
+            )
+        self.client = Client()
+        self.client.force_login(self.sender)
+
+    def count_queries(self, count, **data):
+        recipients = ', '.join(user.email for user in self.users[:count])
+        payload = {'recipients': recipients, 'subject': 'Hi', 'body': 'Hello'}
+        payload.update(data)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return len(queries)
+
+    def test_plain_send_query_count_is_constant(self):
+        self.assertEqual(self.count_queries(1), self.count_queries(6))
+
+    def test_signed_send_query_count_is_constant(self):
+        self.assertEqual(
+            self.count_queries(1, sign=True, passphrase='secret'),
+            self.count_queries(6, sign=True, passphrase='secret'),
+        )
+        # Sending again updates the received keys instead of failing on (user, owner)
+        self.assertEqual(ReceivedPublicKey.objects.filter(user=self.sender).count(), 6)
+
+    def test_encrypted_send_query_count_is_constant(self):
+        self.assertEqual(self.count_queries(1, encrypt=True), self.count_queries(6, encrypt=True))
+
+    def test_encrypted_send_links_only_recipient_keys(self):
+        # Keys received by other users must not be linked to this email
+        ReceivedPublicKey.objects.create(
+            user=self.users[5], owner=self.users[4], key_id='X',
+            keyring=KeyringKey.objects.create(fingerprint='X', public_key='X'), expire_date=timezone.now()
+        )
+        self.count_queries(3, encrypt=True)
+        for user in self.users[:3]:
+            email = Email.objects.get(user=user)
+            self.assertEqual(
+                list(email.public_keys.values_list('recipient_public_key__owner', flat=True)), [user.id]
+            )
+        sender_copy = Email.objects.get(user=self.sender)
+        self.assertEqual(sender_copy.public_keys.count(), 3)
+
+    def test_received_keys_share_the_keyring(self):
+        self.count_queries(3, encrypt=True)
+        self.client.force_login(self.users[4])
+        self.count_queries(3, encrypt=True)
+        # Two senders received the same three keys, each stored once
+        self.assertEqual(ReceivedPublicKey.objects.count(), 6)
+        self.assertEqual(KeyringKey.objects.count(), 3)
+        received = ReceivedPublicKey.objects.filter(user=self.users[4]).first()
+        self.assertEqual(received.public_key, PGPKey.objects.get(key_id=received.key_id).public_key)
+        for link in EmailPGPKey.objects.filter(email__user=self.users[0]):
+            self.assertEqual(link.recipient_key_id, PGPKey.objects.get(user=self.users[0]).key_id)
+
+    def test_prune_email_pgp_keys(self):
+        self.count_queries(2, encrypt=True)
+        email = Email.objects.get(user=self.users[0])
+        stray_key = ReceivedPublicKey.objects.create(
+            user=self.users[5], owner=self.users[4], key_id='X',
+            keyring=KeyringKey.objects.create(fingerprint='X', public_key='X'), expire_date=timezone.now()
+        )
+        own_key = email.public_keys.get().recipient_public_key
+        EmailPGPKey.objects.create(email=email, recipient_public_key=stray_key)
+        EmailPGPKey.objects.create(email=email, recipient_public_key=own_key)
+
+        call_command('prune_email_pgp_keys', stdout=StringIO())
+
+        self.assertEqual(list(email.public_keys.values_list('recipient_public_key', flat=True)), [own_key.id])
+        self.assertEqual(EmailPGPKey.objects.count(), 4)
+
+    def test_prune_sender_copy_links_to_non_recipients(self):
+        self.count_queries(3, encrypt=True)
+        self.count_queries(1, encrypt=True)
+        sent = Email.objects.filter(user=self.sender).latest('id')
+        other_key = ReceivedPublicKey.objects.get(user=self.sender, owner=self.users[2])
+        EmailPGPKey.objects.create(email=sent, recipient_public_key=other_key)
+
+        out = StringIO()
+        call_command('prune_email_pgp_keys', stdout=out)
+
+        self.assertIn('Deleted 1 EmailPGPKey row(s).', out.getvalue())
+        self.assertEqual(
+            list(sent.public_keys.values_list('recipient_public_key__owner', flat=True)), [self.users[0].id]
+        )
+
+    def test_unknown_recipient(self):
+        payload = {'recipients': 'user0@test.com, nobody@test.com', 'subject': 'Hi', 'body': 'Hello'}
+        response = self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'User with email nobody@test.com does not exist.')
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.other = User.objects.create(email='alice@test.com', username='alice@test.com')
+        self.client = Client()
+        self.client.force_login(self.sender)
+        self.send('john@test.com', 'Quarterly report', 'Numbers attached')
+        self.send('john@test.com, alice@test.com', 'Lunch', 'About the quarterly report numbers')
+        self.client.force_login(self.user)
+
+    def send(self, recipients, subject, body):
+        payload = {'recipients': recipients, 'subject': subject, 'body': body}
+        response = self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def search(self, query, **params):
+        return self.client.get('/emails/search', {'q': query, **params}).json()
+
+    def test_subject_match_ranks_first(self):
+        results = self.search('quarterly report')['emails']
+        self.assertEqual([e['subject'] for e in results], ['Quarterly report', 'Lunch'])
+
+    def test_search_sender_recipients_and_prefix(self):
+        self.assertEqual(len(self.search('bob@test.com')['emails']), 2)
+        self.assertEqual([e['subject'] for e in self.search('alice')['emails']], ['Lunch'])
+        self.assertEqual([e['subject'] for e in self.search('quart')['emails']], ['Quarterly report', 'Lunch'])
+
+    def test_only_own_emails(self):
+        self.client.force_login(self.other)
+        self.assertEqual([e['subject'] for e in self.search('numbers')['emails']], ['Lunch'])
+
+    def test_owner_token_is_not_searchable(self):
+        self.assertEqual(self.search(f'u{self.user.id}')['emails'], [])
+
+    def test_pagination(self):
+        first = self.search('numbers', limit=1)
+        self.assertEqual(len(first['emails']), 1)
+        second = self.search('numbers', limit=1, offset=first['next'])
+        self.assertEqual(len(second['emails']), 1)
+        self.assertIsNone(second['next'])
+
+    def test_deleted_email_is_unindexed(self):
+        Email.objects.filter(user=self.user, subject='Lunch').delete()
+        self.assertEqual([e['subject'] for e in self.search('numbers')['emails']], ['Quarterly report'])
+
+    @override_settings(EMAIL_BODY_STORAGE='compact', EMAIL_COMPRESS_BODIES=True)
+    def test_preview_of_compressed_body(self):
+        self.client.force_login(self.sender)
+        body = 'Budget figures for the next quarter. ' * 20
+        self.send('john@test.com', 'Budget', body)
+        self.client.force_login(self.user)
+        self.assertEqual(Email.objects.get(user=self.user, subject='Budget').body_encoding, 'zlib')
+        self.assertEqual(self.search('budget')['emails'][0]['preview'], body[:PREVIEW_LENGTH])
+
+    def test_encrypted_body_is_not_indexed(self):
+        Email.objects.filter(subject='Lunch').update(encrypted=True)
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual([e['subject'] for e in self.search('about')['emails']], [])
+        self.assertEqual([e['subject'] for e in self.search('lunch')['emails']], ['Lunch'])
+
+
+class MailboxIndexTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+
+    def test_mailbox_queries_use_composite_indexes(self):
+        plans = {
+            mailbox: ' '.join(query_plan(first_page_queryset(self.user, mailbox, 50)))
+            for mailbox in ['inbox', 'sent', 'archive']
+        }
+        self.assertIn('mail_email_user_arch_ts_idx', plans['inbox'])
+        self.assertIn('mail_email_user_arch_ts_idx', plans['archive'])
+        self.assertIn('mail_email_user_sender_ts_idx', plans['sent'])
+        for plan in plans.values():
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_seeded_plans_leave_no_rows(self):
+        out = StringIO()
+        call_command('mailbox_query_plans', seed=30, limit=5, repeat=1, stdout=out)
+        self.assertIn('Generated 30 emails.', out.getvalue())
+        self.assertIn('inbox (entries)', out.getvalue())
+        self.assertEqual(list(User.objects.values_list('email', flat=True)), ['john@test.com'])
+        self.assertFalse(Email.objects.exists())
+        self.assertFalse(MailboxEntry.objects.exists())
+
+
+class MailboxEntryTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.client = Client()
+        self.client.force_login(self.sender)
+        payload = {'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello there'}
+        self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.client.force_login(self.user)
+
+    def test_compose_creates_entries(self):
+        sent = MailboxEntry.objects.get(owner=self.sender)
+        received = MailboxEntry.objects.get(owner=self.user)
+        self.assertEqual((sent.folder, sent.read), (MailboxEntry.SENT, True))
+        self.assertEqual((received.folder, received.read), (MailboxEntry.INBOX, False))
+        self.assertEqual(received.recipients_display, 'john@test.com')
+        self.assertEqual(received.preview, 'Hello there')
+
+    def test_update_moves_entry(self):
+        email = Email.objects.get(user=self.user)
+        data = json.dumps({'read': True, 'archived': True})
+        self.client.put(f'/emails/{email.id}', data, content_type='application/json')
+        self.assertEqual(self.client.get('/emails/inbox').json()['emails'], [])
+        archived = self.client.get('/emails/archive').json()['emails']
+        self.assertEqual([(e['id'], e['read']) for e in archived], [(email.id, True)])
+
+    def test_request_key_creates_entry(self):
+        payload = {'recipient': 'bob@test.com', 'flag': 'pgp_404'}
+        self.client.post('/api/security/request-key', json.dumps(payload), content_type='application/json')
+        emails = self.client.get('/emails/sent').json()['emails']
+        self.assertEqual(emails, [])
+        self.client.force_login(self.sender)
+        inbox = self.client.get('/emails/inbox').json()['emails']
+        self.assertEqual([e['subject'] for e in inbox], ['Request for PGP Public Key'])
+
+
+class MailboxCounterTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.client = Client()
+        self.client.force_login(self.sender)
+        for subject in ['One', 'Two']:
+            payload = {'recipients': 'john@test.com', 'subject': subject, 'body': 'Hello'}
+            self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.client.force_login(self.user)
+
+    def summary(self):
+        # session, user, version, counters
+        with self.assertNumQueries(4):
+            return self.client.get('/emails/summary').json()
+
+    def update(self, subject, **data):
+        email = Email.objects.get(user=self.user, subject=subject)
+        self.client.put(f'/emails/{email.id}', json.dumps(data), content_type='application/json')
+
+    def test_compose_counts(self):
+        self.assertEqual(self.summary()['inbox'], {'total': 2, 'unread': 2})
+        self.client.force_login(self.sender)
+        self.assertEqual(self.summary()['sent'], {'total': 2, 'unread': 0})
+
+    def test_read_and_archive_update_counts(self):
+        self.update('One', read=True)
+        self.update('One', read=True)
+        self.update('Two', archived=True)
+        summary = self.summary()
+        self.assertEqual(summary['inbox'], {'total': 1, 'unread': 0})
+        self.assertEqual(summary['archive'], {'total': 1, 'unread': 1})
+
+    def test_failed_delivery_writes_nothing(self):
+        self.client.force_login(self.sender)
+        payload = {'recipients': 'john@test.com', 'subject': 'Three', 'body': 'Hello'}
+        with patch('mail.views.compose.index_emails', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertFalse(Email.objects.filter(subject='Three').exists())
+        self.assertEqual(MailboxEntry.objects.filter(owner=self.user).count(), 2)
+        self.client.force_login(self.user)
+        self.assertEqual(self.summary()['inbox'], {'total': 2, 'unread': 2})
+
+    def test_put_without_csrf_token(self):
+        email = Email.objects.get(user=self.user, subject='One')
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = client.put(f'/emails/{email.id}', json.dumps({'read': True}), content_type='application/json')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.summary()['inbox'], {'total': 2, 'unread': 1})
+
+    def test_concurrent_mark_read_counts_once(self):
+        email = Email.objects.get(user=self.user, subject='One')
+        calls = []
+
+        # Another request marks the email read between this request's read and its write
+        def stale_state(email_id):
+            calls.append(email_id)
+            if len(calls) == 1:
+                self.update('One', read=True)
+                return (False, False)
+            return email_state(email_id)
+
+        with patch('mail.views.index.email_state', side_effect=stale_state):
+            self.update('One', read=True)
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(Email.objects.get(pk=email.pk).read)
+        self.assertEqual(self.summary()['inbox'], {'total': 2, 'unread': 1})
+
+    def test_request_key_counts(self):
+        payload = {'recipient': 'bob@test.com', 'flag': 'pgp_404'}
+        self.client.post('/api/security/request-key', json.dumps(payload), content_type='application/json')
+        self.client.force_login(self.sender)
+        self.assertEqual(self.summary()['inbox'], {'total': 1, 'unread': 1})
+
+    def test_reconcile(self):
+        MailboxCounter.objects.filter(owner=self.user).update(total=42, unread=7)
+        call_command('reconcile_mailbox_counters', email=['john@test.com'], stdout=StringIO())
+        self.assertEqual(self.summary()['inbox'], {'total': 2, 'unread': 2})
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.client = Client()
+        self.client.force_login(self.sender)
+        payload = {'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'}
+        self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.client.force_login(self.user)
+        self.email = Email.objects.get(user=self.user)
+
+    def revalidate(self, url):
+        etag = self.client.get(url)['ETag']
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_mailbox_returns_304(self):
+        response = self.client.get('/emails/inbox')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        # session, user, version
+        with self.assertNumQueries(3):
+            response = self.client.get('/emails/inbox', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.revalidate(f'/emails/{self.email.id}').status_code, 304)
+
+    def test_changes_invalidate_etag(self):
+        etag = self.client.get('/emails/inbox')['ETag']
+        self.client.put(f'/emails/{self.email.id}', json.dumps({'read': True}), content_type='application/json')
+        self.assertEqual(self.client.get('/emails/inbox', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_depends_on_page(self):
+        etag = self.client.get('/emails/inbox')['ETag']
+        self.assertNotEqual(self.client.get('/emails/inbox?limit=1')['ETag'], etag)
+
+    def test_deleted_sender_key_invalidates_email(self):
+        key = PGPKey.objects.create(
+            user=self.sender, key_id='S', public_key='S', private_key='S', passphrase='secret',
+            expire_date=timezone.now() + timedelta(days=1),
+        )
+        EmailPGPKey.objects.create(email=self.email, sender_public_key=key)
+        etag = self.client.get(f'/emails/{self.email.id}')['ETag']
+        self.client.force_login(self.sender)
+        self.client.delete('/api/security/keys/S')
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(f'/emails/{self.email.id}', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_key_listing(self):
+        self.assertEqual(self.revalidate('/api/security/received-keys').status_code, 304)
+        etag = self.client.get('/api/security/keys')['ETag']
+        self.client.delete('/api/security/keys/unknown')
+        self.assertEqual(self.client.get('/api/security/keys', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        PGPKey.objects.create(
+            user=self.user, key_id='K', public_key='K', private_key='K', passphrase='secret',
+            expire_date=timezone.now() + timedelta(days=1),
+        )
+        self.client.delete('/api/security/keys/K')
+        self.assertEqual(self.client.get('/api/security/keys', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SyncTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.token = self.client.get('/emails/sync').json()['token']
+
+    def send(self, subject):
+        self.client.force_login(self.sender)
+        payload = {'recipients': 'john@test.com', 'subject': subject, 'body': 'Hello'}
+        self.client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.client.force_login(self.user)
+        return Email.objects.get(user=self.user, subject=subject)
+
+    def sync(self, since, **params):
+        params['since'] = since
+        return self.client.get('/emails/sync', params).json()
+
+    def test_created_and_updated(self):
+        first = self.send('First')
+        changes = self.sync(self.token)
+        self.assertEqual([e['id'] for e in changes['created']], [first.id])
+        self.assertEqual(changes['created'][0]['folder'], 'inbox')
+        self.assertEqual(changes['updated'], [])
+
+        second = self.send('Second')
+        self.client.put(f'/emails/{first.id}', json.dumps({'archived': True}), content_type='application/json')
+        changes = self.sync(changes['token'])
+        self.assertEqual([e['id'] for e in changes['created']], [second.id])
+        self.assertEqual([(e['id'], e['folder']) for e in changes['updated']], [(first.id, 'archive')])
+
+        self.assertEqual(self.sync(changes['token'])['created'], [])
+
+    def test_deleted(self):
+        email = self.send('First')
+        email_id = email.id
+        MailboxChange.objects.create(owner=self.user, email_id=email_id, kind=MailboxChange.DELETED)
+        email.delete()
+        changes = self.sync(self.token)
+        self.assertEqual(changes['created'], [])
+        self.assertEqual(changes['deleted'], [email_id])
+
+    def test_only_own_changes(self):
+        self.send('First')
+        sent = Email.objects.get(user=self.sender)
+        self.client.force_login(self.sender)
+        changes = self.sync(0)
+        self.assertEqual([(e['id'], e['folder']) for e in changes['created']], [(sent.id, 'sent')])
+
+    def test_limit(self):
+        self.send('First')
+        self.send('Second')
+        changes = self.sync(self.token, limit=1)
+        self.assertTrue(changes['more'])
+        self.assertEqual(len(changes['created']), 1)
+        changes = self.sync(changes['token'], limit=1)
+        self.assertFalse(changes['more'])
+        self.assertEqual(len(changes['created']), 1)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.client.get('/emails/sync?since=abc').status_code, 400)
+
+
+# Stands in for a broker backend: records what is published instead of delivering it
+class RecordingEventBackend(EventBackend):
+    def __init__(self, queue_size=100):
+        super().__init__(queue_size)
+        self.published = []
+
+    def publish(self, user_id, event):
+        self.published.append((user_id, event))
+
+
+@override_settings(MAIL_EVENTS=True)
+class EventStreamTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.backend = get_event_backend()
+
+    def test_compose_publishes_new_message(self):
+        client = Client()
+        client.force_login(self.sender)
+        published = []
+        payload = {'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'}
+        with patch.object(self.backend, 'publish', side_effect=lambda *event: published.append(event)):
+            with self.captureOnCommitCallbacks(execute=True):
+                client.post('/emails', json.dumps(payload), content_type='application/json')
+        events = {user_id: event for user_id, event in published}
+        self.assertEqual(events[self.user.id]['type'], 'message.new')
+        self.assertEqual(events[self.user.id]['email']['folder'], 'inbox')
+        self.assertEqual(events[self.sender.id]['email']['folder'], 'sent')
+
+    def test_local_backend_delivers_to_subscriber(self):
+        async def receive():
+            queue = self.backend.subscribe(self.user.id)
+            try:
+                event = {'type': 'message.new', 'email': {'id': 1}}
+                await asyncio.to_thread(self.backend.publish, self.user.id, event)
+                self.backend.publish(self.sender.id, {'type': 'message.new', 'email': {'id': 2}})
+                return await asyncio.wait_for(queue.get(), timeout=1), queue.qsize()
+            finally:
+                self.backend.unsubscribe(self.user.id, queue)
+
+        event, pending = asyncio.run(receive())
+        self.assertEqual(event['email'], {'id': 1})
+        self.assertEqual(pending, 0)
+        self.assertEqual(self.backend.subscriber_count(), 0)
+
+    def test_async_stream(self):
+        async def first_frames():
+            frames = async_stream(self.user.id)
+            retry = await anext(frames)
+            self.backend.publish(self.user.id, {'type': 'message.new', 'email': {'id': 1}})
+            frame = await anext(frames)
+            await frames.aclose()
+            return retry, frame
+
+        retry, frame = asyncio.run(first_frames())
+        self.assertEqual(retry, 'retry: 5000\n\n')
+        self.assertEqual(frame, 'event: message.new\ndata: {"id": 1}\n\n')
+        self.assertEqual(self.backend.subscriber_count(), 0)
+
+    @override_settings(MAIL_EVENT_KEEPALIVE=0.05, MAIL_EVENT_STREAM_TIMEOUT=0.2)
+    def test_wsgi_stream_is_synchronous_and_ends(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get('/emails/events')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.is_async)
+        frames = response.streaming_content
+        self.assertEqual(next(frames), b'retry: 5000\n\n')
+        self.backend.publish(self.user.id, {'type': 'message.new', 'email': {'id': 1}})
+        self.assertEqual(next(frames), b'event: message.new\ndata: {"id": 1}\n\n')
+        # Keepalives until the time limit, then the stream ends
+        self.assertIn(b': keepalive\n\n', list(frames))
+        self.assertEqual(self.backend.subscriber_count(), 0)
+
+    @override_settings(MAIL_EVENT_BACKEND='mail.tests.RecordingEventBackend', COMPOSE_OUTBOX=True)
+    def test_outbox_worker_publishes_through_configured_backend(self):
+        backend = get_event_backend()
+        self.assertIsInstance(backend, RecordingEventBackend)
+        client = Client()
+        client.force_login(self.sender)
+        payload = {'recipients': 'john@test.com', 'subject': 'Hi', 'body': 'Hello'}
+        client.post('/emails', json.dumps(payload), content_type='application/json')
+        self.assertEqual(backend.published, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            drain_outbox()
+        events = dict(backend.published)
+        self.assertEqual(events[self.user.id]['type'], 'message.new')
+        self.assertEqual(events[self.sender.id]['email']['folder'], 'sent')
+
+    def test_default_backend_is_local(self):
+        self.assertIsInstance(get_event_backend(), LocalEventBackend)
+
+    @override_settings(MAIL_EVENTS=False)
+    def test_disabled(self):
+        client = Client()
+        client.force_login(self.user)
+        self.assertEqual(client.get('/emails/events').status_code, 404)
+        self.assertContains(client.get('/'), 'const MAIL_EVENTS = false;')
+
+    def test_requires_login(self):
+        response = Client().get('/emails/events')
+        self.assertEqual(response.status_code, 302)
+
+
+class BulkOperationsTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.emails = [create_email(self.user, self.sender, [self.user], subject=f'Subject {i}') for i in range(5)]
+        reconcile_counters()
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def bulk(self, *operations):
+        operations = [{'action': action, 'ids': ids} for action, ids in operations]
+        payload = json.dumps({'operations': operations})
+        return self.client.post('/emails/bulk', payload, content_type='application/json')
+
+    def assert_counters_consistent(self):
+        summary = mailbox_summary(self.user)
+        reconcile_counters([self.user.id])
+        self.assertEqual(summary, mailbox_summary(self.user))
+
+    def test_read_and_archive(self):
+        ids = [email.id for email in self.emails]
+        response = self.bulk(('read', ids[:3]), ('archive', ids[:2]), ('read', ids[:1]))
+        results = response.json()['results']
+        self.assertEqual(results[0]['changed'], ids[:3])
+        self.assertEqual(results[1]['changed'], ids[:2])
+        self.assertEqual(results[2]['unchanged'], ids[:1])
+
+        self.assertEqual(Email.objects.filter(user=self.user, read=True).count(), 3)
+        self.assertEqual(
+            set(MailboxEntry.objects.filter(owner=self.user, folder='archive').values_list('pk', flat=True)),
+            set(ids[:2]),
+        )
+        self.assertEqual(mailbox_summary(self.user)['inbox'], {'total': 3, 'unread': 2})
+        self.assert_counters_consistent()
+
+        self.bulk(('unarchive', ids), ('unread', ids))
+        self.assertEqual(mailbox_summary(self.user)['inbox'], {'total': 5, 'unread': 5})
+        self.assert_counters_consistent()
+
+    def test_delete(self):
+        ids = [email.id for email in self.emails]
+        response = self.bulk(('delete', ids[:2]))
+        self.assertEqual(response.json()['results'][0]['changed'], ids[:2])
+        self.assertFalse(Email.objects.filter(id__in=ids[:2]).exists())
+        self.assertFalse(MailboxEntry.objects.filter(pk__in=ids[:2]).exists())
+        self.assertEqual(mailbox_summary(self.user)['inbox'], {'total': 3, 'unread': 3})
+        self.assertEqual(
+            set(MailboxChange.objects.filter(kind=MailboxChange.DELETED).values_list('email_id', flat=True)),
+            set(ids[:2]),
+        )
+
+    def test_scoped_to_user(self):
+        other = create_email(self.sender, self.sender, [self.user])
+        response = self.bulk(('delete', [other.id, 999999]))
+        self.assertEqual(response.json()['results'][0]['not_found'], [other.id, 999999])
+        self.assertTrue(Email.objects.filter(id=other.id).exists())
+
+    @override_settings(BULK_BATCH_SIZE=2)
+    def test_batches(self):
+        ids = [email.id for email in self.emails]
+        response = self.bulk(('read', ids))
+        self.assertEqual(response.json()['results'][0]['changed'], ids)
+        self.assertEqual(mailbox_summary(self.user)['inbox']['unread'], 0)
+
+    def test_row_changed_during_batch_is_counted_once(self):
+        ids = [email.id for email in self.emails]
+        calls = []
+
+        # A single-email PUT marks the first email read between the batch's read and its write
+        def changed_meanwhile(rows, changed):
+            calls.append(changed)
+            if len(calls) == 1:
+                self.client.put(f'/emails/{ids[0]}', json.dumps({'read': True}), content_type='application/json')
+            return group_by_state(rows, changed)
+
+        with patch('mail.views.bulk.group_by_state', side_effect=changed_meanwhile):
+            result = self.bulk(('read', ids[:3])).json()['results'][0]
+        # The stale batch was tried again (the test's PUT shares its connection, so it
+        # was rolled back with it) and every change is counted once
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(result['changed'], ids[:3])
+        self.assertEqual(mailbox_summary(self.user)['inbox'], {'total': 5, 'unread': 2})
+        self.assert_counters_consistent()
+
+    def test_stale_state_raises(self):
+        ids = [email.id for email in self.emails]
+
+        def changed_meanwhile(rows, changed):
+            Email.objects.filter(pk=ids[0]).update(archived=True)
+            return group_by_state(rows, changed)
+
+        with patch('mail.views.bulk.group_by_state', side_effect=changed_meanwhile):
+            with self.assertRaises(StaleBatch):
+                apply_action(self.user, 'read', ids[:3])
+
+    def test_invalid_operations(self):
+        self.assertEqual(self.bulk(('star', [1])).status_code, 400)
+        self.assertEqual(self.bulk(('read', 'all')).status_code, 400)
+        self.assertEqual(self.client.get('/emails/bulk').status_code, 400)
+
+
+class MailboxExportTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        # Newest first
+        self.emails = [
+            create_email(self.user, self.sender, [self.user], subject=f'Subject {i}') for i in range(5)
+        ][::-1]
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_ndjson(self):
+        response = self.client.get('/emails/inbox/export')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [email.id for email in self.emails])
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_json_array_full_view(self):
+        response = self.client.get('/emails/inbox/export?format=json&view=full')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        emails = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([email['id'] for email in emails], [email.id for email in self.emails])
+        self.assertEqual(emails[0]['recipients'], ['john@test.com'])
+
+    def test_empty_and_invalid(self):
+        response = self.client.get('/emails/sent/export?format=json')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [])
+        self.assertEqual(self.client.get('/emails/inbox/export?format=csv').status_code, 400)
+        self.assertEqual(self.client.get('/emails/spam/export').status_code, 400)
+
+
+class MailboxFormatTestCase(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(email='bob@test.com', username='bob@test.com')
+        self.user = User.objects.create(email='john@test.com', username='john@test.com')
+        self.armored = (
+            '-----BEGIN PGP MESSAGE-----\n\nhQEMA\nFrom the start\n>From quoted\n-----END PGP MESSAGE-----\n'
+        )
+        sender_key = PGPKey.objects.create(
+            user=self.sender, key_id='SENDERKEY', public_key='-', private_key='-', passphrase='secret',
+            expire_date=timezone.now() + timedelta(days=1),
+        )
+        KeyringKey.objects.create(fingerprint='JOHNKEY', public_key='-')
+        secret = create_email(
+            self.user, self.sender, [self.user], subject='Secret', body=self.armored, encrypted=True, read=True
+        )
+        EmailPGPKey.objects.create(email=secret, recipient_key_id='JOHNKEY', sender_public_key=sender_key)
+        EmailHMAC.objects.create(email=secret, digest=bytes(range(32)), key_version=2)
+        signed = create_email(
+            self.user, self.sender, [self.user], subject='Héllo', body='Plain\r\nFrom here',
+            signed=True, archived=True,
+        )
+        EmailPGPKey.objects.create(email=signed, sender_public_key=sender_key)
+        create_email(self.user, self.user, [self.sender], subject='Sent', body='')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def snapshot(self, user):
+        return [
+            (
+                e.sender_id, e.subject, e.body, e.encrypted, e.signed, e.read, e.archived,
+                [r.id for r in e.recipients.all()],
+                [(link.recipient_key_id, link.sender_public_key_id) for link in e.public_keys.all()],
+                list(EmailHMAC.objects.filter(email=e).values_list('digest', 'key_version')),
+            )
+            for e in Email.objects.filter(user=user).order_by('timestamp', 'id')
+        ]
+
+    def round_trip(self, output_format, path):
+        before = self.snapshot(self.user)
+        out = StringIO()
+        call_command('export_mailbox', 'john@test.com', path, format=output_format, stdout=out)
+        self.assertIn('Exported 3 email(s).', out.getvalue())
+
+        Email.objects.filter(user=self.user).delete()
+        call_command('import_mailbox', 'john@test.com', path, batch_size=2, stdout=out)
+        self.assertIn('Imported 3 email(s)', out.getvalue())
+        self.assertEqual(self.snapshot(self.user), before)
+        summary = mailbox_summary(self.user)
+        reconcile_counters([self.user.id])
+        self.assertEqual(summary, mailbox_summary(self.user))
+        self.assertEqual(summary['archive'], {'total': 1, 'unread': 1})
+
+    def test_mbox_round_trip(self):
+        self.round_trip('mbox', os.path.join(self.directory, 'john.mbox'))
+
+    def test_maildir_round_trip(self):
+        path = os.path.join(self.directory, 'Maildir')
+        self.round_trip('maildir', path)
+        self.assertEqual(len(os.listdir(os.path.join(path, 'cur'))), 1)
+
+    def test_unknown_sender_is_skipped(self):
+        path = os.path.join(self.directory, 'john.mbox')
+        call_command('export_mailbox', 'john@test.com', path, stdout=StringIO())
+        Email.objects.filter(user=self.user).delete()
+        self.sender.email = 'robert@test.com'
+        self.sender.save()
+        out = StringIO()
+        call_command('import_mailbox', 'john@test.com', path, stdout=out)
+        self.assertIn('Imported 1 email(s), skipped 2', out.getvalue())
+
+    def test_unknown_signing_key_is_skipped(self):
+        path = os.path.join(self.directory, 'john.mbox')
+        call_command('export_mailbox', 'john@test.com', path, stdout=StringIO())
+        Email.objects.filter(user=self.user).delete()
+        PGPKey.objects.filter(user=self.sender).delete()
+        out = StringIO()
+        call_command('import_mailbox', 'john@test.com', path, stdout=out)
+        self.assertIn('Imported 2 email(s), skipped 1', out.getvalue())
+        self.assertFalse(Email.objects.filter(user=self.user, signed=True).exists())
+
+    def test_mixed_case_addresses(self):
+        path = os.path.join(self.directory, 'john.mbox')
+        call_command('export_mailbox', 'john@test.com', path, stdout=StringIO())
+        Email.objects.filter(user=self.user).delete()
+        User.objects.filter(pk=self.sender.pk).update(email='Bob@Test.com')
+        out = StringIO()
+        call_command('import_mailbox', 'John@Test.com', path, stdout=out)
+        self.assertIn('Imported 3 email(s)', out.getvalue())
+        self.assertEqual(Email.objects.filter(user=self.user, sender=self.sender).count(), 2)
+
+    def test_download(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get('/emails/export.mbox')
+        self.assertEqual(response['Content-Type'], 'application/mbox')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(content.count(b'\nFrom bob@test.com '), 1)
+        self.assertTrue(content.startswith(b'From bob@test.com '))
+        self.assertIn(b'\n>From the start\n>>From quoted\n', content)
+
+    def test_subject_with_line_breaks(self):
+        create_email(self.user, self.sender, [self.user], subject='line1\nline2\r\nline3', body='Hello')
+        client = Client()
+        client.force_login(self.user)
+        content = b''.join(client.get('/emails/export.mbox').streaming_content)
+        self.assertEqual(content.count(b'\nFrom bob@test.com '), 2)
+
+        path = os.path.join(self.directory, 'john.mbox')
+        call_command('export_mailbox', 'john@test.com', path, stdout=StringIO())
+        Email.objects.filter(user=self.user).delete()
+        out = StringIO()
+        call_command('import_mailbox', 'john@test.com', path, stdout=out)
+        self.assertIn('Imported 4 email(s)', out.getvalue())
+        self.assertTrue(Email.objects.filter(user=self.user, subject='line1 line2 line3').exists())
+
+
+class HMACTestCase(TestCase):
+    @override_settings(HMAC_KEYS={1: 'old key', 2: 'new key'}, HMAC_KEY_VERSION=1)
+    def test_verify_after_key_rotation(self):
+        signed, digest, version = sign_body('Hello::world')
+        self.assertEqual((len(digest), version), (32, 1))
+        with override_settings(HMAC_KEY_VERSION=2):
+            self.assertEqual(verify_signed_body(signed), 'Hello::world')
+            self.assertTrue(sign_body('Hello')[0].startswith('Hello::v2:'))
+        with override_settings(HMAC_KEYS={2: 'new key'}, HMAC_KEY_VERSION=2):
+            self.assertIsNone(verify_signed_body(signed))
+
+    def test_legacy_hex_trailer(self):
+        digest = hmac.new(settings.SECRET_KEY.encode(), b'Hello', hashlib.sha256).hexdigest()
+        self.assertEqual(verify_signed_body(f'Hello::{digest}'), 'Hello')
+
+    def test_tampered_body(self):
+        signed, _, _ = sign_body('Hello')
+        self.assertIsNone(verify_signed_body(signed.replace('Hello', 'Hallo')))
+        self.assertIsNone(verify_signed_body('Hello'))
+
+
+class KeyGenerationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='bob@test.com', username='bob@test.com', password='pass123')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def generate(self, **fields):
+        payload = {'key_type': 'RSA', 'key_size': 1024, 'expire': 30, 'passphrase': 'secret', **fields}
+        return self.client.post('/api/security/generate', json.dumps(payload), content_type='application/json')
+
+    @override_settings(KEYGEN_BACKGROUND=True)
+    def test_queued_key_is_generated_by_worker(self):
+        response = self.generate()
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+        self.assertFalse(PGPKey.objects.exists())
+        self.assertEqual(self.client.get(f'/api/security/generate/{job_id}').json()['status'], KeyGenJob.PENDING)
+
+        call_command('process_key_jobs', once=True, no_pool=True, stdout=StringIO())
+
+        job = self.client.get(f'/api/security/generate/{job_id}').json()
+        self.assertEqual(job['status'], KeyGenJob.DONE)
+        pgp_key = PGPKey.objects.get(user=self.user)
+        self.assertEqual(job['key_id'], pgp_key.key_id)
+        self.assertTrue(pgp_key.default_key)
+        self.assertNotIn('passphrase', json.loads(KeyGenJob.objects.get(pk=job_id).payload))
+
+    @override_settings(KEYGEN_BACKGROUND=True)
+    def test_invalid_request_is_not_queued(self):
+        self.assertEqual(self.generate(key_size=512).status_code, 400)
+        self.assertFalse(KeyGenJob.objects.exists())
+
+    @override_settings(KEY_POOL_SIZES={('RSA', 1024): 1})
+    def test_pooled_key_material_is_used(self):
+        call_command('process_key_jobs', once=True, stdout=StringIO())
+        pooled = PooledKey.objects.get()
+        material = open_key(pooled.key_data)
+
+        self.assertEqual(self.generate().status_code, 201)
+        self.assertFalse(PooledKey.objects.exists())
+        pgp_key = PGPKey.objects.get(user=self.user)
+        self.assertEqual(pgp_key.key_id, str(material.fingerprint))
+
+        key, _ = pgpy.PGPKey.from_blob(pgp_key.private_key)
+        self.assertTrue(key.is_protected)
+        self.assertLess(abs(key.expires_at - pgp_key.expire_date), timedelta(seconds=1))
+
+    @override_settings(KEY_POOL_SIZES={('RSA', 1024): 1})
+    def test_pooled_key_is_encrypted_at_rest(self):
+        call_command('process_key_jobs', once=True, stdout=StringIO())
+        key_data = bytes(PooledKey.objects.get().key_data)
+        self.assertTrue(pgpy.PGPMessage.from_blob(key_data).is_encrypted)
+        self.assertFalse(open_key(key_data).is_public)
+
+        # A key sealed with another secret is dropped instead of handed out
+        with override_settings(KEY_POOL_SECRET='rotated'):
+            self.assertIsNone(take_pooled_key('RSA', 1024))
+        self.assertFalse(PooledKey.objects.exists())
+
+    @override_settings(KEYGEN_BACKGROUND=True, KEYGEN_JOB_TIMEOUT=60, KEYGEN_MAX_ATTEMPTS=2)
+    def test_stale_running_job_is_reclaimed(self):
+        job_id = self.generate().json()['job_id']
+        abandoned = timezone.now() - timedelta(seconds=120)
+        KeyGenJob.objects.filter(pk=job_id).update(status=KeyGenJob.RUNNING, attempts=1, updated=abandoned)
+        self.assertEqual(drain_key_jobs(), 1)
+        job = KeyGenJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), (KeyGenJob.DONE, 2))
+
+        job_id = self.generate().json()['job_id']
+        KeyGenJob.objects.filter(pk=job_id).update(status=KeyGenJob.RUNNING, attempts=2, updated=abandoned)
+        self.assertEqual(drain_key_jobs(), 0)
+        job = KeyGenJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, KeyGenJob.FAILED)
+        self.assertNotIn('passphrase', json.loads(job.payload))
+
+    @override_settings(KEYGEN_BACKGROUND=True, KEYGEN_JOB_TIMEOUT=60)
+    def test_reclaimed_job_creates_one_key(self):
+        job_id = self.generate().json()['job_id']
+        slow = claim_key_job()
+        KeyGenJob.objects.filter(pk=job_id).update(updated=timezone.now() - timedelta(seconds=120))
+        second = claim_key_job()
+        with self.assertRaises(JobLost):
+            process_key_job(slow)
+        self.assertFalse(PGPKey.objects.exists())
+        process_key_job(second)
+        self.assertEqual(KeyGenJob.objects.get(pk=job_id).status, KeyGenJob.DONE)
+        self.assertEqual(PGPKey.objects.filter(user=self.user).count(), 1)
+
+    @override_settings(KEYGEN_BACKGROUND=True, KEYGEN_MAX_ATTEMPTS=2)
+    def test_failed_job_is_retried_then_scrubbed(self):
+        job_id = self.generate().json()['job_id']
+        with patch('mail.utils.key_jobs.create_user_key', side_effect=RuntimeError('boom')), \
+                self.assertLogs('app_api', level='ERROR'):
+            drain_key_jobs()
+        job = KeyGenJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts, job.error), (KeyGenJob.FAILED, 2, 'boom'))
+        self.assertNotIn('passphrase', json.loads(job.payload))
+        self.assertFalse(PGPKey.objects.exists())
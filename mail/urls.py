@@ -12,11 +12,20 @@ urlpatterns = [
     # Emails
     path('emails', index.compose_view, name='compose'),
     path('emails/<int:email_id>', index.email, name='email'),
+    path('emails/bulk', index.bulk_view, name='bulk'),
+    path('emails/outbox/<int:job_id>', index.outbox_job_view, name='outbox_job'),
+    path('emails/search', index.search_view, name='search'),
+    path('emails/summary', index.summary_view, name='summary'),
+    path('emails/sync', index.sync_view, name='sync'),
+    path('emails/export.mbox', index.export_mbox_view, name='export_mbox'),
+    path('emails/events', index.events_view, name='events'),
     path('emails/<str:mailbox>', index.mailbox, name='mailbox'),
+    path('emails/<str:mailbox>/export', index.export_view, name='export'),
     path('emails/decrypt/<int:email_id>', index.decrypt_email_view, name='decrypt_message'),
     
     # PGP Keys
     path('api/security/generate', index.generate_key_view, name='generate_key'),
+    path('api/security/generate/<int:job_id>', index.key_job_view, name='key_job'),
     path('api/security/keys', index.user_keys_view, name='user_keys'),
     path('api/security/keys/<str:key_id>', index.user_key_item_view, name='user_key_item'),
     path('api/security/received-keys', index.received_keys_view, name='received_keys'),
@@ -0,0 +1,63 @@
+import hashlib
+import zlib
+import pgpy
+from django.conf import settings
+
+# Email.body_encoding values
+TEXT = ''      # plain text in Email.body
+PGP = 'pgp'    # binary OpenPGP packets in Email.body_data
+ZLIB = 'zlib'  # zlib-compressed UTF-8 text in Email.body_data
+
+ARMORED_MESSAGE = '-----BEGIN PGP MESSAGE-----'
+
+
+# Shorter texts are stored as-is, compressing them saves little
+def compress_min_length():
+    return getattr(settings, 'EMAIL_COMPRESS_MIN_LENGTH', 256)
+
+
+# Returns the Email fields (body, body_data, body_encoding) storing text.
+# With EMAIL_BODY_STORAGE = 'compact', armored PGP messages are stored as their
+# binary packets (armor is ~33% larger) and, with EMAIL_COMPRESS_BODIES, plain
+# text of at least EMAIL_COMPRESS_MIN_LENGTH characters is zlib-compressed.
+def pack_body(text):
+    if getattr(settings, 'EMAIL_BODY_STORAGE', 'text') == 'compact':
+        if text.startswith(ARMORED_MESSAGE):
+            try:
+                return {'body': '', 'body_data': bytes(pgpy.PGPMessage.from_blob(text)), 'body_encoding': PGP}
+            except (ValueError, NotImplementedError):
+                pass
+        elif getattr(settings, 'EMAIL_COMPRESS_BODIES', False) and len(text) >= compress_min_length():
+            data = text.encode('utf-8')
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return {'body': '', 'body_data': compressed, 'body_encoding': ZLIB}
+    return {'body': text, 'body_data': None, 'body_encoding': TEXT}
+
+
+# Returns the stored body as text, armoring PGP packets
+def unpack_body(body, body_data, body_encoding):
+    if body_encoding == PGP:
+        return str(pgpy.PGPMessage.from_blob(bytes(body_data)))
+    if body_encoding == ZLIB:
+        return zlib.decompress(bytes(body_data)).decode('utf-8')
+    return body
+
+
+# Returns the body in a form pgpy reads: binary packets as-is, without armoring them first
+def pgp_body(body, body_data, body_encoding):
+    if body_encoding == PGP:
+        return bytes(body_data)
+    return unpack_body(body, body_data, body_encoding)
+
+
+def stored_bytes(body, body_data, body_encoding):
+    if body_encoding == TEXT:
+        return body.encode()
+    return bytes(body_data)
+
+
+# Content address of packed body fields
+def body_digest(fields):
+    data = stored_bytes(fields['body'], fields['body_data'], fields['body_encoding'])
+    return hashlib.sha256(fields['body_encoding'].encode() + b':' + data).hexdigest()
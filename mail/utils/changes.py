@@ -0,0 +1,56 @@
+from django.db.models import Max
+from mail.models import MailboxChange, MailboxEntry
+
+
+# Records a change of kind for every (owner_id, email_id) pair
+def log_changes(pairs, kind):
+    MailboxChange.objects.bulk_create([
+        MailboxChange(owner_id=owner_id, email_id=email_id, kind=kind)
+        for owner_id, email_id in pairs
+    ])
+
+
+def log_entry_changes(entries, kind):
+    log_changes([(entry.owner_id, entry.pk) for entry in entries], kind)
+
+
+# Returns the newest sync token of the user (0 if nothing changed yet)
+def latest_token(user):
+    return MailboxChange.objects.filter(owner=user).aggregate(token=Max('id'))['token'] or 0
+
+
+# Returns the changes of the user's mailbox after the since token, at most limit
+# log rows, collapsed to one state per email:
+# - deleted if the email was deleted in the window
+# - created if it was created in the window (with its current state)
+# - updated otherwise
+def changes_since(user, since, limit):
+    changes = list(
+        MailboxChange.objects.filter(owner=user, id__gt=since)
+        .order_by('id')
+        .values('id', 'email_id', 'kind')[:limit + 1]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+    token = changes[-1]['id'] if changes else since
+
+    kinds = {}
+    for change in changes:
+        email_id, kind = change['email_id'], change['kind']
+        previous = kinds.get(email_id)
+        if kind == MailboxChange.DELETED or previous is None:
+            kinds[email_id] = kind
+        elif previous == MailboxChange.UPDATED and kind == MailboxChange.CREATED:
+            kinds[email_id] = kind
+
+    live_ids = [email_id for email_id, kind in kinds.items() if kind != MailboxChange.DELETED]
+    entries = {entry.pk: entry for entry in MailboxEntry.objects.filter(owner=user, pk__in=live_ids)}
+
+    result = {'token': token, 'more': more, 'created': [], 'updated': [], 'deleted': []}
+    for email_id, kind in kinds.items():
+        entry = entries.get(email_id)
+        if kind == MailboxChange.DELETED or entry is None:
+            result['deleted'].append(email_id)
+        else:
+            result[kind].append(dict(entry.serialize(), folder=entry.folder))
+    return result
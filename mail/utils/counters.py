@@ -0,0 +1,70 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Count, F, Q
+from mail.models import MailboxCounter, MailboxEntry
+
+
+# Adds one message (sign=1) or removes one (sign=-1) to the counter deltas
+def count_message(deltas, owner_id, folder, read, sign=1):
+    total, unread = deltas.get((owner_id, folder), (0, 0))
+    deltas[(owner_id, folder)] = (total + sign, unread + (0 if read else sign))
+
+
+# Counter deltas for newly created listing rows
+def entry_deltas(entries):
+    deltas = {}
+    for entry in entries:
+        count_message(deltas, entry.owner_id, entry.folder, entry.read)
+    return deltas
+
+
+# Applies {(owner_id, folder): (total, unread)} deltas with UPDATE ... SET x = x + delta,
+# so concurrent requests never overwrite each other's counts. Owners sharing the same
+# delta (e.g. all recipients of one email) are updated with a single query.
+def apply_counter_deltas(deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta != (0, 0)}
+    if not deltas:
+        return
+
+    groups = defaultdict(list)
+    for (owner_id, folder), delta in deltas.items():
+        groups[(folder, delta)].append(owner_id)
+
+    with transaction.atomic():
+        MailboxCounter.objects.bulk_create(
+            [MailboxCounter(owner_id=owner_id, folder=folder) for owner_id, folder in deltas],
+            ignore_conflicts=True,
+        )
+        for (folder, (total, unread)), owner_ids in groups.items():
+            MailboxCounter.objects.filter(owner_id__in=owner_ids, folder=folder).update(
+                total=F('total') + total,
+                unread=F('unread') + unread,
+            )
+
+
+# Returns {folder: {'total', 'unread'}} for every folder of the user
+def mailbox_summary(user):
+    summary = {folder: {'total': 0, 'unread': 0} for folder, _ in MailboxEntry.FOLDER_CHOICES}
+    for counter in MailboxCounter.objects.filter(owner=user):
+        summary[counter.folder] = counter.serialize()
+    return summary
+
+
+# Recomputes the counters of the given users (or all users) from MailboxEntry
+def reconcile_counters(user_ids=None):
+    entries = MailboxEntry.objects.all()
+    counters = MailboxCounter.objects.all()
+    if user_ids is not None:
+        entries = entries.filter(owner_id__in=user_ids)
+        counters = counters.filter(owner_id__in=user_ids)
+
+    rows = entries.values('owner_id', 'folder').annotate(
+        total=Count('pk'),
+        unread=Count('pk', filter=Q(read=False)),
+    )
+    with transaction.atomic():
+        counters.delete()
+        MailboxCounter.objects.bulk_create([
+            MailboxCounter(owner_id=row['owner_id'], folder=row['folder'], total=row['total'], unread=row['unread'])
+            for row in rows
+        ], batch_size=1000)
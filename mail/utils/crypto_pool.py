@@ -0,0 +1,38 @@
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Returns the shared process pool, created on first use
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.PGP_WORKER_PROCESSES)
+            atexit.register(_executor.shutdown)
+        return _executor
+
+
+# Runs one job and turns unexpected exceptions into the {'error': ...} shape
+# returned by the pgp_encryption helpers
+def run_job(job):
+    func, args = job
+    try:
+        return func(*args)
+    except Exception as e:
+        return {'error': str(e)}
+
+
+# Runs func(*args) for every args tuple in jobs and returns the results in the same order.
+# pgpy is pure Python and CPU-bound, so with PGP_WORKER_PROCESSES > 1 the jobs run in a
+# process pool instead of one after the other. Failures are returned per job as {'error': ...}.
+def run_crypto_jobs(func, jobs):
+    jobs = [(func, args) for args in jobs]
+    workers = getattr(settings, 'PGP_WORKER_PROCESSES', 0)
+    if workers <= 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+    return list(get_executor().map(run_job, jobs))
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+from queue import Full, Queue as SyncQueue
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+NEW_MESSAGE = 'message.new'
+MESSAGE_UPDATED = 'message.updated'
+MESSAGE_DELETED = 'message.deleted'
+
+
+# Pub/sub of mailbox events, keyed by user id. publish() is called from (sync) request
+# and worker code. Streams subscribe with an asyncio queue (ASGI) or a thread-safe queue
+# (WSGI). A multi-worker deployment sets MAIL_EVENT_BACKEND to a subclass whose publish()
+# forwards the event to a shared broker (e.g. Redis pub/sub) and that hands what it
+# receives to deliver() in every process.
+class EventBackend:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, event):
+        self.deliver(user_id, event)
+
+    # Hands the event to every subscriber of user_id in this process
+    def deliver(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, subscriber in subscribers:
+            if loop is None:
+                put_event(subscriber, event)
+            else:
+                loop.call_soon_threadsafe(put_event, subscriber, event)
+
+    # Must be called from the event loop that will read the queue
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._add(user_id, asyncio.get_running_loop(), queue)
+        return queue
+
+    # Queue read by a (WSGI) thread
+    def subscribe_sync(self, user_id):
+        queue = SyncQueue(maxsize=self.queue_size)
+        self._add(user_id, None, queue)
+        return queue
+
+    def _add(self, user_id, loop, queue):
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append((loop, queue))
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            subscribers = [s for s in self._subscribers.get(user_id, []) if s[1] is not queue]
+            if subscribers:
+                self._subscribers[user_id] = subscribers
+            else:
+                self._subscribers.pop(user_id, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+
+# In-process backend: events only reach clients connected to the process that
+# published them; clients of other processes catch up with /emails/sync
+class LocalEventBackend(EventBackend):
+    pass
+
+
+# A client that does not keep up loses events; it catches up with /emails/sync
+def put_event(queue, event):
+    try:
+        queue.put_nowait(event)
+    except (asyncio.QueueFull, Full):
+        pass
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_event_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, 'MAIL_EVENT_BACKEND', 'mail.utils.events.LocalEventBackend')
+                _backend = import_string(path)(queue_size=getattr(settings, 'MAIL_EVENT_QUEUE_SIZE', 100))
+    return _backend
+
+
+# A changed backend setting (e.g. override_settings) takes effect on the next get_event_backend()
+@receiver(setting_changed)
+def reset_event_backend(setting, **kwargs):
+    global _backend
+    if setting in ('MAIL_EVENT_BACKEND', 'MAIL_EVENT_QUEUE_SIZE'):
+        with _backend_lock:
+            _backend = None
+
+
+def events_enabled():
+    return getattr(settings, 'MAIL_EVENTS', False)
+
+
+# Publishes events ([(user_id, event), ...]) once the current transaction commits
+def publish_events(events):
+    events = list(events)
+    if not events or not events_enabled():
+        return
+    backend = get_event_backend()
+
+    def publish():
+        for user_id, event in events:
+            backend.publish(user_id, event)
+
+    transaction.on_commit(publish)
+
+
+def new_message_events(entries):
+    return [
+        (entry.owner_id, {'type': NEW_MESSAGE, 'email': dict(entry.serialize(), folder=entry.folder)})
+        for entry in entries
+    ]
+
+
+def message_updated_event(email, folder):
+    return message_state_event(email.user_id, email.id, email.read, email.archived, folder)
+
+
+def message_state_event(user_id, email_id, read, archived, folder):
+    return (user_id, {
+        'type': MESSAGE_UPDATED,
+        'email': {'id': email_id, 'read': read, 'archived': archived, 'folder': folder},
+    })
+
+
+def message_deleted_event(user_id, email_id):
+    return (user_id, {'type': MESSAGE_DELETED, 'email': {'id': email_id}})
+
+
+# Server-sent event frame
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event['email'])}\n\n"
@@ -1,18 +1,84 @@
+import base64
+import binascii
 import hmac
 import hashlib
+import re
+from django.conf import settings
 
-# Returns the HMAC of a message
-def generate_hmac(message, secret_key):
-    calc_hmac = hmac.new(
-        secret_key.encode(),
-        message.encode(),
-        hashlib.sha256
-    ).hexdigest()
-    
-    return calc_hmac
-
-
-# Return True if the HMAC of the message is equal to the received HMAC
-def verify_hmac(message, secret_key, received_hmac):
-    calc_hmac = generate_hmac(message, secret_key)
-    return hmac.compare_digest(calc_hmac, received_hmac)
\ No newline at end of file
+HMAC_SEPARATOR = '::'
+# Version of the key that signed bodies written before key versions existed
+LEGACY_KEY_VERSION = 1
+
+# body::v<version>:<base64url digest>, or the legacy body::<hex digest>
+VERSIONED_TRAILER = re.compile(r'^v(\d+):([A-Za-z0-9_-]{43})$')
+LEGACY_TRAILER = re.compile(r'^[0-9a-f]{64}$')
+
+
+# Key registry: {version: secret} from HMAC_KEYS, SECRET_KEY as version 1 by default
+def hmac_keys():
+    return getattr(settings, 'HMAC_KEYS', None) or {LEGACY_KEY_VERSION: settings.SECRET_KEY}
+
+
+# Version of the key new HMACs are made with
+def current_key_version():
+    return getattr(settings, 'HMAC_KEY_VERSION', None) or max(hmac_keys())
+
+
+def get_hmac_key(version):
+    return hmac_keys().get(version)
+
+
+# Returns the 32-byte HMAC-SHA256 of a message with the key of the given version
+def compute_hmac(message, version):
+    return hmac.new(get_hmac_key(version).encode(), message.encode(), hashlib.sha256).digest()
+
+
+# Returns (body::v<version>:<digest>, digest, version) for the current key
+def sign_body(body):
+    version = current_key_version()
+    digest = compute_hmac(body, version)
+    return f'{body}{HMAC_SEPARATOR}{format_trailer(digest, version)}', digest, version
+
+
+# v<version>:<base64url digest>
+def format_trailer(digest, version):
+    encoded = base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+    return f'v{version}:{encoded}'
+
+
+# Returns (key version, digest) of a trailer, or None if it is not a valid trailer
+def parse_trailer(trailer):
+    match = VERSIONED_TRAILER.match(trailer)
+    if match:
+        try:
+            digest = base64.urlsafe_b64decode(match.group(2) + '=')
+        except (binascii.Error, ValueError):
+            return None
+        return int(match.group(1)), digest
+    if LEGACY_TRAILER.match(trailer):
+        return LEGACY_KEY_VERSION, bytes.fromhex(trailer)
+    return None
+
+
+# Splits a signed body into (body, key version, digest), or returns None if it has no valid trailer
+def split_signed_body(signed_body):
+    body, separator, trailer = signed_body.rpartition(HMAC_SEPARATOR)
+    if not separator:
+        return None
+    parsed = parse_trailer(trailer)
+    if parsed is None:
+        return None
+    return (body, *parsed)
+
+
+# Returns the body of a signed body if its HMAC matches the key of its version, else None
+def verify_signed_body(signed_body):
+    parts = split_signed_body(signed_body)
+    if parts is None:
+        return None
+    body, version, digest = parts
+    if get_hmac_key(version) is None:
+        return None
+    if not hmac.compare_digest(compute_hmac(body, version), digest):
+        return None
+    return body
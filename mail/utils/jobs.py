@@ -0,0 +1,80 @@
+import json
+from datetime import timedelta
+from django.db.models import F
+from django.utils import timezone
+
+# Helpers shared by the database-backed job queues (OutboxJob, KeyGenJob). A job model
+# has PENDING/RUNNING/FAILED statuses and payload, error, attempts and updated fields.
+
+# Payload fields that are removed once a job no longer needs them
+SECRET_FIELDS = ('passphrase',)
+
+
+# Raised when a worker finishes a job it no longer owns: the job was reclaimed after
+# OUTBOX_JOB_TIMEOUT/KEYGEN_JOB_TIMEOUT and claimed again by another worker
+class JobLost(Exception):
+    pass
+
+
+# Returns the payload (JSON) without its secrets
+def scrub_payload(payload):
+    data = json.loads(payload)
+    for field in SECRET_FIELDS:
+        data.pop(field, None)
+    return json.dumps(data)
+
+
+# Jobs left RUNNING for more than timeout seconds belong to a worker that died: they go
+# back to the queue, or fail for good once they have been tried max_attempts times
+def reclaim_stale_jobs(model, timeout, max_attempts):
+    now = timezone.now()
+    stale = model.objects.filter(status=model.RUNNING, updated__lt=now - timedelta(seconds=timeout))
+    stale.filter(attempts__lt=max_attempts).update(status=model.PENDING, updated=now)
+    for job in stale.filter(attempts__gte=max_attempts).only('id', 'payload', 'attempts'):
+        model.objects.filter(pk=job.pk, status=model.RUNNING).update(
+            status=model.FAILED,
+            error=f'Gave up after {job.attempts} attempt(s).',
+            payload=scrub_payload(job.payload),
+            updated=now,
+        )
+
+
+# Marks the oldest pending job as running and returns it, or None if the queue is empty.
+# The conditional update makes sure only one worker claims a job.
+def claim_next_job(model):
+    pending = model.objects.filter(status=model.PENDING).order_by('id').values_list('id', flat=True)[:10]
+    for job_id in pending:
+        claimed = model.objects.filter(pk=job_id, status=model.PENDING).update(
+            status=model.RUNNING,
+            attempts=F('attempts') + 1,
+            updated=timezone.now(),
+        )
+        if claimed:
+            return model.objects.select_related('user').get(pk=job_id)
+    return None
+
+
+# Records the outcome of a job, with any other changed fields. A failed job that has
+# attempts left goes back to the queue with its payload; a finished one keeps no secrets.
+# Only the attempt that claimed the job can finish it: if the job was reclaimed meanwhile
+# JobLost is raised, so a caller finishing inside its transaction rolls its work back.
+def finish_job(job, status, error='', retry=False, max_attempts=1, fields=()):
+    if retry and job.attempts < max_attempts:
+        status = job.PENDING
+        payload = job.payload
+    else:
+        payload = scrub_payload(job.payload)
+    job.updated = timezone.now()
+    finished = job.__class__.objects.filter(pk=job.pk, status=job.RUNNING, attempts=job.attempts).update(
+        status=status,
+        error=error,
+        payload=payload,
+        updated=job.updated,
+        **{field: getattr(job, field) for field in fields},
+    )
+    if not finished:
+        raise JobLost(job.pk)
+    job.status = status
+    job.error = error
+    job.payload = payload
+    return job
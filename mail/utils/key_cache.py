@@ -0,0 +1,196 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import pgpy
+from django.conf import settings
+
+
+# Process-wide LRU cache of parsed public keys, keyed by fingerprint.
+# Parsing an armored key (base64 decoding and packet parsing) is done once per
+# fingerprint instead of on every encrypt/verify call.
+class PublicKeyCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the parsed key for key_id, parsing armored_key on a miss
+    def get(self, key_id, armored_key):
+        with self._lock:
+            key = self._keys.get(key_id)
+            if key is not None:
+                self._keys.move_to_end(key_id)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key, _ = pgpy.PGPKey.from_blob(armored_key)
+
+        with self._lock:
+            self._keys[key_id] = key
+            self._keys.move_to_end(key_id)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        return key
+
+    def invalidate(self, key_id):
+        with self._lock:
+            self._keys.pop(key_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+public_key_cache = PublicKeyCache(getattr(settings, 'PGP_KEY_CACHE_SIZE', 256))
+
+
+# Returns a parsed public key, from the cache when the fingerprint is known
+def load_public_key(armored_key, key_id=None):
+    if key_id is None:
+        key, _ = pgpy.PGPKey.from_blob(armored_key)
+        return key
+    return public_key_cache.get(key_id, armored_key)
+
+
+# Per-process cache of unlocked private keys, keyed by (session key, key id).
+# Unlocking runs the S2K passphrase derivation, so a session that reads several
+# encrypted emails unlocks its key once. Entries expire after ttl seconds (counted
+# from the unlock), the least recently used entry is evicted past max_size, and
+# the secret key material of a dropped entry is wiped once no request uses it any
+# more. Keys are never written to the cache backend, they only live in this
+# process's memory.
+class UnlockedKeyCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Yields the unlocked key for key_id in the session, unlocking armored_key with
+    # passphrase on a miss. The caller checks the passphrase, a hit does not unlock again.
+    # The key stays unlocked until the block ends, even if it is dropped meanwhile.
+    @contextmanager
+    def use(self, session_key, key_id, armored_key, passphrase):
+        cache_key = (session_key, key_id)
+        dropped = []
+        with self._lock:
+            entry = self._keys.get(cache_key)
+            if entry is not None and entry.expires <= time.monotonic():
+                dropped.append(self._keys.pop(cache_key))
+                self.expired += 1
+                entry = None
+            if entry is not None:
+                self._keys.move_to_end(cache_key)
+                entry.users += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            entry = UnlockedKey(armored_key, passphrase, time.monotonic() + self.ttl)
+            with self._lock:
+                # Another request of the session unlocked the key meanwhile: keep that one
+                if cache_key in self._keys:
+                    dropped.append(entry)
+                    entry = self._keys[cache_key]
+                self._keys[cache_key] = entry
+                self._keys.move_to_end(cache_key)
+                entry.users += 1
+                while len(self._keys) > self.max_size:
+                    dropped.append(self._keys.popitem(last=False)[1])
+                    self.evictions += 1
+        self._release(dropped)
+
+        try:
+            yield entry.key
+        finally:
+            with self._lock:
+                entry.users -= 1
+            self._release([entry] if entry.dropped else [])
+
+    # Drops every key unlocked in the session (on logout)
+    def invalidate_session(self, session_key):
+        self._drop(lambda cache_key: cache_key[0] == session_key)
+
+    # Drops the key from every session (when the key is deleted)
+    def invalidate_key(self, key_id):
+        self._drop(lambda cache_key: cache_key[1] == key_id)
+
+    def clear(self):
+        self._drop(lambda cache_key: True)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.expired = 0
+            self.evictions = 0
+
+    def _drop(self, match):
+        with self._lock:
+            dropped = [self._keys.pop(cache_key) for cache_key in list(self._keys) if match(cache_key)]
+        self._release(dropped)
+
+    # Marks entries as dropped and locks those no request is using; an entry still
+    # in use is locked by the last request that releases it
+    def _release(self, entries):
+        to_lock = []
+        with self._lock:
+            for entry in entries:
+                entry.dropped = True
+                if entry.users == 0 and not entry.locked:
+                    entry.locked = True
+                    to_lock.append(entry)
+        for entry in to_lock:
+            entry.lock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
+
+
+# A private key kept inside its unlock() block, with the number of requests using it
+class UnlockedKey:
+    def __init__(self, armored_key, passphrase, expires):
+        self.key, _ = pgpy.PGPKey.from_blob(armored_key)
+        self._unlocked = self.key.unlock(passphrase)
+        self._unlocked.__enter__()
+        self.expires = expires
+        self.users = 0
+        self.dropped = False
+        self.locked = False
+
+    # Leaves the unlock() block, which wipes the secret key material
+    def lock(self):
+        self._unlocked.__exit__(None, None, None)
+
+
+unlocked_key_cache = UnlockedKeyCache(
+    getattr(settings, 'UNLOCKED_KEY_CACHE_SIZE', 100),
+    getattr(settings, 'UNLOCKED_KEY_CACHE_TTL', 300),
+)
@@ -0,0 +1,60 @@
+import json
+import logging
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from mail.models import KeyGenJob
+from mail.utils.jobs import JobLost, claim_next_job as claim_job, finish_job, reclaim_stale_jobs
+from mail.utils.keygen import KeyGenError, create_user_key, validate_key_request
+
+logger = logging.getLogger('app_api')  # from LOGGING.loggers in settings.py
+
+
+def keygen_timeout():
+    return getattr(settings, 'KEYGEN_JOB_TIMEOUT', 600)
+
+
+def keygen_max_attempts():
+    return getattr(settings, 'KEYGEN_MAX_ATTEMPTS', 3)
+
+
+def claim_next_job():
+    reclaim_stale_jobs(KeyGenJob, keygen_timeout(), keygen_max_attempts())
+    return claim_job(KeyGenJob)
+
+
+# Generates the key of a claimed job and records the outcome on the job. The key and the
+# outcome are saved in one transaction, so the passphrase leaves the payload as soon as
+# it is stored with the key. Invalid requests fail right away, unexpected errors are
+# retried up to KEYGEN_MAX_ATTEMPTS times; every final state drops the passphrase. A job
+# reclaimed from this worker raises JobLost and its key is rolled back.
+def process_job(job):
+    data = json.loads(job.payload)
+    try:
+        with transaction.atomic():
+            validate_key_request(data)
+            job.key = create_user_key(job.user, data)
+            return finish_job(job, KeyGenJob.DONE, fields=['key'])
+    except KeyGenError as e:
+        return finish_job(job, KeyGenJob.FAILED, str(e))
+    except JobLost:
+        raise
+    except Exception as e:
+        logger.exception(f'Key generation job {job.id} failed')
+        return finish_job(job, KeyGenJob.FAILED, str(e), retry=True, max_attempts=keygen_max_attempts())
+
+
+# Processes jobs until the queue is empty, returns the number of processed jobs
+def drain_key_jobs():
+    processed = 0
+    try:
+        while True:
+            job = claim_next_job()
+            if job is None:
+                return processed
+            try:
+                process_job(job)
+            except JobLost:
+                logger.warning(f'Key generation job {job.id} was reclaimed by another worker')
+            processed += 1
+    finally:
+        close_old_connections()
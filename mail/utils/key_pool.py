@@ -0,0 +1,78 @@
+import pgpy
+from django.conf import settings
+from pgpy.constants import PubKeyAlgorithm
+from pgpy.errors import PGPDecryptionError, PGPError
+from mail.models import PooledKey
+
+KEY_ALGORITHMS = {
+    'RSA': PubKeyAlgorithm.RSAEncryptOrSign,
+    'DSA': PubKeyAlgorithm.DSA,
+}
+
+
+# Target number of pooled keys per (key_type, key_size), e.g. {('RSA', 2048): 5}
+def pool_sizes():
+    return getattr(settings, 'KEY_POOL_SIZES', None) or {}
+
+
+# Passphrase pooled keys are encrypted with at rest, until a user's passphrase protects them
+def pool_secret():
+    return getattr(settings, 'KEY_POOL_SECRET', None) or settings.SECRET_KEY
+
+
+def generate_key_material(key_type, key_size):
+    return pgpy.PGPKey.new(KEY_ALGORITHMS[key_type], key_size)
+
+
+# Key material as stored in the pool: the key packets in a passphrase-encrypted message
+def seal_key(key):
+    return bytes(pgpy.PGPMessage.new(bytes(key), file=False).encrypt(pool_secret()))
+
+
+# Returns the key of seal_key bytes, or None if they cannot be decrypted
+# (e.g. KEY_POOL_SECRET has changed)
+def open_key(key_data):
+    try:
+        message = pgpy.PGPMessage.from_blob(bytes(key_data)).decrypt(pool_secret())
+        key, _ = pgpy.PGPKey.from_blob(bytes(message.message))
+    except (ValueError, NotImplementedError, PGPError, PGPDecryptionError):
+        return None
+    return key
+
+
+# Takes a pre-generated key out of the pool, or returns None if the pool is empty.
+# The conditional delete makes sure a key is handed out only once; keys that cannot
+# be opened are dropped.
+def take_pooled_key(key_type, key_size):
+    pooled = PooledKey.objects.filter(key_type=key_type, key_size=key_size).order_by('id')
+    for pk, key_data in pooled.values_list('id', 'key_data')[:10]:
+        deleted, _ = PooledKey.objects.filter(pk=pk).delete()
+        if deleted:
+            key = open_key(key_data)
+            if key is not None:
+                return key
+    return None
+
+
+# Key material for a new key: from the pool when one is configured, generated otherwise
+def new_key_material(key_type, key_size):
+    if (key_type, key_size) in pool_sizes():
+        key = take_pooled_key(key_type, key_size)
+        if key is not None:
+            return key
+    return generate_key_material(key_type, key_size)
+
+
+# Generates keys until every configured pool is at its target size, at most
+# limit keys in total (None = no limit). Returns the number of generated keys.
+def fill_key_pool(limit=None):
+    generated = 0
+    for (key_type, key_size), target in pool_sizes().items():
+        missing = target - PooledKey.objects.filter(key_type=key_type, key_size=key_size).count()
+        for _ in range(missing):
+            if limit is not None and generated >= limit:
+                return generated
+            key = generate_key_material(key_type, key_size)
+            PooledKey.objects.create(key_type=key_type, key_size=key_size, key_data=seal_key(key))
+            generated += 1
+    return generated
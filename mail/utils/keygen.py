@@ -0,0 +1,96 @@
+import pgpy
+from datetime import timedelta
+from django.utils import timezone
+from pgpy.constants import KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
+from mail.models import PGPKey
+from mail.utils.key_pool import KEY_ALGORITHMS, new_key_material
+from mail.utils.versions import bump_keys_version
+
+# Key creation shared by /api/security/generate and the process_key_jobs worker
+
+
+class KeyGenError(Exception):
+    pass
+
+
+# Validates the generate request data, raises KeyGenError with the error message
+def validate_key_request(data):
+    if data.get('key_type') not in KEY_ALGORITHMS:
+        raise KeyGenError('Invalid key type.')
+
+    # if key_type == 'ECDSA':
+    #     if key_size not in [256, 384, 521]:
+    #         raise KeyGenError('Invalid key size.')
+
+    if data.get('key_size') not in [1024, 2048, 4096]:
+        raise KeyGenError('Invalid key size.')
+
+    expiration = data.get('expire')
+    if not isinstance(expiration, int) or isinstance(expiration, bool):
+        raise KeyGenError('Invalid expiration value.')
+
+
+# Creates a PGP key for the user from validated request data. The key material
+# comes from the pre-generated pool when there is one for the key type and size,
+# so only binding the uid and protecting the key is left to do here.
+def create_user_key(user, data):
+    key_type = data.get('key_type')
+    key_size = data.get('key_size')
+    expiration = data.get('expire')
+    passphrase = data.get('passphrase')
+    comment = data.get('comment', '')
+
+    key = new_key_material(key_type, key_size)
+
+    # we now have some key material, but our new key doesn't have a user ID yet, and therefore is not yet usable!
+    fullname = f'{user.first_name} {user.last_name}'
+    uid = pgpy.PGPUID.new(fullname, comment=comment, email=user.email)
+
+    # now we must add the new user id to the key. We'll need to specify all of our preferences at this point
+    # because PGPy doesn't have any built-in key preference defaults at this time
+    # this example is similar to GnuPG 2.1.x defaults, with no expiration or preferred keyserver
+    usage_flags = {KeyFlags.Sign, KeyFlags.EncryptCommunications}
+    hash_algs = [HashAlgorithm.SHA256]
+    symmetric_algs = [SymmetricKeyAlgorithm.AES256]
+    compression_algs = [CompressionAlgorithm.ZLIB]
+
+    # The key expiration counts from the key creation time, which is earlier than now
+    # for a pooled key
+    expire_date = timezone.now() + timedelta(days=expiration)
+    key.add_uid(
+        uid,
+        usage=usage_flags,
+        hashes=hash_algs,
+        ciphers=symmetric_algs,
+        compression=compression_algs,
+        key_expiration=expire_date - key.created
+    )
+
+    key.protect(passphrase, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+
+    encrypt = False
+    sign = False
+
+    if key_type == 'RSA':
+        encrypt = True
+        sign = True
+    elif key_type == 'DSA':
+        sign = True
+
+    default_key = not PGPKey.objects.filter(user=user).exists()
+
+    pgp_key = PGPKey.objects.create(
+        key_id=str(key.fingerprint),
+        user=user,
+        public_key=str(key.pubkey),
+        private_key=str(key),
+        key_size=key_size,
+        encrypt=encrypt,
+        sign=sign,
+        passphrase=passphrase,
+        expire_date=expire_date,
+        default_key=default_key,
+        created=timezone.now()
+    )
+    bump_keys_version([user.id])
+    return pgp_key
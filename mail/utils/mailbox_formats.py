@@ -0,0 +1,330 @@
+import os
+import re
+import socket
+import time
+from datetime import timezone as dt_timezone
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from email.utils import format_datetime, getaddresses, parsedate_to_datetime
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.functions import Lower
+from django.utils import timezone
+from mail.models import (
+    Email, EmailHMAC, EmailPGPKey, EmailRecipient, KeyringKey, MailboxChange, MailboxEntry, PGPKey, User,
+    body_preview,
+)
+from mail.utils.changes import log_entry_changes
+from mail.utils.counters import apply_counter_deltas, entry_deltas
+from mail.utils.hmac_auth import format_trailer, parse_trailer
+from mail.utils.search import index_emails, signed_body_text
+from mail.utils.versions import bump_mailbox_version
+
+MBOX = 'mbox'
+MAILDIR = 'maildir'
+
+# Headers carrying the fields that have no standard mail header
+ENCRYPTED_HEADER = 'X-Mail-Encrypted'
+SIGNED_HEADER = 'X-Mail-Signed'
+READ_HEADER = 'X-Mail-Read'
+ARCHIVED_HEADER = 'X-Mail-Archived'
+# Key references of encrypted/signed emails, re-linked on import: the fingerprint of the
+# sender's signing key, the fingerprints of the recipient keys and the body HMAC
+SENDER_KEY_HEADER = 'X-Mail-Sender-Key'
+RECIPIENT_KEYS_HEADER = 'X-Mail-Recipient-Keys'
+HMAC_HEADER = 'X-Mail-HMAC'
+
+HEADER_POLICY = policy.default.clone(linesep='\n', max_line_length=998)
+FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+ESCAPED_FROM_LINE = re.compile(rb'^>(>*From )', re.MULTILINE)
+LINE_BREAKS = re.compile(r'[\r\n]+')
+
+
+# The user's emails in mailbox order, with participants loaded per chunk
+def export_queryset(user):
+    return Email.objects.filter(user=user).select_related('sender', 'content', 'hmac').prefetch_related(
+        Prefetch('recipients', queryset=User.objects.only('id', 'email')),
+        Prefetch('public_keys', queryset=EmailPGPKey.objects.select_related('sender_public_key').only(
+            'email_id', 'recipient_key_id', 'sender_public_key__key_id',
+        )),
+    ).order_by('timestamp', 'id')
+
+
+# RFC 5322 bytes of an email. The body is written as-is (8bit UTF-8, no
+# re-wrapping or transfer encoding), so PGP armor and signed text survive
+# byte for byte.
+def email_to_bytes(email):
+    headers = EmailMessage(policy=HEADER_POLICY)
+    headers['From'] = header_value(email.sender.email)
+    headers['To'] = header_value(', '.join(user.email for user in email.recipients.all()))
+    headers['Subject'] = header_value(email.subject)
+    headers['Date'] = format_datetime(email.timestamp)
+    headers['MIME-Version'] = '1.0'
+    headers['Content-Type'] = 'text/plain; charset="utf-8"'
+    headers['Content-Transfer-Encoding'] = '8bit'
+    headers[ENCRYPTED_HEADER] = flag(email.encrypted)
+    headers[SIGNED_HEADER] = flag(email.signed)
+    headers[READ_HEADER] = flag(email.read)
+    headers[ARCHIVED_HEADER] = flag(email.archived)
+    for name, value in key_headers(email).items():
+        headers[name] = value
+    return headers.as_bytes() + email.get_body().encode('utf-8')
+
+
+# Headers referencing the keys and HMAC of an encrypted or signed email
+def key_headers(email):
+    if not (email.encrypted or email.signed):
+        return {}
+    headers = {}
+    links = email.public_keys.all()
+    sender_keys = [link.sender_public_key.key_id for link in links if link.sender_public_key is not None]
+    if sender_keys:
+        headers[SENDER_KEY_HEADER] = sender_keys[0]
+    recipient_keys = list(dict.fromkeys(link.recipient_key_id for link in links if link.recipient_key_id))
+    if recipient_keys:
+        headers[RECIPIENT_KEYS_HEADER] = ', '.join(recipient_keys)
+    try:
+        hmac = email.hmac
+    except EmailHMAC.DoesNotExist:
+        hmac = None
+    if hmac is not None:
+        headers[HMAC_HEADER] = format_trailer(bytes(hmac.digest), hmac.key_version)
+    return headers
+
+
+# Header values cannot span lines; compose accepts any subject, so line breaks become spaces
+def header_value(value):
+    return LINE_BREAKS.sub(' ', value)
+
+
+def flag(value):
+    return 'yes' if value else 'no'
+
+
+# Parses bytes written by email_to_bytes (or any single-part text message)
+def parse_message(data, read=None):
+    head, _, body = data.partition(b'\n\n')
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(head + b'\n\n')
+    try:
+        timestamp = parsedate_to_datetime(str(headers['Date']))
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    except (TypeError, ValueError):
+        timestamp = timezone.now()
+
+    def header_flag(name, default=False):
+        value = headers[name]
+        return default if value is None else str(value).strip().lower() == 'yes'
+
+    return {
+        'sender': address_list(headers['From'])[:1],
+        'recipients': address_list(headers['To']),
+        'subject': str(headers['Subject'] or '')[:255],
+        'body': body.decode('utf-8', errors='replace'),
+        'timestamp': timestamp,
+        'encrypted': header_flag(ENCRYPTED_HEADER),
+        'signed': header_flag(SIGNED_HEADER),
+        'read': header_flag(READ_HEADER, default=bool(read)),
+        'archived': header_flag(ARCHIVED_HEADER),
+        'sender_key': str(headers[SENDER_KEY_HEADER] or '').strip() or None,
+        'recipient_keys': [key.strip() for key in str(headers[RECIPIENT_KEYS_HEADER] or '').split(',') if key.strip()],
+        'hmac': parse_trailer(str(headers[HMAC_HEADER] or '').strip()),
+    }
+
+
+def address_list(value):
+    return [address.lower() for _, address in getaddresses([str(value or '')]) if address]
+
+
+# mbox (mboxrd flavour): every message starts with a "From " line and body lines
+# matching >*From are escaped with one more '>', so the escaping is reversible.
+def mbox_records(emails):
+    for email in emails:
+        from_line = f'From {email.sender.email} {time.asctime(email.timestamp.utctimetuple())}\n'
+        head, _, body = email_to_bytes(email).partition(b'\n\n')
+        yield from_line.encode() + head + b'\n\n' + FROM_LINE.sub(rb'>\1', body) + b'\n\n'
+
+
+# Reads an mbox file one message at a time
+def read_mbox(path):
+    def record(lines):
+        data = b''.join(lines)
+        # Drop the separator written after the body
+        if data.endswith(b'\n\n'):
+            data = data[:-2]
+        head, _, body = data.partition(b'\n\n')
+        return parse_message(head + b'\n\n' + ESCAPED_FROM_LINE.sub(rb'\1', body))
+
+    lines = None
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'From '):
+                if lines is not None:
+                    yield record(lines)
+                lines = []
+            elif lines is not None:
+                lines.append(line)
+    if lines is not None:
+        yield record(lines)
+
+
+# Writes the emails into a Maildir (created if needed); read emails go to cur/ with the S flag
+def write_maildir(path, emails):
+    for subdir in ('tmp', 'new', 'cur'):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    host = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+    count = 0
+    for email in emails:
+        name = f'{int(time.time())}.P{os.getpid()}Q{count:09d}M{email.id}.{host}'
+        tmp = os.path.join(path, 'tmp', name)
+        with open(tmp, 'wb') as f:
+            f.write(email_to_bytes(email))
+        if email.read:
+            os.replace(tmp, os.path.join(path, 'cur', name + ':2,S'))
+        else:
+            os.replace(tmp, os.path.join(path, 'new', name))
+        count += 1
+    return count
+
+
+# Reads the messages of new/ and cur/ in file name (delivery) order
+def read_maildir(path):
+    entries = []
+    for subdir in ('new', 'cur'):
+        directory = os.path.join(path, subdir)
+        if os.path.isdir(directory):
+            entries.extend(entry for entry in os.scandir(directory) if entry.is_file())
+
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        _, _, info = entry.name.partition(':2,')
+        with open(entry.path, 'rb') as f:
+            yield parse_message(f.read(), read='S' in info)
+
+
+# Imports parsed messages into the owner's mailbox, batch_size at a time: one
+# bulk_create per table and batch, and one query per batch to resolve addresses
+# (case-insensitively). Messages whose sender has no account, and signed messages
+# whose signing key is not one of the sender's keys, are skipped (they could never
+# be read); unknown recipients are dropped. Returns (imported, skipped).
+def import_messages(owner, messages, batch_size=1000):
+    users = {owner.email.lower(): owner}
+    imported = skipped = 0
+    batch = []
+
+    def flush():
+        addresses = {address for message in batch for address in message['sender'] + message['recipients']}
+        missing = [address for address in addresses if address not in users]
+        found = User.objects.annotate(email_lower=Lower('email')).filter(email_lower__in=missing).only('id', 'email')
+        for user in found:
+            users[user.email.lower()] = user
+        return import_batch(owner, batch, users)
+
+    for message in messages:
+        batch.append(message)
+        if len(batch) == batch_size:
+            count = flush()
+            imported += count
+            skipped += len(batch) - count
+            batch = []
+    if batch:
+        count = flush()
+        imported += count
+        skipped += len(batch) - count
+    return imported, skipped
+
+
+@transaction.atomic
+def import_batch(owner, messages, users):
+    messages = [
+        message for message in messages
+        if message['sender'] and message['sender'][0] in users
+    ]
+    sender_keys = {
+        key.key_id: key
+        for key in PGPKey.objects.filter(key_id__in={m['sender_key'] for m in messages if m['sender_key']}).only(
+            'id', 'key_id', 'user_id'
+        )
+    }
+    messages = [
+        message for message in messages
+        if not message['signed'] or signing_key(message, users, sender_keys) is not None
+    ]
+    if not messages:
+        return 0
+
+    bodies = Email.pack_bodies(message['body'] for message in messages)
+    emails = []
+    recipients = []
+    for message in messages:
+        sender = users[message['sender'][0]]
+        emails.append(Email(
+            **bodies[message['body']],
+            user=owner,
+            sender=sender,
+            subject=message['subject'],
+            timestamp=message['timestamp'],
+            read=message['read'],
+            archived=message['archived'],
+            encrypted=message['encrypted'],
+            signed=message['signed'],
+        ))
+        recipients.append(list({users[a].id: users[a] for a in message['recipients'] if a in users}.values()))
+
+    Email.objects.bulk_create(emails)
+    EmailRecipient.objects.bulk_create([
+        EmailRecipient(email_id=email.id, user_id=user.id)
+        for email, email_recipients in zip(emails, recipients)
+        for user in email_recipients
+    ])
+    entries = [MailboxEntry.from_email(email, email_recipients) for email, email_recipients in zip(emails, recipients)]
+    # The signed text of sign-only emails is public: preview and index it instead of the armor
+    signed_texts = {}
+    for email, entry in zip(emails, entries):
+        if email.signed and not email.encrypted:
+            signed_texts[email.id] = signed_body_text(email.get_pgp_body()) or ''
+            entry.preview = body_preview(signed_texts[email.id])
+    MailboxEntry.objects.bulk_create(entries)
+    apply_counter_deltas(entry_deltas(entries))
+    log_entry_changes(entries, MailboxChange.CREATED)
+    bump_mailbox_version([owner.id])
+    index_emails(
+        emails,
+        {email.id: email_recipients for email, email_recipients in zip(emails, recipients)},
+        bodies=signed_texts,
+    )
+    link_keys(emails, messages, users, sender_keys)
+    return len(emails)
+
+
+# The sender's PGPKey a message was signed with, or None if it is unknown
+def signing_key(message, users, sender_keys):
+    key = sender_keys.get(message['sender_key'])
+    if key is None or key.user_id != users[message['sender'][0]].id:
+        return None
+    return key
+
+
+# Re-creates the key links (as compose does) and HMACs of imported encrypted/signed emails
+def link_keys(emails, messages, users, sender_keys):
+    known_keys = set(KeyringKey.objects.filter(
+        fingerprint__in={key for message in messages for key in message['recipient_keys']}
+    ).values_list('fingerprint', flat=True))
+
+    links = []
+    hmacs = []
+    for email, message in zip(emails, messages):
+        if not (email.encrypted or email.signed):
+            continue
+        sender_key = signing_key(message, users, sender_keys)
+        recipient_keys = [key for key in message['recipient_keys'] if key in known_keys] or [None]
+        links.extend(
+            EmailPGPKey(email=email, recipient_key_id=key, sender_public_key=sender_key)
+            for key in recipient_keys
+        )
+        if message['hmac'] is not None:
+            version, digest = message['hmac']
+            hmacs.append(EmailHMAC(email=email, digest=digest, key_version=version))
+    EmailPGPKey.objects.bulk_create(links)
+    EmailHMAC.objects.bulk_create(hmacs)
@@ -0,0 +1,72 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from mail.models import OutboxJob
+from mail.utils.jobs import JobLost, claim_next_job as claim_job, finish_job, reclaim_stale_jobs
+from mail.views.compose import ComposeError, prepare_email, deliver_email
+
+logger = logging.getLogger('app_api')  # from LOGGING.loggers in settings.py
+
+
+def outbox_timeout():
+    return getattr(settings, 'OUTBOX_JOB_TIMEOUT', 300)
+
+
+def outbox_max_attempts():
+    return getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 3)
+
+
+def claim_next_job():
+    reclaim_stale_jobs(OutboxJob, outbox_timeout(), outbox_max_attempts())
+    return claim_job(OutboxJob)
+
+
+# Sends the email of a claimed job and records the outcome on the job. Invalid emails
+# fail right away, unexpected errors are retried up to OUTBOX_MAX_ATTEMPTS times.
+def process_job(job):
+    data = json.loads(job.payload)
+    try:
+        # All or nothing, and the job is marked sent in the same transaction, so a
+        # retried job never delivers twice; a job reclaimed from this worker raises
+        # JobLost and its delivery is rolled back
+        with transaction.atomic():
+            prepared = prepare_email(job.user, data)
+            deliver_email(job.user, prepared)
+            return finish_job(job, OutboxJob.SENT)
+    except ComposeError as e:
+        return finish_job(job, OutboxJob.FAILED, e.payload['error'])
+    except JobLost:
+        raise
+    except Exception as e:
+        logger.exception(f'Outbox job {job.id} failed')
+        return finish_job(job, OutboxJob.FAILED, str(e), retry=True, max_attempts=outbox_max_attempts())
+
+
+# Processes jobs until the queue is empty, returns the number of processed jobs
+def drain_worker():
+    processed = 0
+    try:
+        while True:
+            job = claim_next_job()
+            if job is None:
+                return processed
+            try:
+                process_job(job)
+            except JobLost:
+                logger.warning(f'Outbox job {job.id} was reclaimed by another worker')
+            processed += 1
+    finally:
+        close_old_connections()
+
+
+# Drains the outbox with the given number of worker threads.
+# With concurrency 1 the jobs are processed in the calling thread.
+def drain_outbox(concurrency=1):
+    if concurrency <= 1:
+        return drain_worker()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(drain_worker) for _ in range(concurrency)]
+    return sum(future.result() for future in futures)
@@ -0,0 +1,66 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+
+class PaginationError(ValueError):
+    pass
+
+
+# Returns an opaque cursor string for the (timestamp, id) position of an email
+def encode_cursor(timestamp, pk):
+    raw = f'{timestamp.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# Returns the (timestamp, id) tuple stored inside a cursor string
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, pk = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise PaginationError('Invalid cursor.')
+
+
+# Keyset pagination over a queryset ordered by (timestamp, pk) descending.
+# Instead of OFFSET, each page continues from the (timestamp, id) of the last row
+# seen, so the cost of a page does not depend on how deep into the mailbox it is.
+#
+# - before: rows older than the cursor (next page)
+# - after: rows newer than the cursor (polling for new mail)
+#
+# Returns (rows, next_cursor, prev_cursor).
+def paginate_keyset(queryset, limit, before=None, after=None):
+    if before is not None and after is not None:
+        raise PaginationError('Use either before or after, not both.')
+
+    if after is not None:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+        ).order_by('timestamp', 'pk')
+    else:
+        if before is not None:
+            timestamp, pk = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+            )
+        queryset = queryset.order_by('-timestamp', '-pk')
+
+    # Fetch one extra row to know whether another page exists
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if after is not None:
+        rows.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = before is not None, has_more
+
+    next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].pk) if rows and has_older else None
+    prev_cursor = encode_cursor(rows[0].timestamp, rows[0].pk) if rows and has_newer else None
+
+    return rows, next_cursor, prev_cursor
@@ -1,15 +1,18 @@
 import pgpy
+from contextlib import contextmanager
+from .key_cache import load_public_key
 
 
 """
 Fungsi ini mengenkripsi pesan plaintext menggunakan public key yang diberikan.
 Jika berhasil, fungsi mengembalikan pesan terenkripsi dalam bentuk string.
 Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
+Jika key_id (fingerprint) diberikan, public key diambil dari cache.
 """
-def encrypt_message(message, public_key):
+def encrypt_message(message, public_key, key_id=None):
     try:
         # Memuat public key
-        public_key, _ = pgpy.PGPKey.from_blob(public_key)
+        public_key = load_public_key(public_key, key_id)
         
         # Membuat objek PGPMessage dari pesan
         pgp_message = pgpy.PGPMessage.new(message)
@@ -23,6 +26,20 @@ def encrypt_message(message, public_key):
         return {"error": str(ve)}
 
 
+# Memuat dan membuka private key untuk dipakai di dalam blok with.
+# private_key boleh berupa kunci yang sudah dibuka (dari unlocked_key_cache),
+# kunci tersebut dipakai langsung tanpa dibuka ulang.
+@contextmanager
+def unlocked_private_key(private_key, passphrase):
+    if isinstance(private_key, pgpy.PGPKey):
+        yield private_key
+        return
+
+    key, _ = pgpy.PGPKey.from_blob(private_key)
+    with key.unlock(passphrase):
+        yield key
+
+
 """
 Fungsi ini mendekripsi pesan yang telah dienkripsi menggunakan private key yang diberikan 
 dan passphrase untuk membuka private key.
@@ -31,11 +48,8 @@ Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
 """
 def decrypt_message(encrypted_message, private_key, passphrase):
     try:
-        # Memuat private key
-        private_key, _ = pgpy.PGPKey.from_blob(private_key)
-        
-        # Membuka kunci private key dengan passphrase
-        with private_key.unlock(passphrase):
+        # Memuat private key dan membukanya dengan passphrase
+        with unlocked_private_key(private_key, passphrase) as private_key:
             # Memuat pesan terenkripsi
             enc_msg = pgpy.PGPMessage.from_blob(encrypted_message)
             decrypt_msg = private_key.decrypt(enc_msg)
@@ -49,44 +63,67 @@ def decrypt_message(encrypted_message, private_key, passphrase):
 """
 Fungsi ini menandatangani pesan plaintext menggunakan private key yang diberikan 
 dan passphrase untuk membuka private key.
-Fungsi mengembalikan pesan yang telah ditandatangani dalam bentuk string.
+Jika berhasil, fungsi mengembalikan pesan yang telah ditandatangani dalam bentuk string.
+Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
 """
 def sign_message(message, private_key, passphrase):
-    # Memuat private key
-    priv_key, _ = pgpy.PGPKey.from_blob(private_key)
-    
-    # Membuka kunci private key dengan passphrase
-    with priv_key.unlock(passphrase):
-        # Create a PGPMessage object from the plaintext message
-        msg = pgpy.PGPMessage.new(message)
+    try:
+        # Memuat private key
+        priv_key, _ = pgpy.PGPKey.from_blob(private_key)
+
+        # Membuka kunci private key dengan passphrase
+        with priv_key.unlock(passphrase):
+            # Create a PGPMessage object from the plaintext message
+            msg = pgpy.PGPMessage.new(message)
+
+            # Sign pesan menggunakan private key
+            msg |= priv_key.sign(msg)
         
-        # Sign pesan menggunakan private key
-        msg |= priv_key.sign(msg)
+        return str(msg)
     
-    return str(msg)
+    except ValueError as ve:
+        return {"error": str(ve)}
 
 
 """
 Fungsi ini memverifikasi pesan yang telah ditandatangani menggunakan public key pengirim yang diberikan.
-Jika tanda tangan valid, fungsi mengembalikan pesan dalam bentuk string.
+Jika tanda tangan valid, fungsi mengembalikan objek JSON dengan pesan dalam bentuk string.
 Jika verifikasi gagal, fungsi mengembalikan objek JSON dengan pesan error.
+Jika key_id (fingerprint) diberikan, public key diambil dari cache.
 """
-def verify_message(signed_message, sender_public_key):
-    # Memuat public key pengirim
-    pub_key, _ = pgpy.PGPKey.from_blob(sender_public_key)
-    
-    # Memuat pesan
-    signed_pgp_message = pgpy.PGPMessage.from_blob(signed_message)
-    
-    # Memverifikasi signature pesan
-    verification = pub_key.verify(signed_pgp_message)
+def verify_message(signed_message, sender_public_key, key_id=None):
+    try:
+        # Memuat public key pengirim
+        pub_key = load_public_key(sender_public_key, key_id)
+
+        # Memuat pesan
+        signed_pgp_message = pgpy.PGPMessage.from_blob(signed_message)
+
+        # Memverifikasi signature pesan
+        verification = pub_key.verify(signed_pgp_message)
+
+        if verification:
+            print("Signature is valid.")
+            return {"message": str(signed_pgp_message.message)}
+        else:
+            print("Signature verification failed.")
+            return {"error": "Signature verification failed."}
     
-    if verification:
-        print("Signature is valid.")
-        return signed_pgp_message.message
-    else:
-        print("Signature verification failed.")
-        return {"error": "Signature verification failed."}
+    except ValueError as ve:
+        return {"error": str(ve)}
+
+
+# Mengembalikan teks dari pesan yang ditandatangani (literal data packet) tanpa
+# memverifikasi tanda tangan, atau None jika pesan tidak dapat dibaca.
+# Dipakai untuk indeks pencarian dan preview; verifikasi tetap dilakukan saat email dibuka.
+def signed_message_text(signed_message):
+    try:
+        message = pgpy.PGPMessage.from_blob(signed_message)
+    except (ValueError, TypeError):
+        return None
+    if message.is_encrypted or not isinstance(message.message, str):
+        return None
+    return message.message
 
 
 """
@@ -95,10 +132,10 @@ dan menandatangani pesan tersebut menggunakan private key pengirim dengan passph
 Jika berhasil, fungsi mengembalikan pesan terenkripsi dalam bentuk string.
 Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
 """
-def encrypt_and_sign_message(message, recipient_public_key, sender_private_key, passphrase):
+def encrypt_and_sign_message(message, recipient_public_key, sender_private_key, passphrase, recipient_key_id=None):
     try:
         # Memuat public key penerima
-        pub_key, _ = pgpy.PGPKey.from_blob(recipient_public_key)
+        pub_key = load_public_key(recipient_public_key, recipient_key_id)
         
         # Memeriksa apakah public key memiliki flag enkripsi
         if not any(uid.selfsig.key_flags & {pgpy.constants.KeyFlags.EncryptCommunications, pgpy.constants.KeyFlags.EncryptStorage} for uid in pub_key.userids):
@@ -130,18 +167,17 @@ dan memverifikasi tanda tangan pesan tersebut menggunakan public key pengirim.
 Jika berhasil, fungsi mengembalikan pesan terenkripsi dalam bentuk json.
 Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
 """
-def decrypt_and_verify_message(encrypted_message, recipient_private_key, passphrase, sender_public_key):
+def decrypt_and_verify_message(
+    encrypted_message, recipient_private_key, passphrase, sender_public_key, sender_key_id=None
+):
     try:
-        # Memuat private key penerima
-        priv_key, _ = pgpy.PGPKey.from_blob(recipient_private_key)
-        
-        # Membuka private keye key penerima dengan passphrase
-        with priv_key.unlock(passphrase):
+        # Memuat private key penerima dan membukanya dengan passphrase
+        with unlocked_private_key(recipient_private_key, passphrase) as priv_key:
             # Decrypt the message
             decrypted_message = priv_key.decrypt(pgpy.PGPMessage.from_blob(encrypted_message))
             
         # Memuat public key pengirim
-        pub_key, _ = pgpy.PGPKey.from_blob(sender_public_key)
+        pub_key = load_public_key(sender_public_key, sender_key_id)
         
         # Memverifikasi signature
         if pub_key.verify(decrypted_message):
@@ -152,4 +188,61 @@ def decrypt_and_verify_message(encrypted_message, recipient_private_key, passphr
             return {"error": "Signature verification failed."}
         
     except ValueError as ve:
-        return {"error": str(ve)}
\ No newline at end of file
+        return {"error": str(ve)}
+
+
+# Fungsi ini mengenkripsi pesan yang sudah ditandatangani (hasil sign_message)
+# menggunakan public key penerima yang diberikan.
+# Dengan fungsi ini private key pengirim cukup dibuka dan dipakai sekali untuk
+# semua penerima, lalu hasil tanda tangan dienkripsi untuk setiap penerima.
+# Jika berhasil, fungsi mengembalikan pesan terenkripsi dalam bentuk string.
+# Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
+def encrypt_signed_message(signed_message, recipient_public_key, recipient_key_id=None):
+    try:
+        # Memuat public key penerima
+        pub_key = load_public_key(recipient_public_key, recipient_key_id)
+
+        # Memeriksa apakah public key memiliki flag enkripsi
+        encrypt_flags = {pgpy.constants.KeyFlags.EncryptCommunications, pgpy.constants.KeyFlags.EncryptStorage}
+        if not any(uid.selfsig.key_flags & encrypt_flags for uid in pub_key.userids):
+            raise ValueError("public key penerima tidak valid untuk enkripsi.")
+
+        # Memuat pesan yang sudah ditandatangani
+        msg = pgpy.PGPMessage.from_blob(signed_message)
+
+        # Mengenkripsi pesan yang ditandatangani dengan public key penerima
+        encrypted_message = pub_key.encrypt(msg)
+
+        return str(encrypted_message)
+
+    except ValueError as ve:
+        return {"error": str(ve)}
+
+
+# Fungsi ini mengenkripsi pesan sekali untuk semua penerima: satu session key
+# dibungkus dengan public key setiap penerima, sehingga hasilnya satu pesan OpenPGP
+# yang bisa didekripsi oleh semua penerima.
+# Jika signed bernilai True, message adalah pesan yang sudah ditandatangani (hasil sign_message).
+# Jika berhasil, fungsi mengembalikan pesan terenkripsi dalam bentuk string.
+# Jika terjadi kesalahan, fungsi mengembalikan objek JSON dengan pesan error.
+def encrypt_message_for_recipients(message, public_keys, key_ids=None, signed=False):
+    try:
+        key_ids = key_ids or [None] * len(public_keys)
+
+        # Membuat objek PGPMessage dari pesan
+        msg = pgpy.PGPMessage.from_blob(message) if signed else pgpy.PGPMessage.new(message)
+
+        # Session key yang sama dipakai untuk semua penerima
+        cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
+        session_key = cipher.gen_key()
+
+        for public_key, key_id in zip(public_keys, key_ids):
+            pub_key = load_public_key(public_key, key_id)
+            msg = pub_key.encrypt(msg, cipher=cipher, sessionkey=session_key)
+
+        del session_key
+
+        return str(msg)
+
+    except ValueError as ve:
+        return {"error": str(ve)}
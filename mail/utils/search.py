@@ -0,0 +1,125 @@
+from django.db import connection
+from mail.utils import body_storage
+from mail.utils.hmac_auth import verify_signed_body
+from mail.utils.pgp_encryption import signed_message_text
+
+# SQLite FTS5 table created by migration 0013, one row per Email (rowid = email id).
+# The owner column holds an 'u<user id>' token, so a search is an index intersection
+# with the user's own rows instead of a scan.
+SEARCH_TABLE = 'mail_email_fts'
+
+# Columns the search terms are matched against; owner only scopes the search
+SEARCH_COLUMNS = ('subject', 'sender', 'recipients', 'body')
+
+# bm25 weights per column: owner, subject, sender, recipients, body
+SEARCH_WEIGHTS = (0.0, 10.0, 5.0, 5.0, 1.0)
+
+
+def search_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def owner_token(user_id):
+    return f'u{user_id}'
+
+
+# Encrypted and armored bodies are not searchable; sign-only emails are searched by
+# their signed text
+def searchable_body(email):
+    if email.encrypted:
+        return ''
+    if email.signed:
+        return signed_body_text(email.get_pgp_body()) or ''
+    if email.get_body_encoding() == body_storage.PGP:
+        return ''
+    body = email.get_body()
+    if body.startswith('-----BEGIN PGP'):
+        return ''
+    return body
+
+
+# The text of a signed body (body::hmac inside the signed message) if its HMAC
+# matches, else None
+def signed_body_text(signed_body):
+    text = signed_message_text(signed_body)
+    if text is None:
+        return None
+    return verify_signed_body(text)
+
+
+# Adds or replaces the index rows of the given emails.
+# recipients is the list of recipient users shared by all the emails (as in compose),
+# a dict of {email_id: recipients} (as in imports), or None to read each email's recipients.
+# bodies ({email_id: text}) replaces the searchable body of emails whose text the
+# caller already has (e.g. the plaintext of a sign-only send).
+def index_emails(emails, recipients=None, bodies=None):
+    if not search_enabled() or not emails:
+        return
+
+    rows = []
+    for email in emails:
+        if isinstance(recipients, dict):
+            email_recipients = recipients[email.id]
+        elif recipients is not None:
+            email_recipients = recipients
+        else:
+            email_recipients = email.recipients.all()
+        rows.append((
+            email.id,
+            owner_token(email.user_id),
+            email.subject,
+            email.sender.email,
+            ' '.join(user.email for user in email_recipients),
+            bodies[email.id] if bodies and email.id in bodies else searchable_body(email),
+        ))
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, owner, subject, sender, recipients, body) '
+            'VALUES (%s, %s, %s, %s, %s, %s)',
+            rows,
+        )
+
+
+def unindex_emails(email_ids):
+    if not search_enabled() or not email_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(email_ids))})',
+            list(email_ids),
+        )
+
+
+def clear_search_index():
+    if not search_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+
+
+# Turns free text into an FTS5 query: every word must match, the last one as a prefix
+def build_match_query(query):
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' AND '.join(terms)
+
+
+# Returns the ids of the user's emails matching query, best match first.
+# Fetches limit + 1 ids so the caller can tell whether there is another page.
+def search_email_ids(user, query, limit, offset=0):
+    match = build_match_query(query)
+    if match is None:
+        return []
+
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s '
+            f'ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT %s OFFSET %s',
+            [f'owner:{owner_token(user.id)} AND {{{" ".join(SEARCH_COLUMNS)}}}: ({match})', limit + 1, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
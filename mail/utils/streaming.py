@@ -0,0 +1,36 @@
+import json
+from django.http import StreamingHttpResponse
+
+NDJSON = 'ndjson'
+JSON = 'json'
+CONTENT_TYPES = {
+    NDJSON: 'application/x-ndjson',
+    JSON: 'application/json',
+}
+
+
+# One JSON document per line
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+# A JSON array, emitted one element at a time
+def json_array_chunks(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ','
+    yield ']'
+
+
+# Streams serialized rows as NDJSON or a JSON array. rows should be a lazy
+# iterable (e.g. QuerySet.iterator()), so memory stays bounded by one chunk
+# of objects however many rows there are.
+def streaming_json_response(rows, output_format=NDJSON, filename=None):
+    chunks = ndjson_lines(rows) if output_format == NDJSON else json_array_chunks(rows)
+    response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[output_format])
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,77 @@
+import hashlib
+from django.db.models import F
+from django.utils import timezone
+from mail.models import UserVersion
+
+MAILBOX = 'mailbox'
+KEYS = 'keys'
+
+
+# Increments the mailbox or keys version of the given users
+def bump_version(user_ids, kind):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    UserVersion.objects.bulk_create([UserVersion(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    UserVersion.objects.filter(user_id__in=user_ids).update(**{
+        f'{kind}_version': F(f'{kind}_version') + 1,
+        f'{kind}_updated': timezone.now(),
+    })
+
+
+def bump_mailbox_version(user_ids):
+    bump_version(user_ids, MAILBOX)
+
+
+def bump_keys_version(user_ids):
+    bump_version(user_ids, KEYS)
+
+
+# Returns the versions of the requesting user, loaded once per request
+def get_user_version(request):
+    if not hasattr(request, '_user_version'):
+        user_id = request.user.id
+        request._user_version = UserVersion.objects.filter(user_id=user_id).first() or UserVersion(user_id=user_id)
+    return request._user_version
+
+
+# ETag of a response that depends on the given kinds of data of the user.
+# The full path is part of it, so every page/cursor/view has its own tag.
+def user_etag(request, *kinds):
+    version = get_user_version(request)
+    parts = [request.get_full_path()] + [str(getattr(version, f'{kind}_version')) for kind in kinds]
+    digest = hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+    return f'W/"{request.user.id}-{digest}"'
+
+
+def user_last_modified(request, *kinds):
+    version = get_user_version(request)
+    dates = [getattr(version, f'{kind}_updated') for kind in kinds]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def mailbox_etag(request, *args, **kwargs):
+    return user_etag(request, MAILBOX)
+
+
+def mailbox_last_modified(request, *args, **kwargs):
+    return user_last_modified(request, MAILBOX)
+
+
+def keys_etag(request, *args, **kwargs):
+    return user_etag(request, KEYS)
+
+
+def keys_last_modified(request, *args, **kwargs):
+    return user_last_modified(request, KEYS)
+
+
+# An opened email also depends on the keys (its signature is verified with them);
+# deleting a key bumps the keys version of the owners of the emails linked to it
+def email_etag(request, *args, **kwargs):
+    return user_etag(request, MAILBOX, KEYS)
+
+
+def email_last_modified(request, *args, **kwargs):
+    return user_last_modified(request, MAILBOX, KEYS)
@@ -0,0 +1,169 @@
+import json
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from mail.models import Email, MailboxChange, MailboxEntry, mailbox_folder
+from ..utils.changes import log_changes
+from ..utils.counters import apply_counter_deltas, count_message
+from ..utils.events import message_deleted_event, message_state_event, publish_events
+from ..utils.versions import bump_mailbox_version
+
+# action: (field, value); delete has no field
+BULK_ACTIONS = {
+    'read': ('read', True),
+    'unread': ('read', False),
+    'archive': ('archived', True),
+    'unarchive': ('archived', False),
+    'delete': None,
+}
+
+
+# Times a batch is tried again when its rows changed while it was being applied
+BULK_RETRIES = 3
+
+
+class BulkError(Exception):
+    pass
+
+
+# Raised inside the batch transaction when a row no longer had the state that was read
+class StaleBatch(Exception):
+    pass
+
+
+# Validates the request body and returns [(action, ids), ...]
+def parse_operations(data):
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise BulkError('A list of operations is required.')
+
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('action') not in BULK_ACTIONS:
+            raise BulkError(f"Action must be one of: {', '.join(BULK_ACTIONS)}.")
+        ids = operation.get('ids')
+        if not isinstance(ids, list) or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+            raise BulkError('ids must be a list of email ids.')
+        parsed.append((operation['action'], list(dict.fromkeys(ids))))
+    return parsed
+
+
+# {(read, archived): ids} of the read rows. Writes are made per prior state and only
+# match rows still in it, so a row changed concurrently makes the counts not add up.
+def group_by_state(rows, ids):
+    groups = {}
+    for pk in ids:
+        groups.setdefault(rows[pk][1:], []).append(pk)
+    return groups
+
+
+# Applies one action to a batch of the user's emails with one UPDATE (or DELETE) per
+# table and prior state, and keeps listing rows, counters, the change log and events in
+# step. Returns (changed_ids, unchanged_ids, not_found_ids, events); raises StaleBatch
+# when a row changed since it was read.
+def apply_action(user, action, ids):
+    # Locks the rows where the database supports it; the writes below are also conditional
+    # on the state read here, so a concurrent change is never counted twice
+    rows = Email.objects.select_for_update().filter(user=user, id__in=ids).values_list(
+        'id', 'sender_id', 'read', 'archived'
+    )
+    rows = {pk: (sender_id, read, archived) for pk, sender_id, read, archived in rows}
+    not_found = [pk for pk in ids if pk not in rows]
+    deltas = {}
+    events = []
+
+    if action == 'delete':
+        changed = list(rows)
+        for pk, (sender_id, read, archived) in rows.items():
+            count_message(deltas, user.id, mailbox_folder(user.id, sender_id, archived), read, sign=-1)
+            events.append(message_deleted_event(user.id, pk))
+        # Cascades to listing rows, recipients, HMACs and key links; search rows
+        # are removed by the post_delete signal
+        deleted = sum(
+            Email.objects.filter(user=user, id__in=pks, read=read, archived=archived).delete()[1].get(
+                Email._meta.label, 0
+            )
+            for (read, archived), pks in group_by_state(rows, changed).items()
+        )
+        if deleted != len(changed):
+            raise StaleBatch()
+        kind = MailboxChange.DELETED
+    else:
+        field, value = BULK_ACTIONS[action]
+        position = 1 if field == 'read' else 2
+        changed = [pk for pk in ids if pk in rows and rows[pk][position] != value]
+        updated = sum(
+            Email.objects.filter(user=user, id__in=pks, read=read, archived=archived).update(**{field: value})
+            for (read, archived), pks in group_by_state(rows, changed).items()
+        )
+        if updated != len(changed):
+            raise StaleBatch()
+        MailboxEntry.objects.filter(owner=user, pk__in=changed).update(**{field: value})
+
+        moved = {}
+        for pk in changed:
+            sender_id, read, archived = rows[pk]
+            old_folder = mailbox_folder(user.id, sender_id, archived)
+            count_message(deltas, user.id, old_folder, read, sign=-1)
+            if field == 'read':
+                read = value
+            else:
+                archived = value
+            folder = mailbox_folder(user.id, sender_id, archived)
+            count_message(deltas, user.id, folder, read)
+            if folder != old_folder:
+                moved.setdefault(folder, []).append(pk)
+            events.append(message_state_event(user.id, pk, read, archived, folder))
+        for folder, pks in moved.items():
+            MailboxEntry.objects.filter(owner=user, pk__in=pks).update(folder=folder)
+        kind = MailboxChange.UPDATED
+
+    apply_counter_deltas(deltas)
+    log_changes([(user.id, pk) for pk in changed], kind)
+    changed_ids = set(changed)
+    unchanged = [pk for pk in ids if pk in rows and pk not in changed_ids]
+    return changed, unchanged, not_found, events
+
+
+# POST /emails/bulk
+# Request body: { operations: [{ action: read|unread|archive|unarchive|delete, ids: [...] }, ...] }
+# Operations run in order, in batches of BULK_BATCH_SIZE ids. Returns, per
+# operation, the ids that changed, were already in that state, or were not found.
+def bulk_update(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required.'}, status=400)
+
+    try:
+        operations = parse_operations(json.loads(request.body))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON.'}, status=400)
+    except BulkError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    batch_size = getattr(settings, 'BULK_BATCH_SIZE', 500)
+    results = []
+    for action, ids in operations:
+        result = {'action': action, 'changed': [], 'unchanged': [], 'not_found': []}
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            for _ in range(BULK_RETRIES):
+                try:
+                    with transaction.atomic():
+                        changed, unchanged, not_found, events = apply_action(request.user, action, batch)
+                        if changed:
+                            bump_mailbox_version([request.user.id])
+                            publish_events(events)
+                    break
+                except StaleBatch:
+                    continue
+            else:
+                return JsonResponse({
+                    'error': 'Emails changed during the update, try again.',
+                    'results': results,
+                }, status=409)
+            result['changed'] += changed
+            result['unchanged'] += unchanged
+            result['not_found'] += not_found
+        results.append(result)
+
+    return JsonResponse({'results': results})
@@ -1,116 +1,193 @@
 import json
 from django.http import JsonResponse
 from django.conf import settings
-from mail.models import Email, PGPKey, User, EmailHMAC, ReceivedPublicKey, EmailPGPKey
-from mail.utils.pgp_encryption import encrypt_message, encrypt_and_sign_message, sign_message
-from mail.utils.hmac_auth import generate_hmac
+from django.db import transaction
+from mail.models import (
+    Email, PGPKey, User, EmailHMAC, KeyringKey, ReceivedPublicKey, EmailPGPKey, OutboxJob, MailboxEntry, MailboxChange,
+    body_preview,
+)
+from mail.utils.pgp_encryption import (
+    encrypt_message, encrypt_signed_message, encrypt_message_for_recipients, sign_message,
+)
+from mail.utils.hmac_auth import sign_body
+from mail.utils.crypto_pool import run_crypto_jobs
+from mail.utils.search import index_emails
+from mail.utils.counters import apply_counter_deltas, entry_deltas
+from mail.utils.versions import bump_mailbox_version, bump_keys_version
+from mail.utils.changes import log_entry_changes
+from mail.utils.events import new_message_events, publish_events
 
 
-def compose(request):
-    # Composing a new email must be via POST
-    if request.method != 'POST':
-        return JsonResponse({'error': 'POST request required.'}, status=400)
+class ComposeError(Exception):
+    def __init__(self, error, status=400, **extra):
+        super().__init__(error)
+        self.status = status
+        self.payload = {'error': error, **extra}
+
 
+# Validates the compose request data and resolves recipients and PGP keys.
+# Raises ComposeError if the email cannot be sent, otherwise returns everything
+# deliver_email needs.
+def prepare_email(sender, data):
     # Check recipient emails
-    data = json.loads(request.body)
-    emails = [email.strip() for email in data.get('recipients').split(',')]
+    emails = [email.strip() for email in data.get('recipients', '').split(',')]
     if emails == ['']:
-        return JsonResponse({
-            'error': 'At least one recipient required.'
-        }, status=400)
+        raise ComposeError('At least one recipient required.')
 
+    # Convert email addresses to users, with a single query for all recipients
+    emails = list(dict.fromkeys(emails))
+    if sender.email in emails:
+        raise ComposeError('Cannot send email to self.')
 
-    # Convert email addresses to users
+    users_by_email = {user.email: user for user in User.objects.filter(email__in=emails)}
     recipients = []
     for email in emails:
-        if email == request.user.email:
-            return JsonResponse({
-                'error': 'Cannot send email to self.'
-            }, status=400)
-        
-        try:
-            user = User.objects.get(email=email)    
-            recipients.append(user)
-        except User.DoesNotExist:
-            return JsonResponse({
-                'error': f'User with email {email} does not exist.'
-            }, status=400)
+        user = users_by_email.get(email)
+        if user is None:
+            raise ComposeError(f'User with email {email} does not exist.')
+        recipients.append(user)
 
     # Get contents of email
-    subject = data.get('subject', '')
-    body = data.get('body', '')
     is_encrypt = data.get('encrypt', False)
     is_sign = data.get('sign', False)
     passphrase = data.get('passphrase', '')
     
-    sender_key = PGPKey.objects.filter(user=request.user, default_key=True).first()
-    
-    # Check passphrase validity
-    if is_sign and (passphrase != sender_key.passphrase):
-        return JsonResponse({'error': 'Passphrase does not match'}, status=400)    
-    
-    secret_key = settings.SECRET_KEY
-    # Generate HMAC for email
-    hmac_body = generate_hmac(body, secret_key)
-    combined_body = f'{body}::{hmac_body}'
-    
-    # Encrypt and/or sign email
-    encrypted_bodies = {}
+    sender_key = None
+    recipient_keys = []
     public_keys_to_save = []
     
     if is_encrypt or is_sign:
+        sender_key = PGPKey.objects.filter(user=sender, default_key=True).first()
+
+        # Check passphrase validity
+        if is_sign and sender_key is None:
+            raise ComposeError('Default PGP key not found.')
+        if is_sign and (passphrase != sender_key.passphrase):
+            raise ComposeError('Passphrase does not match')
+
+        # Default keys of all recipients in one query
+        keys_by_user = {
+            key.user_id: key
+            for key in PGPKey.objects.filter(user__in=recipients, default_key=True)
+        }
+
         for user in recipients:
-            try:
-                recipient_key = PGPKey.objects.get(user=user, default_key=True)
-                pub_key = ReceivedPublicKey(
-                    user=request.user,
-                    owner=user,
-                    key_id=recipient_key.key_id,
-                    public_key=recipient_key.public_key,
-                    expire_date=recipient_key.expire_date
+            recipient_key = keys_by_user.get(user.id)
+            if recipient_key is None:
+                raise ComposeError(
+                    f'PGP key for user {user.email} not found!',
+                    flag='pgp_404',
+                    recipient=f'{user.email}'
                 )
-                public_keys_to_save.append(pub_key)
-                
-                if pub_key.is_expired():
-                    return JsonResponse({
-                        'error': f'PGP key for user {user.email} has expired!', 
-                        'flag': 'pgp_expire', 
-                        'recipient': f'{user.email}'
-                    }, status=400)
-                
-            except PGPKey.DoesNotExist:
-                return JsonResponse({
-                    'error': f'PGP key for user {user.email} not found!', 
-                    'flag': 'pgp_404', 
-                    'recipient': f'{user.email}'
-                }, status=400)
             
-            if is_encrypt and is_sign:
-                secured_body = encrypt_and_sign_message(combined_body, recipient_key.public_key, sender_key.private_key, passphrase)
-            elif is_encrypt:
-                secured_body = encrypt_message(combined_body, recipient_key.public_key)
-            elif is_sign:
-                secured_body = sign_message(combined_body, sender_key.private_key, passphrase)
-           
-            if isinstance(secured_body, ValueError):
-                return JsonResponse({'error': f'Failed to encrypt message for user {user.email}: {str(secured_body)}'}, status=400)
+            pub_key = ReceivedPublicKey(
+                user=sender,
+                owner=user,
+                key_id=recipient_key.key_id,
+                keyring_id=recipient_key.key_id,
+                expire_date=recipient_key.expire_date
+            )
+            public_keys_to_save.append(pub_key)
+
+            if pub_key.is_expired():
+                raise ComposeError(
+                    f'PGP key for user {user.email} has expired!',
+                    flag='pgp_expire',
+                    recipient=f'{user.email}'
+                )
+
+            recipient_keys.append(recipient_key)
+
+    return {
+        'recipients': recipients,
+        'subject': data.get('subject', ''),
+        'body': data.get('body', ''),
+        'is_encrypt': is_encrypt,
+        'is_sign': is_sign,
+        'passphrase': passphrase,
+        'sender_key': sender_key,
+        'recipient_keys': recipient_keys,
+        'public_keys_to_save': public_keys_to_save,
+    }
+
+
+# Encrypts and/or signs a prepared email and stores one Email row per participant.
+# Raises ComposeError if the crypto fails, otherwise returns the created emails.
+def deliver_email(sender, prepared):
+    recipients = prepared['recipients']
+    subject = prepared['subject']
+    body = prepared['body']
+    is_encrypt = prepared['is_encrypt']
+    is_sign = prepared['is_sign']
+    passphrase = prepared['passphrase']
+    sender_key = prepared['sender_key']
+    recipient_keys = prepared['recipient_keys']
+    public_keys_to_save = prepared['public_keys_to_save']
+
+    # Generate HMAC for email (body::v<key version>:<digest>)
+    combined_body, hmac_digest, hmac_key_version = sign_body(body)
+
+    # Encrypt and/or sign email
+    encrypted_bodies = {}
+
+    if is_encrypt or is_sign:
+        # Sign once: the signed payload is the same for every recipient,
+        # so the sender's private key is unlocked and used a single time
+        payload = combined_body
+        if is_sign:
+            payload = sign_message(combined_body, sender_key.private_key, passphrase)
+            if isinstance(payload, dict):
+                raise ComposeError(f'Failed to sign message: {payload.get("error")}')
+
+        if not is_encrypt:
+            secured_bodies = [payload] * len(recipients)
+        elif getattr(settings, 'COMPOSE_SHARED_SESSION_KEY', False):
+            # One OpenPGP message whose session key is wrapped for every recipient
+            shared_body = encrypt_message_for_recipients(
+                payload,
+                [key.public_key for key in recipient_keys],
+                [key.key_id for key in recipient_keys],
+                signed=is_sign,
+            )
+            secured_bodies = [shared_body] * len(recipients)
+        else:
+            # Encrypt for every recipient, in parallel when PGP_WORKER_PROCESSES > 1
+            crypto_func = encrypt_signed_message if is_sign else encrypt_message
+            secured_bodies = run_crypto_jobs(
+                crypto_func, [(payload, key.public_key, key.key_id) for key in recipient_keys]
+            )
+
+        for user, secured_body in zip(recipients, secured_bodies):
+            if isinstance(secured_body, dict):
+                raise ComposeError(f'Failed to encrypt message for user {user.email}: {secured_body.get("error")}')
 
             encrypted_bodies[user] = secured_body
 
 
     # Create and save email objects
     all_users = set(recipients)
-    all_users.add(request.user)
+    all_users.add(sender)
     
+    # Sign-only emails keep the signed payload in every copy, so it can be verified when read
+    if is_sign and not is_encrypt:
+        email_bodies = {user: payload for user in all_users}
+    else:
+        email_bodies = {
+            user: encrypted_bodies[user] if is_encrypt and user in encrypted_bodies else body
+            for user in all_users
+        }
+    # Identical bodies (plain text, shared session key) are packed and stored once
+    packed_bodies = Email.pack_bodies(email_bodies.values())
+
     emails_to_save = []
     for user in all_users:
-        email_body = encrypted_bodies[user] if is_encrypt and user in encrypted_bodies else body
+        email_body = email_bodies[user]
         email = Email(
             user=user,
-            sender=request.user,
+            sender=sender,
             subject=subject,
-            body=email_body,
-            read=(user == request.user),
+            **packed_bodies[email_body],
+            read=(user == sender),
             encrypted=is_encrypt,
             signed=is_sign,
         )
@@ -119,48 +196,109 @@ def compose(request):
     # Bulk create emails
     Email.objects.bulk_create(emails_to_save)
     
-    # Save or update ReceivedPublicKey objects
-    for public_key in public_keys_to_save:
-        is_key_exist = ReceivedPublicKey.objects.filter(key_id=public_key.key_id, owner=public_key.owner, user=public_key.user).first()
-        # If not exists, create new
-        if not is_key_exist:
-            pub_key = ReceivedPublicKey.objects.create(
-                user=public_key.user,
-                owner=public_key.owner,
-                key_id=public_key.key_id,
-                public_key=public_key.public_key,
-                expire_date=public_key.expire_date
-            )
-            pub_key.save()
-            
+    # Store the recipient keys once in the keyring, then save or update the
+    # ReceivedPublicKey references in one upsert
+    if public_keys_to_save:
+        KeyringKey.store([KeyringKey.from_pgp_key(key) for key in recipient_keys])
+        ReceivedPublicKey.objects.bulk_create(
+            public_keys_to_save,
+            update_conflicts=True,
+            unique_fields=['user', 'owner'],
+            update_fields=['key_id', 'keyring', 'expire_date'],
+        )
     
-    # Create recipient relationships
-    for email in emails_to_save:
-        email.recipients.set(recipients)
+    # Create recipient relationships in one insert
+    EmailRecipient = Email.recipients.through
+    EmailRecipient.objects.bulk_create([
+        EmailRecipient(email_id=email.id, user_id=user.id)
+        for email in emails_to_save
+        for user in recipients
+    ])
     
-    hmacs_to_save = []
-    email_pgpkeys_to_save = []
-    if is_encrypt:
-        for email in emails_to_save:
-            original_msg = body
-            email_body = encrypted_bodies[email.user] if email.user in encrypted_bodies else original_msg
-            hmac_record = EmailHMAC(email=email, hmac=hmac_body, secret_key=secret_key)
-            hmacs_to_save.append(hmac_record)
-            
-            for public_key in public_keys_to_save:
-                email_pgpkey = EmailPGPKey(email=email, recipient_public_key=public_key, sender_public_key=sender_key)
-                email_pgpkeys_to_save.append(email_pgpkey)
-            
+    # Listing rows and folder counters for everyone's mailbox
+    entries = [MailboxEntry.from_email(email, recipients) for email in emails_to_save]
+    if is_sign and not is_encrypt:
+        # The signed text is public, preview it instead of the armor
+        for entry in entries:
+            entry.preview = body_preview(body)
+    MailboxEntry.objects.bulk_create(entries)
+    apply_counter_deltas(entry_deltas(entries))
+    log_entry_changes(entries, MailboxChange.CREATED)
+    bump_mailbox_version([user.id for user in all_users])
+    publish_events(new_message_events(entries))
+    if public_keys_to_save:
+        bump_keys_version([sender.id])
+
+    if is_sign and not is_encrypt:
+        index_emails(emails_to_save, recipients, bodies={email.id: body for email in emails_to_save})
+    else:
+        index_emails(emails_to_save, recipients)
+
+    if is_encrypt or is_sign:
         # Bulk create HMACs
-        EmailHMAC.objects.bulk_create(hmacs_to_save)
-        
-        # Create Email PGP Keys
-        for public_key in ReceivedPublicKey.objects.all():
-            is_key_exist = ReceivedPublicKey.objects.filter(pk=public_key.pk).exists()  # Check if key exists
-            if is_key_exist:
-                email_pgpkey = EmailPGPKey(email=email, recipient_public_key=public_key, sender_public_key=sender_key)
-                email_pgpkey.save()
+        EmailHMAC.objects.bulk_create([
+            EmailHMAC(email=email, digest=hmac_digest, key_version=hmac_key_version)
+            for email in emails_to_save
+        ])
+
+    if is_sign and not is_encrypt:
+        # Link each copy to the key it was signed with
+        EmailPGPKey.objects.bulk_create([
+            EmailPGPKey(email=email, sender_public_key=sender_key)
+            for email in emails_to_save
+        ])
+    elif is_encrypt:
+        # Link each email to the keys it was encrypted with: a recipient's copy to
+        # that recipient's key, the sender's copy to every recipient key
+        received_keys = ReceivedPublicKey.objects.filter(user=sender, owner__in=recipients).only('id', 'owner_id')
+        received_keys_by_owner = {key.owner_id: key for key in received_keys}
+        recipient_keys_by_owner = {key.user_id: key for key in recipient_keys}
+
+        email_pgpkeys_to_save = []
+        for email in emails_to_save:
+            owners = recipients if email.user == sender else [email.user]
+            for owner in owners:
+                email_pgpkeys_to_save.append(EmailPGPKey(
+                    email=email,
+                    recipient_public_key=received_keys_by_owner[owner.id],
+                    recipient_key_id=recipient_keys_by_owner[owner.id].key_id,
+                    sender_public_key=sender_key,
+                ))
+        EmailPGPKey.objects.bulk_create(email_pgpkeys_to_save)
     
+    return emails_to_save
+
+
+# Request fields queued with an outbox job; the passphrase is only kept to sign
+OUTBOX_FIELDS = ('recipients', 'subject', 'body', 'encrypt', 'sign')
+
+
+def outbox_payload(data):
+    payload = {field: data[field] for field in OUTBOX_FIELDS if field in data}
+    if data.get('sign'):
+        payload['passphrase'] = data.get('passphrase', '')
+    return payload
+
+
+def compose(request):
+    # Composing a new email must be via POST
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required.'}, status=400)
+
+    data = json.loads(request.body)
+    try:
+        prepared = prepare_email(request.user, data)
+
+        # Outbox mode: the email is sent later by the process_outbox command
+        if getattr(settings, 'COMPOSE_OUTBOX', False):
+            job = OutboxJob.objects.create(user=request.user, payload=json.dumps(outbox_payload(data)))
+            return JsonResponse({'message': 'Email queued.', 'job_id': job.id}, status=202)
+
+        # Emails, recipients, entries, counters and change log are written together
+        with transaction.atomic():
+            deliver_email(request.user, prepared)
+    except ComposeError as e:
+        return JsonResponse(e.payload, status=e.status)
 
     return JsonResponse({'message': 'Email sent successfully.'}, status=201)
 
@@ -199,16 +337,37 @@ def request_key(request):
         return JsonResponse({'error': 'Invalid flag.'}, status=400)
 
     # Kirim request ke email user
-    email = Email(
-        user=user,
-        sender=request.user,
-        subject='Request for PGP Public Key',
-        body=body,
-        read=False,
-        encrypted=False,
-        signed=False
-    )
-    email.save()
-    email.recipients.add(user)
+    with transaction.atomic():
+        email = Email.with_body(
+            body,
+            user=user,
+            sender=request.user,
+            subject='Request for PGP Public Key',
+            read=False,
+            encrypted=False,
+            signed=False
+        )
+        email.save()
+        email.recipients.add(user)
+        entry = MailboxEntry.from_email(email, [user])
+        entry.save(force_insert=True)
+        apply_counter_deltas(entry_deltas([entry]))
+        log_entry_changes([entry], MailboxChange.CREATED)
+        bump_mailbox_version([user.id])
+        publish_events(new_message_events([entry]))
+        index_emails([email], [user])
 
     return JsonResponse({'message': 'Request key message sent successfully.'}, status=200)
+
+
+# GET /emails/outbox/<job_id>: status of a queued email
+def outbox_job_status(request, job_id):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+
+    try:
+        job = OutboxJob.objects.get(user=request.user, pk=job_id)
+    except OutboxJob.DoesNotExist:
+        return JsonResponse({'error': 'Outbox job not found.'}, status=404)
+
+    return JsonResponse(job.serialize())
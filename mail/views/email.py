@@ -1,29 +1,65 @@
 import json
+import hashlib
+from contextlib import nullcontext
+from django.core.cache import cache
 from django.http import JsonResponse
 from mail.models import Email, PGPKey, EmailPGPKey
 from django.conf import settings
 from ..utils.pgp_encryption import decrypt_message, decrypt_and_verify_message, verify_message
-from ..utils.hmac_auth import verify_hmac
+from ..utils.hmac_auth import verify_signed_body
+from ..utils.key_cache import unlocked_key_cache
+
+
+# Cache key of a verification result. The sender key fingerprint and the body digest
+# are part of the key, so a changed EmailPGPKey or body never reuses an old result.
+def signature_cache_key(email, sender_key):
+    body_digest = hashlib.sha256(email.get_stored_body()).hexdigest()
+    return f'mail:signature:{email.id}:{sender_key.key_id}:{body_digest}'
+
+
+# Returns the result of verify_message for a signed email, verifying only on a cache miss
+def verify_email_signature(email, sender_key):
+    cache_key = signature_cache_key(email, sender_key)
+    result = cache.get(cache_key)
+    if result is None:
+        result = verify_message(email.get_pgp_body(), sender_key.public_key, sender_key.key_id)
+        cache.set(cache_key, result, getattr(settings, 'SIGNATURE_CACHE_TIMEOUT', None))
+    return result
 
 
 def get_email(request, id, email):
-    if email.signed:
-        email_pgp_key = EmailPGPKey.objects.filter(email=id).first()
+    # Encrypted emails are verified when they are decrypted
+    if email.signed and not email.encrypted:
+        email_pgp_key = EmailPGPKey.objects.select_related('sender_public_key').filter(email=id).first()
         if email_pgp_key is None:
             return JsonResponse({'error': 'Email PGP key not found.'}, status=400)
         
-        msg = verify_message(email.body, email_pgp_key.sender_public_key.public_key)
+        msg = verify_email_signature(email, email_pgp_key.sender_public_key)
         if msg.get('error') is not None:
             return JsonResponse({'error': f'Failed to decrypt message: {msg.get("error")}'}, status=400)
+
+        # The signed text carries the HMAC trailer (body::hmac)
+        body = verify_signed_body(msg.get('message'))
+        if body is None:
+            return JsonResponse({'error': 'Failed to verify HMAC authentication'}, status=400)
             
-        email.body = msg
+        return JsonResponse(email.serialize(body=body))
     
     return JsonResponse(email.serialize())
 
 
+# Yields the user's private key unlocked for this session when UNLOCKED_KEY_CACHE is on,
+# otherwise the armored key, unlocked by the decrypt functions. The cached key is only
+# locked again once the block ends.
+def unlocked_private_key(request, pgp_key, passphrase):
+    if not getattr(settings, 'UNLOCKED_KEY_CACHE', False) or request.session.session_key is None:
+        return nullcontext(pgp_key.private_key)
+    return unlocked_key_cache.use(request.session.session_key, pgp_key.key_id, pgp_key.private_key, passphrase)
+
+
 def decrypt_email(request, email_id):
     try:
-        email = Email.objects.get(user=request.user, pk=email_id)
+        email = Email.objects.select_related('content').get(user=request.user, pk=email_id)
     except:
         return JsonResponse({'error': 'Email not found.'}, status=404)
     
@@ -46,29 +82,27 @@ def decrypt_email(request, email_id):
             if passphrase != user_pgp_key.passphrase:
                 return JsonResponse({'error': 'Passphrase does not match.'}, status=400)
             
-            if email.encrypted and email.signed:
-                decrypted_body = decrypt_and_verify_message(email.body, user_pgp_key.private_key, passphrase, email_pgp_key.sender_public_key.public_key)
-            elif email.encrypted:            
-                decrypted_body = decrypt_message(email.body, user_pgp_key.private_key, passphrase)
-            elif email.signed:
-                decrypted_body = verify_message(email.body, email_pgp_key.sender_public_key.public_key) 
+            sender_key = email_pgp_key.sender_public_key
+            stored_body = email.get_pgp_body()
+            with unlocked_private_key(request, user_pgp_key, passphrase) as private_key:
+                if email.encrypted and email.signed:
+                    decrypted_body = decrypt_and_verify_message(
+                        stored_body, private_key, passphrase, sender_key.public_key, sender_key.key_id
+                    )
+                elif email.encrypted:
+                    decrypted_body = decrypt_message(stored_body, private_key, passphrase)
+                elif email.signed:
+                    decrypted_body = verify_message(stored_body, sender_key.public_key, sender_key.key_id)
             
             if decrypted_body.get('error') is not None:
                 return JsonResponse({'error': f'Failed to decrypt message: {decrypted_body.get("error")}'}, status=400)
             
-            # Split body and HMAC key (body::hmac)
-            split_body = decrypted_body.get('message').split('::')
-            body = split_body[0]
-            hmac = split_body[1]
-            
-            # Verify HMAC authentication
-            secret_key = settings.SECRET_KEY
-            if verify_hmac(body, secret_key, received_hmac=hmac) is False:
+            # Verify HMAC authentication (body::hmac) with the key of the HMAC's version
+            body = verify_signed_body(decrypted_body.get('message'))
+            if body is None:
                 return JsonResponse({'error': 'Failed to verify HMAC authentication'})
             
-            email.body = body
-            
-            return JsonResponse({'data': email.serialize()})
+            return JsonResponse({'data': email.serialize(body=body)})
         
         except PGPKey.DoesNotExist:
             return JsonResponse({'error': 'PGP key not found.'}, status=400)
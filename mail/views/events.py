@@ -0,0 +1,77 @@
+import asyncio
+import time
+from queue import Empty
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from ..utils.events import events_enabled, format_event, get_event_backend
+
+# Sent first: how long the browser waits before reconnecting a closed stream
+RETRY_FRAME = 'retry: 5000\n\n'
+# Comment line, keeps proxies from closing an idle connection
+KEEPALIVE_FRAME = ': keepalive\n\n'
+
+
+# GET /emails/events
+# Server-sent event stream of the user's new-message and read/archive events, when
+# MAIL_EVENTS is on. The stream ends after MAIL_EVENT_STREAM_TIMEOUT seconds and the
+# browser reconnects, so under WSGI (runserver) a tab holds a worker thread for a bounded
+# time only; under ASGI an idle stream costs a queue instead of a thread. Missed events
+# are recovered with /emails/sync.
+async def event_stream(request):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+    if not events_enabled():
+        return JsonResponse({'error': 'Mailbox events are disabled.'}, status=404)
+
+    user_id = await sync_to_async(lambda: request.user.pk)()
+    if isinstance(request, ASGIRequest):
+        stream = async_stream(user_id)
+    else:
+        stream = sync_stream(user_id)
+
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def stream_settings():
+    return getattr(settings, 'MAIL_EVENT_KEEPALIVE', 15), getattr(settings, 'MAIL_EVENT_STREAM_TIMEOUT', 300)
+
+
+async def async_stream(user_id):
+    keepalive, timeout = stream_settings()
+    backend = get_event_backend()
+    queue = backend.subscribe(user_id)
+    deadline = time.monotonic() + timeout
+    try:
+        yield RETRY_FRAME
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=min(keepalive, remaining))
+            except asyncio.TimeoutError:
+                yield KEEPALIVE_FRAME
+                continue
+            yield format_event(event)
+    finally:
+        backend.unsubscribe(user_id, queue)
+
+
+def sync_stream(user_id):
+    keepalive, timeout = stream_settings()
+    backend = get_event_backend()
+    queue = backend.subscribe_sync(user_id)
+    deadline = time.monotonic() + timeout
+    try:
+        yield RETRY_FRAME
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = queue.get(timeout=min(keepalive, remaining))
+            except Empty:
+                yield KEEPALIVE_FRAME
+                continue
+            yield format_event(event)
+    finally:
+        backend.unsubscribe(user_id, queue)
@@ -1,16 +1,31 @@
 import json
 import logging
+from asgiref.sync import sync_to_async
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import HttpResponse, HttpResponseRedirect, render
 from django.urls import reverse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
-from ..models import Email
-from .security import generate_key, user_keys, user_key_item, received_keys, received_key_item
-from .compose import compose, request_key
+from django.views.decorators.http import condition
+from ..models import Email, MailboxChange, MailboxEntry, mailbox_folder
+from ..utils.changes import log_changes
+from ..utils.events import events_enabled, message_updated_event, publish_events
+from ..utils.counters import apply_counter_deltas, count_message
+from ..utils.versions import (
+    bump_mailbox_version, mailbox_etag, mailbox_last_modified, keys_etag, keys_last_modified,
+    email_etag, email_last_modified,
+)
+from .security import generate_key, key_job_status, user_keys, user_key_item, received_keys, received_key_item
+from .compose import compose, request_key, outbox_job_status
 from .auth import login_service, register_service
 from .email import get_email, decrypt_email
+from .mailbox import list_mailbox, search_mailbox, folder_summary, sync_mailbox, export_mailbox, export_mbox
+from .events import event_stream
+from .bulk import bulk_update
 
 
 logger = logging.getLogger('app_api') #from LOGGING.loggers in settings.py
@@ -18,7 +33,7 @@ logger = logging.getLogger('app_api') #from LOGGING.loggers in settings.py
 def index(request):
     # Authenticated users view their inbox
     if request.user.is_authenticated:
-        return render(request, 'inbox.html')
+        return render(request, 'inbox.html', {'mail_events': events_enabled()})
 
     # Everyone else is prompted to sign in
     else:
@@ -50,37 +65,79 @@ def request_key_view(request):
     return request_key(request)
 
 
+@csrf_exempt
+@login_required
+def bulk_view(request):
+    return bulk_update(request)
+
+
 @login_required
+def outbox_job_view(request, job_id):
+    return outbox_job_status(request, job_id)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=mailbox_etag, last_modified_func=mailbox_last_modified)
+def summary_view(request):
+    return folder_summary(request)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=mailbox_etag, last_modified_func=mailbox_last_modified)
+def search_view(request):
+    return search_mailbox(request)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=mailbox_etag, last_modified_func=mailbox_last_modified)
+def sync_view(request):
+    return sync_mailbox(request)
+
+
+# login_required does not wrap async views in this Django version
+async def events_view(request):
+    is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+    if not is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    return await event_stream(request)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=mailbox_etag, last_modified_func=mailbox_last_modified)
 def mailbox(request, mailbox):
+    return list_mailbox(request, mailbox)
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+def export_view(request, mailbox):
+    return export_mailbox(request, mailbox)
 
-    # Filter emails returned based on mailbox
-    if mailbox == 'inbox':
-        emails = Email.objects.filter(
-            user=request.user, recipients=request.user, archived=False
-        )
-    elif mailbox == 'sent':
-        emails = Email.objects.filter(
-            user=request.user, sender=request.user
-        )
-    elif mailbox == 'archive':
-        emails = Email.objects.filter(
-            user=request.user, recipients=request.user, archived=True
-        )
-    else:
-        return JsonResponse({'error': 'Invalid mailbox.'}, status=400)
 
-    # Return emails in reverse chronologial order
-    emails = emails.order_by('-timestamp').all()
-    return JsonResponse([email.serialize() for email in emails], safe=False)
+@login_required
+@cache_control(private=True, no_cache=True)
+def export_mbox_view(request):
+    return export_mbox(request)
+
+
+# (read, archived) of an email, locking the row where the database supports it
+def email_state(email_id):
+    return Email.objects.select_for_update().filter(pk=email_id).values_list('read', 'archived').get()
 
 
 @csrf_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=email_etag, last_modified_func=email_last_modified)
 def email(request, email_id):
 
     # Query for requested email
     try:
-        email = Email.objects.get(user=request.user, pk=email_id)
+        email = Email.objects.select_related('content').get(user=request.user, pk=email_id)
     except Email.DoesNotExist:
         return JsonResponse({'error': 'Email not found.'}, status=404)
 
@@ -91,11 +148,42 @@ def email(request, email_id):
     # Update whether email is read or should be archived
     elif request.method == 'PUT':
         data = json.loads(request.body)
-        if data.get('read') is not None:
-            email.read = data['read']
-        if data.get('archived') is not None:
-            email.archived = data['archived']
-        email.save()
+
+        with transaction.atomic():
+            # Compare-and-set: the row is only updated if it still has the state the
+            # counter deltas are computed from, otherwise the state is read again
+            while True:
+                try:
+                    old_read, old_archived = email_state(email.pk)
+                except Email.DoesNotExist:
+                    return JsonResponse({'error': 'Email not found.'}, status=404)
+                read = old_read if data.get('read') is None else bool(data['read'])
+                archived = old_archived if data.get('archived') is None else bool(data['archived'])
+                if (read, archived) == (old_read, old_archived):
+                    return HttpResponse(status=204)
+                updated = Email.objects.filter(pk=email.pk, read=old_read, archived=old_archived).update(
+                    read=read,
+                    archived=archived,
+                )
+                if updated:
+                    break
+
+            email.read = read
+            email.archived = archived
+            old_folder = mailbox_folder(email.user_id, email.sender_id, old_archived)
+            folder = mailbox_folder(email.user_id, email.sender_id, archived)
+            MailboxEntry.objects.filter(email=email).update(
+                read=read,
+                archived=archived,
+                folder=folder,
+            )
+            deltas = {}
+            count_message(deltas, email.user_id, old_folder, old_read, sign=-1)
+            count_message(deltas, email.user_id, folder, read)
+            apply_counter_deltas(deltas)
+            log_changes([(email.user_id, email.id)], MailboxChange.UPDATED)
+            bump_mailbox_version([email.user_id])
+            publish_events([message_updated_event(email, folder)])
         return HttpResponse(status=204)
 
     # Email must be via GET or PUT
@@ -113,26 +201,39 @@ def generate_key_view(request):
     return generate_key(request)
 
 
+@login_required
+def key_job_view(request, job_id):
+    return key_job_status(request, job_id)
+
+
 @csrf_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=keys_etag, last_modified_func=keys_last_modified)
 def user_keys_view(request):
     return user_keys(request)
 
 
 @csrf_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=keys_etag, last_modified_func=keys_last_modified)
 def user_key_item_view(request, key_id):
     return user_key_item(request, key_id)
 
 
 @csrf_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=keys_etag, last_modified_func=keys_last_modified)
 def received_keys_view(request):
     return received_keys(request)
 
 
 @csrf_exempt
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=keys_etag, last_modified_func=keys_last_modified)
 def received_key_item_view(request, key_id):
     return received_key_item(request, key_id)
 
@@ -0,0 +1,213 @@
+from django.conf import settings
+from django.db.models import Exists, F, OuterRef, Prefetch, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from mail.models import Email, EmailRecipient, MailboxEntry, User
+from ..utils.pagination import paginate_keyset, PaginationError
+from ..utils.search import search_enabled, search_email_ids
+from ..utils.counters import mailbox_summary
+from ..utils.changes import changes_since, latest_token
+from ..utils.streaming import CONTENT_TYPES, NDJSON, streaming_json_response
+from ..utils.mailbox_formats import export_queryset, mbox_records
+
+
+# Returns the base queryset of a user's mailbox, or None if the mailbox is unknown.
+# "Received by user" is an EXISTS on the recipients table rather than a join, so SQLite
+# walks the (user, archived, timestamp) index in order and stops after one page.
+# archived__in is used because archived=False compiles to "NOT archived", which
+# cannot use the index.
+def mailbox_queryset(user, mailbox):
+    received = Exists(EmailRecipient.objects.filter(email=OuterRef('pk'), user=user))
+    if mailbox == 'inbox':
+        return Email.objects.filter(received, user=user, archived__in=[False])
+    elif mailbox == 'sent':
+        return Email.objects.filter(user=user, sender=user)
+    elif mailbox == 'archive':
+        return Email.objects.filter(received, user=user, archived__in=[True])
+    return None
+
+
+# Returns the page size requested by the client, clamped to MAILBOX_MAX_PAGE_SIZE
+def get_page_limit(request):
+    default_limit = getattr(settings, 'MAILBOX_PAGE_SIZE', 50)
+    max_limit = getattr(settings, 'MAILBOX_MAX_PAGE_SIZE', 200)
+
+    limit = request.GET.get('limit', default_limit)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise PaginationError('Invalid limit.')
+    if limit < 1:
+        raise PaginationError('Invalid limit.')
+    return min(limit, max_limit)
+
+
+# Loads sender and recipients (email addresses only) in two queries for the whole page
+def with_participants(emails):
+    return emails.select_related('sender').prefetch_related(
+        Prefetch('recipients', queryset=User.objects.only('id', 'email'))
+    )
+
+
+# Mailbox listing without the body, plus the preview computed when the email was
+# written (MailboxEntry.preview), so compressed or shared bodies need not be unpacked
+def mailbox_summary_queryset(emails):
+    return with_participants(emails).defer('body', 'body_data').annotate(
+        preview=F('mailbox_entry__preview')
+    )
+
+
+# Listing rows of a mailbox, served from the denormalized MailboxEntry table
+def mailbox_entries_queryset(user, mailbox):
+    return MailboxEntry.objects.filter(owner=user, folder=mailbox)
+
+
+# GET /emails/<mailbox>?limit=&before=&after=&view=
+# Returns one page of the mailbox in reverse chronological order, with cursors
+# for the next (older) and previous (newer) pages.
+# By default the page is read from MailboxEntry, without bodies or joins;
+# view=full returns the full Email serialization instead.
+def list_mailbox(request, mailbox):
+    emails = mailbox_queryset(request.user, mailbox)
+    if emails is None:
+        return JsonResponse({'error': 'Invalid mailbox.'}, status=400)
+
+    full = request.GET.get('view') == 'full'
+    if full:
+        rows = with_participants(emails).select_related('content')
+    else:
+        rows = mailbox_entries_queryset(request.user, mailbox)
+
+    try:
+        limit = get_page_limit(request)
+        page, next_cursor, prev_cursor = paginate_keyset(
+            rows,
+            limit,
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+        )
+    except PaginationError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({
+        'emails': [row.serialize() for row in page],
+        'next': next_cursor,
+        'prev': prev_cursor,
+    })
+
+
+# GET /emails/<mailbox>/export?format=ndjson|json&view=
+# Streams the whole mailbox, newest first, as NDJSON (default) or a JSON array.
+# Rows are read with QuerySet.iterator() in chunks of EXPORT_CHUNK_SIZE, so the
+# first rows are sent before the rest are loaded and memory stays bounded.
+# view=full exports the full Email serialization (with bodies).
+def export_mailbox(request, mailbox):
+    emails = mailbox_queryset(request.user, mailbox)
+    if emails is None:
+        return JsonResponse({'error': 'Invalid mailbox.'}, status=400)
+
+    output_format = request.GET.get('format', NDJSON)
+    if output_format not in CONTENT_TYPES:
+        return JsonResponse({'error': 'Invalid format.'}, status=400)
+
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 500)
+    if request.GET.get('view') == 'full':
+        rows = with_participants(emails).select_related('content')
+    else:
+        rows = mailbox_entries_queryset(request.user, mailbox)
+    rows = rows.order_by('-timestamp', '-pk').iterator(chunk_size=chunk_size)
+
+    return streaming_json_response(
+        (row.serialize() for row in rows),
+        output_format,
+        filename=f'{mailbox}.{output_format}',
+    )
+
+
+# GET /emails/export.mbox: download of all the user's emails as an mbox file
+def export_mbox(request):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 500)
+    emails = export_queryset(request.user).iterator(chunk_size=chunk_size)
+    response = StreamingHttpResponse(mbox_records(emails), content_type='application/mbox')
+    response['Content-Disposition'] = 'attachment; filename="mailbox.mbox"'
+    return response
+
+
+# GET /emails/search?q=&limit=&offset=
+# Full-text search over the user's emails (subject, sender, recipients and
+# non-encrypted bodies), best match first.
+def search_mailbox(request):
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'Search query required.'}, status=400)
+
+    try:
+        limit = get_page_limit(request)
+        offset = int(request.GET.get('offset', 0))
+    except (PaginationError, ValueError):
+        return JsonResponse({'error': 'Invalid limit or offset.'}, status=400)
+    if offset < 0:
+        return JsonResponse({'error': 'Invalid limit or offset.'}, status=400)
+
+    emails = Email.objects.filter(user=request.user)
+    if search_enabled():
+        ids = search_email_ids(request.user, query, limit, offset)
+        has_more = len(ids) > limit
+        ids = ids[:limit]
+        found = {email.id: email for email in mailbox_summary_queryset(emails.filter(id__in=ids))}
+        page = [found[pk] for pk in ids if pk in found]
+    else:
+        # Without FTS5, fall back to a (slow) substring search
+        emails = emails.filter(
+            Q(subject__icontains=query)
+            | Q(sender__email__icontains=query)
+            | Q(recipients__email__icontains=query)
+            | Q(body__icontains=query, encrypted=False)
+            | Q(content__body__icontains=query, encrypted=False)
+        ).distinct().order_by('-timestamp', '-id')
+        page = list(mailbox_summary_queryset(emails)[offset:offset + limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+    return JsonResponse({
+        'emails': [email.serialize_summary() for email in page],
+        'next': offset + limit if has_more else None,
+    })
+
+
+# GET /emails/summary: total and unread counts of every folder
+def folder_summary(request):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+    return JsonResponse(mailbox_summary(request.user))
+
+
+# GET /emails/sync?since=<token>&limit=
+# Returns the emails created, updated (read/archived) or deleted since the change
+# token, and the token to pass next time. "more" is true when further changes are
+# waiting. Without since, only the current token is returned.
+def sync_mailbox(request):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+
+    since = request.GET.get('since')
+    if since is None:
+        return JsonResponse({
+            'token': latest_token(request.user),
+            'more': False,
+            'created': [],
+            'updated': [],
+            'deleted': [],
+        })
+
+    try:
+        limit = get_page_limit(request)
+        since = int(since)
+    except (PaginationError, ValueError):
+        return JsonResponse({'error': 'Invalid limit or token.'}, status=400)
+    if since < 0:
+        return JsonResponse({'error': 'Invalid limit or token.'}, status=400)
+
+    return JsonResponse(changes_since(request.user, since, limit))
@@ -1,11 +1,11 @@
 import json
 import logging
-import pgpy
-from datetime import timedelta
-from django.utils import timezone
-from pgpy.constants import PubKeyAlgorithm, KeyFlags, HashAlgorithm, SymmetricKeyAlgorithm, CompressionAlgorithm
+from django.conf import settings
 from django.http import JsonResponse
-from mail.models import PGPKey, ReceivedPublicKey
+from mail.models import KeyGenJob, PGPKey, ReceivedPublicKey
+from mail.utils.key_cache import public_key_cache, unlocked_key_cache
+from mail.utils.keygen import KeyGenError, create_user_key, validate_key_request
+from mail.utils.versions import bump_keys_version
 
 logger = logging.getLogger('app_api') #from LOGGING.loggers in settings.py
 
@@ -50,6 +50,7 @@ def user_key_item(request, key_id):
             pgp_key.save()
             
             PGPKey.objects.filter(user=request.user).exclude(key_id=key_id).update(default_key=False)
+            bump_keys_version([request.user.id])
             
             return JsonResponse({'message': 'PGP key updated successfully.'})
             
@@ -60,6 +61,9 @@ def user_key_item(request, key_id):
         try:
             pgp_key = PGPKey.objects.get(user=request.user, key_id=key_id)
             pgp_key.delete()
+            public_key_cache.invalidate(key_id)
+            unlocked_key_cache.invalidate_key(key_id)
+            bump_keys_version([request.user.id])
             return JsonResponse({'message': 'PGP key deleted successfully.'})
         except PGPKey.DoesNotExist:
             return JsonResponse({'error': 'PGP key not found.'}, status=404)
@@ -96,6 +100,8 @@ def received_key_item(request, key_id):
         try:
             keys = ReceivedPublicKey.objects.filter(user=request.user, key_id=key_id)
             keys.delete()
+            public_key_cache.invalidate(key_id)
+            bump_keys_version([request.user.id])
             return JsonResponse({'message': 'Received keys deleted successfully.'})
         except ReceivedPublicKey.DoesNotExist:
             return JsonResponse({'error': 'Received keys not found.'}, status=404)
@@ -110,89 +116,21 @@ def generate_key(request):
     
     if request.method == 'POST':
         
-        data = json.loads(request.body)
-        user = request.user
-        key_type = data.get('key_type')
-        key_size = data.get('key_size')
-        expiration = data.get('expire')
-        passphrase = data.get('passphrase')
-        comment = data.get('comment', '')
-        
-        if key_type not in ['RSA', 'DSA']:
-            return JsonResponse({'error': 'Invalid key type.'}, status=400)
-        
-        # if key_type == 'ECDSA':
-        #     if key_size not in [256, 384, 521]:
-        #         return JsonResponse({'error': 'Invalid key size.'}, status=400)
-        
-        if key_size not in [1024, 2048, 4096]:
-            return JsonResponse({'error': 'Invalid key size.'}, status=400)
-        
-        if not isinstance(expiration, int) or expiration is None:
-            return JsonResponse({'error': 'Invalid expiration value.'}, status=400)
-        
-        key = None
-        
-        if key_type == 'RSA':
-            key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, key_size)
-        elif key_type == 'DSA':
-            key = pgpy.PGPKey.new(PubKeyAlgorithm.DSA, key_size)
-        # elif key_type == 'ECDSA':
-        #     key = pgpy.PGPKey.new(PubKeyAlgorithm.ECDSA, key_size)
-
-        # we now have some key material, but our new key doesn't have a user ID yet, and therefore is not yet usable!
-        fullname = f'{user.first_name} {user.last_name}'
-        uid = pgpy.PGPUID.new(fullname, comment=comment, email=user.email)
-
-        # now we must add the new user id to the key. We'll need to specify all of our preferences at this point
-        # because PGPy doesn't have any built-in key preference defaults at this time
-        # this example is similar to GnuPG 2.1.x defaults, with no expiration or preferred keyserver
-        usage_flags = {KeyFlags.Sign, KeyFlags.EncryptCommunications}
-        hash_algs = [HashAlgorithm.SHA256]
-        symmetric_algs = [SymmetricKeyAlgorithm.AES256]
-        compression_algs = [CompressionAlgorithm.ZLIB]    
-        
-        key.add_uid(
-            uid, 
-            usage=usage_flags,
-            hashes=hash_algs,
-            ciphers=symmetric_algs,
-            compression=compression_algs,
-            key_expiration=timedelta(days=expiration)
-        )
-        
-        key.protect(passphrase, SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
-        
-        encrypt = False
-        sign = False
-        
-        if key_type == 'RSA':
-            encrypt = True
-            sign = True
-        elif key_type == 'DSA':
-            sign = True
+        try:
+            data = json.loads(request.body)
+            validate_key_request(data)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON.'}, status=400)
+        except KeyGenError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         
-        default_key = False
-        count_keys = PGPKey.objects.filter(user=user).count()
-        if count_keys == 0:
-            default_key = True
+        # Background mode: the key is generated by the process_key_jobs command
+        if getattr(settings, 'KEYGEN_BACKGROUND', False):
+            job = KeyGenJob.objects.create(user=request.user, payload=json.dumps(data))
+            return JsonResponse({'message': 'Key generation queued.', 'job_id': job.id}, status=202)
         
         try:
-            pgp_key = PGPKey.objects.create(
-                key_id=str(key.fingerprint),
-                user=user, 
-                public_key=str(key.pubkey), 
-                private_key=str(key),
-                key_size=key_size,
-                encrypt=encrypt,
-                sign=sign,
-                passphrase=passphrase, 
-                expire_date=timezone.now() + timedelta(days=expiration), 
-                default_key=default_key,
-                created=timezone.now()
-            )
-            pgp_key.save()
-            
+            create_user_key(request.user, data)
             return JsonResponse({'message': 'PGP key generated successfully.'}, status=201)
         except Exception as e:
             logger.error(f'Failed to save PGP key: {str(e)}')
@@ -201,4 +139,17 @@ def generate_key(request):
     else:
         return JsonResponse({
             'error': 'POST request required.'
-        }, status=400)
\ No newline at end of file
+        }, status=400)
+
+
+# GET /api/security/generate/<job_id>: status of a queued key generation
+def key_job_status(request, job_id):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'GET request required.'}, status=400)
+
+    try:
+        job = KeyGenJob.objects.select_related('key').get(user=request.user, pk=job_id)
+    except KeyGenJob.DoesNotExist:
+        return JsonResponse({'error': 'Key generation job not found.'}, status=404)
+
+    return JsonResponse(job.serialize())
@@ -10,8 +10,13 @@ document.addEventListener('DOMContentLoaded', function () {
 
     // By default, load the inbox
     load_mailbox('inbox');
+
+    // Refresh the open mailbox when mail arrives instead of polling
+    subscribe_events();
 });
 
+let current_mailbox = null;
+
 
 function compose_email() {
     // Show compose view and hide other views
@@ -600,6 +605,41 @@ function generate_key(key_type, key_size, key_expiration, passphrase, comment) {
                 return
             }
 
+            // Queued: the key is generated in the background
+            if (result.job_id) {
+                wait_for_key_job(result.job_id);
+                return
+            }
+
+            localStorage.clear();
+            document.querySelector('#security-view').innerHTML = '';
+            load_security();
+        })
+}
+
+
+/**
+ * GET /api/security/generate/<job_id>
+ * Polls a queued key generation until it is done, then reloads the keys
+ * @param job_id
+ */
+function wait_for_key_job(job_id) {
+    fetch(`/api/security/generate/${job_id}`)
+        .then(response => response.json())
+        .then(job => {
+            if (job.status === 'pending' || job.status === 'running') {
+                setTimeout(() => wait_for_key_job(job_id), 1000);
+                return
+            }
+
+            if (job.status === 'failed') {
+                document.querySelector('#error-generate-key').innerHTML = '';
+                const errorMsg = document.createElement('span')
+                errorMsg.textContent = job.error
+                document.querySelector('#error-generate-key').appendChild(errorMsg)
+                return
+            }
+
             localStorage.clear();
             document.querySelector('#security-view').innerHTML = '';
             load_security();
@@ -617,13 +657,48 @@ function load_mailbox(mailbox) {
     document.querySelector('#security-view').style.display = 'none';
     document.querySelector('#compose-view').style.display = 'none';
 
+    current_mailbox = mailbox;
+
     // Show the mailbox name
     document.querySelector('#emails-view').innerHTML = `<h3>${mailbox.charAt(0).toUpperCase() + mailbox.slice(1)}</h3>`;
 
-    // GET /emails/<str:mailbox>
-    fetch(`/emails/${mailbox}`)
+    load_mailbox_page(mailbox, null);
+}
+
+
+/**
+ * GET /emails/events
+ * Reloads the open mailbox when a new email arrives in it (only when the server has
+ * MAIL_EVENTS on; the stream ends periodically and EventSource reconnects)
+ */
+function subscribe_events() {
+    if (!window.EventSource || !MAIL_EVENTS) {
+        return;
+    }
+    const events = new EventSource('/emails/events');
+    events.addEventListener('message.new', event => {
+        const email = JSON.parse(event.data);
+        const visible = document.querySelector('#emails-view').style.display === 'block';
+        if (visible && email.folder === current_mailbox) {
+            load_mailbox(current_mailbox);
+        }
+    });
+}
+
+
+/**
+ * GET /emails/<str:mailbox>?before=<cursor>
+ * Appends one page of emails and a "Load more" button if there are older emails
+ * @param mailbox 
+ * @param cursor 
+ */
+function load_mailbox_page(mailbox, cursor) {
+    const url = cursor ? `/emails/${mailbox}?before=${encodeURIComponent(cursor)}` : `/emails/${mailbox}`;
+
+    fetch(url)
         .then(response => response.json())
-        .then(emails => {
+        .then(page => {
+            const emails = page.emails;
             const user = getCookie('user_email')
 
             emails.forEach(email => {
@@ -639,7 +714,7 @@ function load_mailbox(mailbox) {
 
                 const encryptCondition = email.encrypted && (email.recipients != user);
 
-                const emailBody = email.body.length >= 99 ? `${email.body.slice(0, 99)} <a href='#'>(more...)</a>` : email.body.slice(0, 99);
+                const emailBody = email.preview.length >= 99 ? `${email.preview.slice(0, 99)} <a href='#'>(more...)</a>` : email.preview;
 
                 let div = document.createElement('div');
                 div.className = `card my-1 items`;
@@ -671,6 +746,17 @@ function load_mailbox(mailbox) {
                     view_email(email.id, mailbox);
                 });
             });
+
+            if (page.next) {
+                let more = document.createElement('button');
+                more.className = 'btn btn-outline-primary my-2';
+                more.innerHTML = 'Load more';
+                more.addEventListener('click', () => {
+                    more.remove();
+                    load_mailbox_page(mailbox, page.next);
+                });
+                document.querySelector('#emails-view').appendChild(more);
+            }
         })
 }
 
@@ -681,6 +767,9 @@ function load_mailbox(mailbox) {
  * @param mailbox 
  */
 function view_email(email_id, mailbox) {
+    // The mailbox list is replaced, stop refreshing it
+    current_mailbox = null;
+
     // GET /emails/<int:email_id>
     fetch(`/emails/${email_id}`)
         .then(response => response.json())